@@ -11,14 +11,22 @@ These were assembled into this full workflow and UI by Sam Marshall
 Subsequent updates have been made by Will Greene
 """
 import Metashape
+import os
 from os import path
 import sys
 import csv
 import re
+import shutil
+import tempfile
 #import exifread
 from datetime import datetime
 from PySide2 import QtGui, QtCore, QtWidgets
 from ui_components import AddPhotosGroupBox, BoundaryMarkerDlg, GeoreferenceGroupBox
+from processing_settings import load_processing_settings, load_compression_profile
+from export_tools import raster_job, tiles_job, shapes_job, run_export_job, ExportScheduler, ExportCache, EXPORT_CACHE_FILE, tile_grid, write_tile_manifest, window_extent, export_region, export_compression, pixel_size, export_resolution
+from raster_tools import read_tiff_array, hillshade, mark_points, write_png, DEM_NODATA, QUANTIZED_NODATA
+from timeseries_tools import check_marker_residuals, coregister_chunk, reference_chunk_of, record_alignment_qa
+from camera_selection import tie_point_coords, surface_grid, camera_footprints, greedy_view_selection, coverage_analysis, write_coverage_png
 
 #function to display message boxes for errors
 def show_error_dialog(title, exception):
@@ -31,9 +39,12 @@ def show_error_dialog(title, exception):
     
 class FullWorkflowDlg(QtWidgets.QDialog):
 
-    def __init__(self, parent):
+    def __init__(self, parent, unattended = False):
         # set document info
         self.doc = Metashape.app.document
+        # in unattended mode (batch processing, see 13_align_all_timepoints.py) the dialog is never shown: the caller runs
+        # runWorkFlow() with the saved settings, and messages are printed instead of waiting for someone to click OK
+        self.unattended = unattended
 
         if len(self.doc.chunks) == 0:
             self.doc.addChunk()
@@ -110,6 +121,59 @@ class FullWorkflowDlg(QtWidgets.QDialog):
         self.checkBoxVertexColors.setToolTip("If checked, Metashape will calculate vertex colors for the mesh. This is useful for visualization but does not affect standard 2D exports. Defaults to false to save time.")
         self.checkBoxVertexColors.setChecked(False)
 
+        # set processing mode - map-only modes skip the 3D mesh and build the DEM directly as a height field
+        self.processingModes = [
+            ("Full 3D Model", "full"),
+            ("2.5D Map Only (DEM from Depth Maps)", "2.5d_depth_maps"),
+            ("2.5D Map Only (DEM from Point Cloud)", "2.5d_point_cloud"),
+            ("Field Preview", "preview")
+        ]
+        self.labelProcessingMode = QtWidgets.QLabel("Processing Mode:")
+        self.comboProcessingMode = QtWidgets.QComboBox()
+        for processing_mode in self.processingModes:
+            self.comboProcessingMode.addItem(processing_mode[0])
+        self.comboProcessingMode.setToolTip("Full 3D Model builds a mesh from depth maps and uses it to create the DEM and orthomosaic."
+                                            "\n\n2.5D Map Only skips the mesh and builds the DEM straight from depth maps (or a point cloud), which is much faster "
+                                            "when only the orthomosaic and DEM are needed. The 3D surface area tool requires a mesh and cannot be used on 2.5D chunks."
+                                            "\n\nField Preview quickly makes a low-resolution orthomosaic, DEM and coverage map from a subset of the photos in a separate "
+                                            "'preview' folder, without changing the chunk, to check in the field whether a plot was captured well.")
+        self.labelPreviewStep = QtWidgets.QLabel("Preview Uses Every Nth Photo: ")
+        self.spinboxPreviewStep = QtWidgets.QSpinBox()
+        self.spinboxPreviewStep.setMinimum(1)
+        self.spinboxPreviewStep.setMaximum(20)
+        self.spinboxPreviewStep.setValue(3)
+
+        # redundant view pruning for dense processing
+        self.checkBoxPruneCameras = QtWidgets.QCheckBox("Prune Redundant Cameras")
+        self.checkBoxPruneCameras.setToolTip("If checked, cameras that are not needed to see every part of the plot the minimum number of times are "
+                                             "disabled while depth maps and the mesh are built, which can cut dense processing time considerably for high-overlap surveys."
+                                             "\n\nAll cameras are re-enabled afterwards.")
+        self.checkBoxPruneCameras.setChecked(False)
+        self.labelMinViews = QtWidgets.QLabel("Min Views: ")
+        self.spinboxMinViews = QtWidgets.QSpinBox()
+        self.spinboxMinViews.setMinimum(2)
+        self.spinboxMinViews.setMaximum(20)
+        self.spinboxMinViews.setValue(5)
+        self.spinboxMinViews.setToolTip("Minimum number of cameras that must still see each part of the plot after pruning")
+        self.checkBoxOrthoAllCameras = QtWidgets.QCheckBox("Use All Cameras for Orthomosaic")
+        self.checkBoxOrthoAllCameras.setToolTip("If checked, pruned cameras are re-enabled before the orthomosaic is built so they are available for blending")
+        self.checkBoxOrthoAllCameras.setChecked(True)
+
+        # coverage check before dense processing
+        self.checkBoxCoverage = QtWidgets.QCheckBox("Check Coverage Before Dense Processing")
+        self.checkBoxCoverage.setToolTip("If checked, the plot is checked for areas seen by too few cameras right after alignment and referencing, "
+                                         "and a coverage map is written to the output folder. This takes seconds and can reveal gaps before hours of processing.")
+        self.checkBoxCoverage.setChecked(True)
+        self.labelCoverageViews = QtWidgets.QLabel("Min Coverage Views: ")
+        self.spinboxCoverageViews = QtWidgets.QSpinBox()
+        self.spinboxCoverageViews.setMinimum(1)
+        self.spinboxCoverageViews.setMaximum(20)
+        self.spinboxCoverageViews.setValue(3)
+        self.checkBoxStopOnGaps = QtWidgets.QCheckBox("Stop if Gaps Found")
+        self.checkBoxStopOnGaps.setToolTip("If checked, the script stops before building depth maps when more than 1% of the plot is seen by too few cameras. "
+                                           "Otherwise the gaps are only reported and recorded in the chunk metadata.")
+        self.checkBoxStopOnGaps.setChecked(False)
+
         # directory input for exports
         self.labelOutputDir = QtWidgets.QLabel("Folder for outputs: ")
         self.btnOutputDir = QtWidgets.QPushButton("Select Folder")
@@ -122,6 +186,12 @@ class FullWorkflowDlg(QtWidgets.QDialog):
         self.checkBoxReport = QtWidgets.QCheckBox("Generate Processing Report")
         self.checkBoxReport.setChecked(True)
         self.checkBoxReport.setToolTip("If this option is checked, a processing report for the currently-selected chunk will be generated")
+
+        # quick-look previews
+        self.checkBoxQuickLook = QtWidgets.QCheckBox("Quick-Look Previews")
+        self.checkBoxQuickLook.setChecked(True)
+        self.checkBoxQuickLook.setToolTip("If this option is checked, a small orthomosaic JPEG, a hillshaded DEM and a map of the cameras and markers "
+                                          "are written to a quicklook folder before the full resolution products are exported, so the plot can be reviewed straight away")
         
         # standard outputs for gis
         self.checkBoxExport = QtWidgets.QCheckBox("Export Uncropped GIS Outputs")
@@ -136,6 +206,67 @@ class FullWorkflowDlg(QtWidgets.QDialog):
                                        "\n\nIf this option is checked, a second set of outputs will be created for TagLab analysis that are cropped to the boundary polygon and broken into blocks if needed")
         self.checkBoxTagLab.setChecked(True)
 
+        # tiled taglab outputs
+        self.checkBoxTagLabTiles = QtWidgets.QCheckBox("Tiled TagLab Outputs")
+        self.checkBoxTagLabTiles.setToolTip("If checked, the TagLab orthomosaic and DEM are exported as overlapping square tiles instead of blocks split at the TIFF size limit, "
+                                            "with a GeoJSON index of the tiles (<plot>_tiles.geojson)."
+                                            "\n\nTiles are laid on a grid anchored to the coordinate system origin, so the same tile covers the same pixels in every timepoint of a plot. "
+                                            "Use a custom resolution so all timepoints share the same pixel size.")
+        self.checkBoxTagLabTiles.setChecked(False)
+        self.labelTileSize = QtWidgets.QLabel("Tile Size (px): ")
+        self.spinboxTileSize = QtWidgets.QSpinBox()
+        self.spinboxTileSize.setMinimum(512)
+        self.spinboxTileSize.setMaximum(32512)
+        self.spinboxTileSize.setSingleStep(512)
+        self.spinboxTileSize.setValue(4096)
+        self.labelTileOverlap = QtWidgets.QLabel("Overlap (px): ")
+        self.spinboxTileOverlap = QtWidgets.QSpinBox()
+        self.spinboxTileOverlap.setMinimum(0)
+        self.spinboxTileOverlap.setMaximum(4096)
+        self.spinboxTileOverlap.setSingleStep(64)
+        self.spinboxTileOverlap.setValue(256)
+        self.spinboxTileOverlap.setToolTip("Number of pixels shared by neighbouring tiles, so objects on a tile edge appear whole in at least one tile")
+
+        # boundary-windowed outputs
+        self.checkBoxWindowExports = QtWidgets.QCheckBox("Window Outputs to Boundary")
+        self.checkBoxWindowExports.setToolTip("If checked, the GIS and TagLab orthomosaic and DEM cover only the bounding box of the boundary polygon plus a margin, "
+                                              "with everything outside the boundary set to nodata, instead of the whole reconstruction."
+                                              "\n\nThe window is snapped to whole pixels from the coordinate system origin, so every timepoint of a plot "
+                                              "exported at the same resolution has exactly the same extent. Has no effect if the chunk has no boundary.")
+        self.checkBoxWindowExports.setChecked(False)
+        self.labelWindowMargin = QtWidgets.QLabel("Margin (m): ")
+        self.spinboxWindowMargin = QtWidgets.QDoubleSpinBox()
+        self.spinboxWindowMargin.setDecimals(2)
+        self.spinboxWindowMargin.setMinimum(0)
+        self.spinboxWindowMargin.setMaximum(10)
+        self.spinboxWindowMargin.setSingleStep(0.05)
+        self.spinboxWindowMargin.setValue(0.25)
+
+        # compact dem format
+        self.demFormats = [("Float32", None), ("Int16 (0.1 mm steps)", "int16"), ("Float16", "float16")]
+        self.labelDemFormat = QtWidgets.QLabel("DEM Format: ")
+        self.comboDemFormat = QtWidgets.QComboBox()
+        self.comboDemFormat.addItems([label for label, mode in self.demFormats])
+        self.comboDemFormat.setToolTip("Float32 keeps full precision. Int16 stores elevations in 0.1 mm steps with a scale and offset in the file, "
+                                       "and Float16 stores them as half precision floats relative to an offset; both roughly halve the size of the DEMs."
+                                       "\n\nSoftware that ignores the scale and offset metadata will show raw values for compact DEMs. Requires GDAL.")
+
+        # cloud-optimized geotiffs
+        self.checkBoxCOG = QtWidgets.QCheckBox("Cloud-Optimized GeoTIFFs")
+        self.checkBoxCOG.setToolTip("If checked, the uncropped GIS orthomosaic and DEM are converted to Cloud-Optimized GeoTIFFs (512 px internal tiles, "
+                                    "ordered overviews, floating point predictor for the DEM) so viewers can read just the area they need over a network."
+                                    "\n\nRequires GDAL to be installed in Metashape's Python.")
+        self.checkBoxCOG.setChecked(False)
+
+        # number of exports run at the same time
+        self.labelConcurrentExports = QtWidgets.QLabel("Concurrent Exports: ")
+        self.spinboxConcurrentExports = QtWidgets.QSpinBox()
+        self.spinboxConcurrentExports.setMinimum(1)
+        self.spinboxConcurrentExports.setMaximum(8)
+        self.spinboxConcurrentExports.setValue(2)
+        self.spinboxConcurrentExports.setToolTip("Number of raster exports run at the same time, each in a separate background Metashape process. "
+                                                 "Exporting is mostly compression and disk writing, so 2-4 is usually fastest; set to 1 to export one at a time in this session.")
+
         # run script button
         self.btnOk = QtWidgets.QPushButton("Ok")
         self.btnOk.setFixedSize(90, 50)
@@ -161,6 +292,11 @@ class FullWorkflowDlg(QtWidgets.QDialog):
         crs_layout = QtWidgets.QHBoxLayout()
         crs_layout.addWidget(self.labelCRS)
         crs_layout.addWidget(self.comboCRS)
+        crs_layout.addStretch()
+        crs_layout.addWidget(self.labelProcessingMode)
+        crs_layout.addWidget(self.comboProcessingMode)
+        crs_layout.addWidget(self.labelPreviewStep)
+        crs_layout.addWidget(self.spinboxPreviewStep)
         
         checkbox_layout = QtWidgets.QHBoxLayout()
 
@@ -176,6 +312,20 @@ class FullWorkflowDlg(QtWidgets.QDialog):
         resolution_layout.addWidget(self.spinboxCustomRes)
         # checkbox_layout.addWidget(self.checkBoxTagLab)
 
+        prune_layout = QtWidgets.QHBoxLayout()
+        prune_layout.addWidget(self.checkBoxPruneCameras)
+        prune_layout.addWidget(self.labelMinViews)
+        prune_layout.addWidget(self.spinboxMinViews)
+        prune_layout.addStretch()
+        prune_layout.addWidget(self.checkBoxOrthoAllCameras)
+
+        coverage_layout = QtWidgets.QHBoxLayout()
+        coverage_layout.addWidget(self.checkBoxCoverage)
+        coverage_layout.addWidget(self.labelCoverageViews)
+        coverage_layout.addWidget(self.spinboxCoverageViews)
+        coverage_layout.addStretch()
+        coverage_layout.addWidget(self.checkBoxStopOnGaps)
+
         output_layout = QtWidgets.QHBoxLayout()
         output_layout.addWidget(self.labelOutputDir)
         output_layout.addWidget(self.txtOutputDir)
@@ -183,8 +333,28 @@ class FullWorkflowDlg(QtWidgets.QDialog):
 
         export_layout = QtWidgets.QHBoxLayout()
         export_layout.addWidget(self.checkBoxReport)
+        export_layout.addWidget(self.checkBoxQuickLook)
         export_layout.addWidget(self.checkBoxExport)
         export_layout.addWidget(self.checkBoxTagLab)
+        export_layout.addWidget(self.checkBoxCOG)
+        export_layout.addWidget(self.labelConcurrentExports)
+        export_layout.addWidget(self.spinboxConcurrentExports)
+
+        tile_layout = QtWidgets.QHBoxLayout()
+        tile_layout.addWidget(self.checkBoxTagLabTiles)
+        tile_layout.addStretch()
+        tile_layout.addWidget(self.labelTileSize)
+        tile_layout.addWidget(self.spinboxTileSize)
+        tile_layout.addWidget(self.labelTileOverlap)
+        tile_layout.addWidget(self.spinboxTileOverlap)
+
+        window_layout = QtWidgets.QHBoxLayout()
+        window_layout.addWidget(self.checkBoxWindowExports)
+        window_layout.addStretch()
+        window_layout.addWidget(self.labelDemFormat)
+        window_layout.addWidget(self.comboDemFormat)
+        window_layout.addWidget(self.labelWindowMargin)
+        window_layout.addWidget(self.spinboxWindowMargin)
 
         ok_layout = QtWidgets.QHBoxLayout()
         ok_layout.addWidget(self.btnOk)
@@ -197,8 +367,12 @@ class FullWorkflowDlg(QtWidgets.QDialog):
         general_layout.addLayout(crs_layout)
         general_layout.addLayout(checkbox_layout)
         general_layout.addLayout(resolution_layout)
+        general_layout.addLayout(prune_layout)
+        general_layout.addLayout(coverage_layout)
         general_layout.addLayout(output_layout)
         general_layout.addLayout(export_layout)
+        general_layout.addLayout(window_layout)
+        general_layout.addLayout(tile_layout)
         general_groupbox.setLayout(general_layout)
 
 
@@ -231,26 +405,31 @@ class FullWorkflowDlg(QtWidgets.QDialog):
         self.setLayout(scroll_layout) # set wrapper layout for scroll area as main dialog layout
 
         # adjust size and position of main widget
-        self.setMinimumSize(main_widget.frameGeometry().width(), 0.6*parent.frameGeometry().height())
-        # determining the actual width needed to display the widget without cutting it off or leaving extra space is
-        # surprisingly difficult because of the padding and margin space between nested widgets - this workaround was found by trial and error
-        width = (scroll_area.frameGeometry().width() + main_widget.frameGeometry().width()) / 2
-        x = parent.frameGeometry().width()/2.0 - width/2 # set starting position so that widget is roughly centered on screen
-        if(x<0): x = 0
-        y = parent.frameGeometry().height()/2.0 - 0.4*parent.frameGeometry().height()
-        self.setGeometry(parent.frameGeometry().x() + x, parent.frameGeometry().y() + y, width, 0.85*parent.frameGeometry().height())
+        if(parent is not None):
+            self.setMinimumSize(main_widget.frameGeometry().width(), 0.6*parent.frameGeometry().height())
+            # determining the actual width needed to display the widget without cutting it off or leaving extra space is
+            # surprisingly difficult because of the padding and margin space between nested widgets - this workaround was found by trial and error
+            width = (scroll_area.frameGeometry().width() + main_widget.frameGeometry().width()) / 2
+            x = parent.frameGeometry().width()/2.0 - width/2 # set starting position so that widget is roughly centered on screen
+            if(x<0): x = 0
+            y = parent.frameGeometry().height()/2.0 - 0.4*parent.frameGeometry().height()
+            self.setGeometry(parent.frameGeometry().x() + x, parent.frameGeometry().y() + y, width, 0.85*parent.frameGeometry().height())
 
         # --- Connect signals and slots ---
         # these two syntaxes for connecting signals to slots should be equivalent, but the first method (dot notation) may make it easier
         # to use widget-specific signals (such as currentIndexChanged) instead of core signals
         self.checkBoxDefaultRes.stateChanged.connect(self.onResolutionChange)
+        self.comboProcessingMode.currentIndexChanged.connect(self.onProcessingModeChange)
+        self.checkBoxPruneCameras.stateChanged.connect(self.onPruneCamerasChange)
+        self.checkBoxCoverage.stateChanged.connect(self.onCoverageChange)
         self.btnOutputDir.clicked.connect(self.getOutputDir)
         #self.btnCRS.clicked.connect(self.getCRS)
 
         QtCore.QObject.connect(self.btnOk, QtCore.SIGNAL("clicked()"), self.runWorkFlow)
         QtCore.QObject.connect(self.btnQuit, QtCore.SIGNAL("clicked()"), self, QtCore.SLOT("reject()"))
         self.loadSettings()
-        self.exec()
+        if(not self.unattended):
+            self.exec()
         
     def loadSettings(self):
         """Load saved settings using QSettings."""
@@ -262,6 +441,26 @@ class FullWorkflowDlg(QtWidgets.QDialog):
         self.checkBoxTagLab.setChecked(self.settings.value("checkBoxTagLab", False, type=bool))
         self.checkBoxReport.setChecked(self.settings.value("checkBoxExportReport", True, type=bool))
         self.checkBoxVertexColors.setChecked(self.settings.value("checkBoxVertexColors", False, type=bool))
+        self.checkBoxCOG.setChecked(self.settings.value("checkBoxCOG", False, type=bool))
+        self.spinboxConcurrentExports.setValue(self.settings.value("spinboxConcurrentExports", 2, type=int))
+        self.checkBoxTagLabTiles.setChecked(self.settings.value("checkBoxTagLabTiles", False, type=bool))
+        self.spinboxTileSize.setValue(self.settings.value("spinboxTileSize", 4096, type=int))
+        self.spinboxTileOverlap.setValue(self.settings.value("spinboxTileOverlap", 256, type=int))
+        self.checkBoxWindowExports.setChecked(self.settings.value("checkBoxWindowExports", False, type=bool))
+        self.checkBoxQuickLook.setChecked(self.settings.value("checkBoxQuickLook", True, type=bool))
+        self.comboDemFormat.setCurrentIndex(self.settings.value("comboDemFormat", 0, type=int))
+        self.spinboxWindowMargin.setValue(self.settings.value("spinboxWindowMargin", 0.25, type=float))
+        self.comboProcessingMode.setCurrentIndex(self.settings.value("comboProcessingMode", 0, type=int))
+        self.spinboxPreviewStep.setValue(self.settings.value("spinboxPreviewStep", 3, type=int))
+        self.onProcessingModeChange()
+        self.checkBoxPruneCameras.setChecked(self.settings.value("checkBoxPruneCameras", False, type=bool))
+        self.spinboxMinViews.setValue(self.settings.value("spinboxMinViews", 5, type=int))
+        self.checkBoxOrthoAllCameras.setChecked(self.settings.value("checkBoxOrthoAllCameras", True, type=bool))
+        self.onPruneCamerasChange()
+        self.checkBoxCoverage.setChecked(self.settings.value("checkBoxCoverage", True, type=bool))
+        self.spinboxCoverageViews.setValue(self.settings.value("spinboxCoverageViews", 3, type=int))
+        self.checkBoxStopOnGaps.setChecked(self.settings.value("checkBoxStopOnGaps", False, type=bool))
+        self.onCoverageChange()
         crs_wkt = self.settings.value("coordinate_system", None, type=str)
         if crs_wkt:
             self.chunk.crs = Metashape.CoordinateSystem(crs_wkt)
@@ -276,6 +475,23 @@ class FullWorkflowDlg(QtWidgets.QDialog):
         self.settings.setValue("checkBoxTagLab", self.checkBoxTagLab.isChecked())
         self.settings.setValue("checkBoxExportReport", self.checkBoxReport.isChecked())
         self.settings.setValue("checkBoxVertexColors", self.checkBoxVertexColors.isChecked())
+        self.settings.setValue("checkBoxCOG", self.checkBoxCOG.isChecked())
+        self.settings.setValue("spinboxConcurrentExports", self.spinboxConcurrentExports.value())
+        self.settings.setValue("checkBoxTagLabTiles", self.checkBoxTagLabTiles.isChecked())
+        self.settings.setValue("spinboxTileSize", self.spinboxTileSize.value())
+        self.settings.setValue("spinboxTileOverlap", self.spinboxTileOverlap.value())
+        self.settings.setValue("checkBoxWindowExports", self.checkBoxWindowExports.isChecked())
+        self.settings.setValue("checkBoxQuickLook", self.checkBoxQuickLook.isChecked())
+        self.settings.setValue("comboDemFormat", self.comboDemFormat.currentIndex())
+        self.settings.setValue("spinboxWindowMargin", self.spinboxWindowMargin.value())
+        self.settings.setValue("comboProcessingMode", self.comboProcessingMode.currentIndex())
+        self.settings.setValue("spinboxPreviewStep", self.spinboxPreviewStep.value())
+        self.settings.setValue("checkBoxPruneCameras", self.checkBoxPruneCameras.isChecked())
+        self.settings.setValue("spinboxMinViews", self.spinboxMinViews.value())
+        self.settings.setValue("checkBoxOrthoAllCameras", self.checkBoxOrthoAllCameras.isChecked())
+        self.settings.setValue("checkBoxCoverage", self.checkBoxCoverage.isChecked())
+        self.settings.setValue("spinboxCoverageViews", self.spinboxCoverageViews.value())
+        self.settings.setValue("checkBoxStopOnGaps", self.checkBoxStopOnGaps.isChecked())
         selected_label = self.comboCRS.currentText()
         self.settings.setValue("coordinate_system", self.crs_options[selected_label].wkt)
     
@@ -301,8 +517,8 @@ class FullWorkflowDlg(QtWidgets.QDialog):
         selected_crs = self.crs_options[selected_crs_label]
         self.chunk.crs = selected_crs
         ###### 0. Setting Parameters ######
-        if(not self.georef_groupbox.autoDetectMarkers and self.chunk.model == None):
-            Metashape.app.messageBox("You have initiated the script without specifying georeferencing information. If you ran the align timepoints script first, "
+        if(not self.georef_groupbox.autoDetectMarkers and self.chunk.model == None and self.processingModes[self.comboProcessingMode.currentIndex()][1] != "preview"):
+            self.notify("You have initiated the script without specifying georeferencing information. If you ran the align timepoints script first, "
                                     "clicking OK will simply complete the workflow in its entirety for you (no further action needed). \n\n If this is a new project "
                                     "without auto-detectable markers, the script will exit after creating a mesh to allow for manual referencing, leveling, "
                                     "and scaling. \n\n Once this information is added, run the script again to complete the remainder of the workflow.")
@@ -311,6 +527,13 @@ class FullWorkflowDlg(QtWidgets.QDialog):
         ALIGN_QUALITY = 1 # quality setting for camera alignment; corresponds to high accuracy in GUI
         DM_QUALITY = 2 ** self.comboMeshQuality.currentIndex() # quality setting for depth maps; corresponds to medium in GUI
         INTERPOLATION = Metashape.DisabledInterpolation # interpolation setting for DEM creation
+        COVERAGE_GAP_LIMIT = 0.01 # fraction of the plot that may be under-covered before the script stops (if enabled)
+        # task settings (neighbours, work item sizes) - uses this computer's tuned profile if one has been benchmarked
+        task_settings = load_processing_settings()
+        match_settings = task_settings["match_photos"]
+        dm_settings = task_settings["depth_maps"]
+        dem_settings = task_settings["build_dem"]
+        ortho_settings = task_settings["build_orthomosaic"]
 
         # set arguments from dialog box
         try:
@@ -318,7 +541,7 @@ class FullWorkflowDlg(QtWidgets.QDialog):
                 scalebars_path = self.georef_groupbox.scalebars_path
                 georef_path = self.georef_groupbox.georef_path
         except:
-            Metashape.app.messageBox("No files selected. If you would like to automatically detect markers, please select files containing scaling and georeferencing information")
+            self.notify("No files selected. If you would like to automatically detect markers, please select files containing scaling and georeferencing information")
             print("Script aborted")
             self.setEnabled(True)
             return
@@ -333,6 +556,16 @@ class FullWorkflowDlg(QtWidgets.QDialog):
 
         DEM_RES = 0 # allow metashape to choose dem resolution by default, since we arent exporting for taglab
 
+        # map-only modes skip the mesh entirely and use the DEM as a height field surface for the orthomosaic
+        processing_mode = self.processingModes[self.comboProcessingMode.currentIndex()][1]
+        map_only = processing_mode != "full"
+        if(processing_mode == "2.5d_depth_maps"):
+            DEM_SOURCE = Metashape.DepthMapsData
+        elif(processing_mode == "2.5d_point_cloud"):
+            DEM_SOURCE = Metashape.PointCloudData
+        else:
+            DEM_SOURCE = Metashape.ModelData
+
         target_type = self.georef_groupbox.target_type
 
         ref_formatting = [self.georef_groupbox.spinboxRefLabel.value(), self.georef_groupbox.spinboxRefX.value(),
@@ -340,6 +573,15 @@ class FullWorkflowDlg(QtWidgets.QDialog):
                             self.georef_groupbox.spinboxXAcc.value(), self.georef_groupbox.spinboxYAcc.value(),
                             self.georef_groupbox.spinboxZAcc.value(), self.georef_groupbox.spinboxSkipRows.value()]
         self.corner_markers = self.georef_groupbox.corner_markers
+
+        # the field preview works on a temporary copy of the chunk and never touches the full-resolution state
+        if(processing_mode == "preview"):
+            if(self.georef_groupbox.autoDetectMarkers):
+                self.runPreview(self.spinboxPreviewStep.value(), target_type, georef_path, scalebars_path, ref_formatting)
+            else:
+                self.runPreview(self.spinboxPreviewStep.value())
+            return
+
         if(self.chunk.tie_points and not self.chunk.meta['init_tie_points']):
             self.chunk.meta['init_tie_points'] = str(len(self.chunk.tie_points.points))
         
@@ -350,7 +592,8 @@ class FullWorkflowDlg(QtWidgets.QDialog):
             self.chunk.matchPhotos(downscale = ALIGN_QUALITY, keypoint_limit_per_mpx = 300, generic_preselection = generic_preselect,
                               reference_preselection=True, filter_mask=False, mask_tiepoints=True,
                               filter_stationary_points=True, keypoint_limit=40000, tiepoint_limit=4000, keep_keypoints=True, guided_matching=False,
-                              reset_matches=False, subdivide_task=True, workitem_size_cameras=20, workitem_size_pairs=80, max_workgroup_size=100)
+                              reset_matches=False, subdivide_task=True, workitem_size_cameras=match_settings["workitem_size_cameras"],
+                              workitem_size_pairs=match_settings["workitem_size_pairs"], max_workgroup_size=match_settings["max_workgroup_size"])
             self.chunk.alignCameras(adaptive_fitting = True, min_image=2, reset_alignment=True, subdivide_task=True)
             #second alignment step sometimes adds extra photos to the alignment that were missed on the first pass
             self.chunk.alignCameras(adaptive_fitting = True, min_image=2, reset_alignment=False, subdivide_task=True)
@@ -372,7 +615,8 @@ class FullWorkflowDlg(QtWidgets.QDialog):
             self.chunk.matchPhotos(downscale = ALIGN_QUALITY, keypoint_limit_per_mpx = 300, generic_preselection = False,
                               reference_preselection=True, filter_mask=False, mask_tiepoints=True,
                               filter_stationary_points=True, keypoint_limit=40000, tiepoint_limit=4000, keep_keypoints=True, guided_matching=False,
-                              reset_matches=False, subdivide_task=True, workitem_size_cameras=20, workitem_size_pairs=80, max_workgroup_size=100)
+                              reset_matches=False, subdivide_task=True, workitem_size_cameras=match_settings["workitem_size_cameras"],
+                              workitem_size_pairs=match_settings["workitem_size_pairs"], max_workgroup_size=match_settings["max_workgroup_size"])
             self.chunk.alignCameras(adaptive_fitting = True, min_image=2, reset_alignment=False, subdivide_task=True)
 
             print(" --- Cameras are aligned and sparse point cloud generated --- ")
@@ -383,9 +627,19 @@ class FullWorkflowDlg(QtWidgets.QDialog):
             self.chunk.detectMarkers(target_type = target_type, tolerance=20, filter_mask=False, inverted=False, noparity=False, maximum_residual=5, minimum_size=0, minimum_dist=5)
             print(" --- Markers Detected --- ")
 
+        # markers referenced from an earlier time point are checked for movement or damage once the cameras are aligned
+        if(self.chunk.meta['timeseries_reference'] and not self.chunk.meta['marker_check']):
+            check_marker_residuals(self.chunk, self.output_dir)
+            self.updateAndSave()
+
         # c. scale model
         if(len(self.chunk.scalebars) == 0 and self.georef_groupbox.autoDetectMarkers): # creates scalebars only if there are none already
-            ref_except = self.referenceModel(georef_path, ref_formatting)
+            # a time point aligned to a reference time point keeps the transferred marker reference - its own georeferencing
+            # file is only used to georeference it roughly when it is waiting to be co-registered from its DEM
+            if(self.chunk.meta['timeseries_reference'] and self.chunk.meta['coregistration'] != "pending"):
+                ref_except = ""
+            else:
+                ref_except = self.referenceModel(georef_path, ref_formatting)
             scale_except = ""
             if(not ref_except):
                 scale_except = self.createScalebars(scalebars_path)
@@ -398,14 +652,20 @@ class FullWorkflowDlg(QtWidgets.QDialog):
                 if(ref_except):
                     print(ref_except)
                     error = error + ref_except
-                Metashape.app.messageBox("Unable to scale and reference model:\n" + error + "Check that the files are formatted correctly and try again, or add markers and scalebars through the Metashape GUI.")
+                self.notify("Unable to scale and reference model:\n" + error + "Check that the files are formatted correctly and try again, or add markers and scalebars through the Metashape GUI.")
                 self.reject()
                 return
             else:
                 self.chunk.updateTransform()
 
 
-        if(self.chunk.model == None):
+        # in map-only modes there is never a model, so the DEM is used to check whether the dense stage is done
+        if(map_only):
+            dense_products_missing = self.chunk.elevation == None
+        else:
+            dense_products_missing = self.chunk.model == None
+
+        if(dense_products_missing):
             # d. optimize camera alignment - only optimize if there isn't already a model, and if the current
             # number of tie points is not less than the inital number - prevents optimizing twice
             if(not len(self.chunk.tie_points.points) < int(self.chunk.meta['init_tie_points'])):
@@ -418,57 +678,124 @@ class FullWorkflowDlg(QtWidgets.QDialog):
             # reset reconstruction region to make sure the mesh gets built for the full plot
             self.chunk.resetRegion()
             self.updateAndSave()
-            # try 'task' syntax to enable hidden preferences (ie pm_enable) to be changed
-            task = Metashape.Tasks.BuildDepthMaps()
-            task.downscale = DM_QUALITY
-            task.filter_mode = Metashape.FilterMode.MildFiltering
-            task.reuse_depth = True
-            task.max_neighbors = 16
-            task.subdivide_task = True
-            task.workitem_size_cameras = 20
-            task.max_workgroup_size = 100
-            task["pm_enable"] = "1"
-            task.apply(self.chunk)
-            self.updateAndSave()
-            
-            self.chunk.buildModel(
-                surface_type = Metashape.Arbitrary, 
-                interpolation = Metashape.EnabledInterpolation, 
-                face_count=Metashape.HighFaceCount,
-                face_count_custom = 1000000, 
-                source_data = Metashape.DepthMapsData, 
-                keep_depth = True,
-                vertex_colors=False
-            )
-            print(" --- Mesh Generated --- ")
-            self.updateAndSave()
-            
-            if self.checkBoxVertexColors.isChecked():
-                self.chunk.colorizeModel()
+            # check for gaps in camera coverage before committing to depth maps and mesh
+            if(self.checkBoxCoverage.isChecked() and not self.chunk.meta['pruned_cameras']):
+                gap_fraction = self.checkCoverage(self.spinboxCoverageViews.value())
+                if(gap_fraction > COVERAGE_GAP_LIMIT and self.checkBoxStopOnGaps.isChecked()):
+                    print("Exiting script due to gaps in camera coverage")
+                    self.notify("{:.1f}% of the plot is seen by fewer than {} cameras. A coverage map has been saved to the output folder.\n\n"
+                                             "Check the map for missed areas before processing. To process anyway, uncheck \"Stop if Gaps Found\" and run the script again."
+                                             .format(100 * gap_fraction, self.spinboxCoverageViews.value()))
+                    self.setEnabled(True)
+                    return
+
+            # disable surplus cameras for the dense stage only - skipped if a previous run already pruned them
+            if(self.checkBoxPruneCameras.isChecked() and not self.chunk.meta['pruned_cameras']):
+                self.pruneRedundantCameras(self.spinboxMinViews.value())
+
+            # depth maps are kept from an earlier map-only run that stopped for manual referencing
+            if(not map_only or self.chunk.depth_maps == None):
+                # try 'task' syntax to enable hidden preferences (ie pm_enable) to be changed
+                task = Metashape.Tasks.BuildDepthMaps()
+                task.downscale = DM_QUALITY
+                task.filter_mode = Metashape.FilterMode.MildFiltering
+                task.reuse_depth = True
+                task.max_neighbors = dm_settings["max_neighbors"]
+                task.subdivide_task = True
+                task.workitem_size_cameras = dm_settings["workitem_size_cameras"]
+                task.max_workgroup_size = dm_settings["max_workgroup_size"]
+                task["pm_enable"] = "1" if dm_settings["pm_enable"] else "0"
+                task.apply(self.chunk)
+                self.updateAndSave()
+
+            if(processing_mode == "2.5d_point_cloud"):
+                if(self.chunk.point_cloud == None):
+                    self.chunk.buildPointCloud(source_data = Metashape.DepthMapsData, point_colors = False, point_confidence = True,
+                                               keep_depth = True, subdivide_task = True, workitem_size_cameras = dm_settings["workitem_size_cameras"],
+                                               max_workgroup_size = dm_settings["max_workgroup_size"])
+                    print(" --- Point Cloud Generated --- ")
+                    self.updateAndSave()
+            elif(not map_only):
+                self.chunk.buildModel(
+                    surface_type = Metashape.Arbitrary, 
+                    interpolation = Metashape.EnabledInterpolation, 
+                    face_count=Metashape.HighFaceCount,
+                    face_count_custom = 1000000, 
+                    source_data = Metashape.DepthMapsData, 
+                    keep_depth = True,
+                    vertex_colors=False
+                )
+                print(" --- Mesh Generated --- ")
                 self.updateAndSave()
                 
+                if self.checkBoxVertexColors.isChecked():
+                    self.chunk.colorizeModel()
+                    self.updateAndSave()
+                
         # if not using automatic referencing, exit script after mesh creation
         if(not self.autoDetectMarkers and len(self.chunk.markers) == 0):
             print("Exiting script for manual referencing")
-            Metashape.app.messageBox("Image alignment and mesh building complete.\n\nNow, add referencing information, then re-run the full dialog script to complete processing.")
+            self.restorePrunedCameras()
+            if(map_only):
+                self.notify("Image alignment and depth map building complete.\n\nNow, add referencing information, then re-run the full dialog script to complete processing.")
+            else:
+                self.notify("Image alignment and mesh building complete.\n\nNow, add referencing information, then re-run the full dialog script to complete processing.")
             self.close()
             return
 
         # b. build orthomosaic and DEM
         
+        dem_params = dict(source_data = DEM_SOURCE, interpolation = Metashape.EnabledInterpolation, flip_x=False, flip_y=False, flip_z=False,
+                          resolution=ORTHO_RES, subdivide_task=True, workitem_size_tiles=dem_settings["workitem_size_tiles"], max_workgroup_size=dem_settings["max_workgroup_size"])
         if(self.chunk.elevation == None):
-            self.chunk.buildDem(source_data = Metashape.ModelData, interpolation = Metashape.EnabledInterpolation, flip_x=False, flip_y=False, flip_z=False,
-                           resolution=ORTHO_RES, subdivide_task=True, workitem_size_tiles=10, max_workgroup_size=100)
+            self.chunk.buildDem(**dem_params)
+            # record which path produced the products so later tools (e.g. surface area ratio) can tell a 2.5D chunk from a full 3D one
+            self.chunk.meta['processing_mode'] = processing_mode
+            self.chunk.meta['dem_source'] = str(DEM_SOURCE).split(".")[-1]
             print(" --- Hi-Res DEM Built --- ")
+
+        # a time point with too few markers matched to its reference time point is co-registered to the reference DEM instead,
+        # which replaces its DEM, so the DEM is built again with the corrected georeferencing
+        if(self.chunk.meta['coregistration'] == "pending"):
+            try:
+                reference_chunk = reference_chunk_of(self.doc, self.chunk)
+                if(reference_chunk is None):
+                    raise Exception("reference chunk " + self.chunk.meta['timeseries_reference'] + " not found")
+                coregister_chunk(reference_chunk, self.chunk)
+            except Exception as e:
+                self.restorePrunedCameras()
+                self.notify("Unable to co-register " + self.chunk.label + " to its reference time point:\n" + str(e))
+                self.setEnabled(True)
+                return
+            self.updateAndSave()
+            self.chunk.buildDem(**dem_params)
+            print(" --- Hi-Res DEM Rebuilt After Co-registration --- ")
+
+        # time points aligned to a reference are checked against it once, now the DEM can be compared too - the check is
+        # marked as done even if the DEMs could not be compared, so later runs do not add more rows to the QA table
+        if(self.chunk.meta['timeseries_reference'] and not self.chunk.meta['qa_dem_checked']):
+            try:
+                record_alignment_qa(self.chunk, self.output_dir, reference_chunk_of(self.doc, self.chunk))
+            except Exception as e:
+                print("Unable to record the alignment QA: " + str(e))
+            self.chunk.meta['qa_dem_checked'] = self.chunk.meta['qa_time'] or "failed"
+            self.updateAndSave()
             
             
+        if(self.checkBoxOrthoAllCameras.isChecked()):
+            self.restorePrunedCameras()
+
         if(self.chunk.orthomosaic == None):
             self.chunk.buildOrthomosaic(resolution = ORTHO_RES, surface_data=Metashape.ElevationData, blending_mode=Metashape.MosaicBlending, fill_holes=True, ghosting_filter=False,
                                    cull_faces=False, refine_seamlines=False, flip_x=False, flip_y=False, flip_z=False, subdivide_task=True,
-                                   workitem_size_cameras=20, workitem_size_tiles=10, max_workgroup_size=100)
+                                   workitem_size_cameras=ortho_settings["workitem_size_cameras"], workitem_size_tiles=ortho_settings["workitem_size_tiles"],
+                                   max_workgroup_size=ortho_settings["max_workgroup_size"])
+            self.chunk.meta['ortho_surface'] = "ElevationData"
             print(" --- Orthomosaic Built --- ")
 
             self.updateAndSave()
+
+        self.restorePrunedCameras()
             
 #        if self.chunk.elevation:
 #            # Delete the DEM and then rebuild at normal resolution
@@ -485,19 +812,84 @@ class FullWorkflowDlg(QtWidgets.QDialog):
 
         ###### 3. Export products ######
 
-        # set up compression parameters
-        #first, for regular orthomosaic
-        jpg = Metashape.ImageCompression()
-        jpg.tiff_compression = Metashape.ImageCompression.TiffCompressionJPEG
-        jpg.jpeg_quality = 90
-        jpg.tiff_big = True
-        jpg.tiff_overviews = True
-        #lzw for DEM and TagLab products
-        lzw = Metashape.ImageCompression()
-        lzw.tiff_compression = Metashape.ImageCompression.TiffCompressionLZW
-        lzw.tiff_big = True
-        lzw.tiff_overviews = True
-        
+        # small previews first, so the plot can be checked while the full resolution products export
+        if(self.checkBoxQuickLook.isChecked()):
+            try:
+                self.exportQuickLooks()
+            except Exception as e:
+                print("Unable to create quick-look previews: " + str(e))
+
+        # set up compression parameters - by default JPEG for the regular orthomosaic and LZW for the DEM and TagLab products,
+        # unless the compression benchmark has recommended other codecs. Each product gets the Metashape compression
+        # to export with, and a GDAL recompression for codecs Metashape cannot write itself
+        codecs = load_compression_profile()
+        compression = {}
+        for product, codec in codecs.items():
+            metashape_compression, recompress = export_compression(codec)
+            metashape_compression.update(tiff_big = True, tiff_overviews = True)
+            compression[product] = (metashape_compression, recompress)
+        # compact DEMs are quantised to 16 bits after export, compressed with the DEM codec (or Deflate, if that is lossy)
+        dem_mode = self.demFormats[self.comboDemFormat.currentIndex()][1]
+        def quantize(codec):
+            if not dem_mode:
+                return None
+            return {"mode": dem_mode, "step": 0.0001, "compression": codec["compression"] if codec["compression"] != "JPEG" else "DEFLATE"}
+        # COG DEMs always get a predictor, which suits floating point elevations (or horizontal differencing for int16)
+        dem_cog = codecs["dem"] if codecs["dem"].get("predictor") else {"compression": "DEFLATE", "predictor": 3}
+        if dem_mode:
+            dem_cog = dict(dem_cog, predictor = 2 if dem_mode == "int16" else 3)
+        dem_cog["nodata"] = QUANTIZED_NODATA if dem_mode else DEM_NODATA
+        # remainder of parameters are defaults specified to ensure any alternate settings get overridden
+        raster_defaults = dict(save_kml=False, save_world=False, save_scheme=False, save_alpha=True, image_description='', network_links=True, global_profile=False,
+                               min_zoom_level=-1, max_zoom_level=-1, white_background=True)
+
+        # the raster exports are independent of each other, so they are collected as jobs and run side by side
+        # in separate Metashape processes (up to the concurrent export limit) while the report and shapes are exported here
+        export_jobs = []
+        # window of the boundary in each product's pixel grid, or None to export everything
+        ortho_window = self.boundaryWindow(self.chunk.orthomosaic, ORTHO_RES)
+        dem_window = self.boundaryWindow(self.chunk.elevation, DEM_RES)
+        taglab_dem_window = self.boundaryWindow(self.chunk.elevation, ORTHO_RES)
+        if(self.checkBoxExport.isChecked()):
+            # export orthomosaic and DEM in full format
+            ortho_path = self.output_dir + "/" + self.project_name + "_" + self.chunk.label + ".tif"
+            dem_path = self.output_dir + "/" + self.project_name + "_" + self.chunk.label + "_DEM.tif"
+            export_jobs.append(raster_job("Orthomosaic", ortho_path, "OrthomosaicData", compression["ortho"][0], recompress = compression["ortho"][1],
+                                          cog = codecs["ortho"] if self.checkBoxCOG.isChecked() else None, region = ortho_window,
+                                          split_in_blocks = False, clip_to_boundary = ortho_window is not None,
+                                          title = 'Orthomosaic', description = 'Generated by Agisoft Metashape with ReefShape',
+                                          **export_resolution(self.chunk.orthomosaic, ORTHO_RES, ortho_window), **raster_defaults))
+            export_jobs.append(raster_job("DEM", dem_path, "ElevationData", compression["dem"][0], recompress = compression["dem"][1],
+                                          quantize = quantize(codecs["dem"]), cog = dem_cog if self.checkBoxCOG.isChecked() else None, region = dem_window,
+                                          nodata_value = DEM_NODATA, split_in_blocks = False, clip_to_boundary = dem_window is not None,
+                                          title = 'DEM', description = 'Generated by Agisoft Metashape with ReefShape',
+                                          **export_resolution(self.chunk.elevation, DEM_RES, dem_window), **raster_defaults))
+
+        # export ortho and dem in blockwise format for Taglab
+        if(self.checkBoxTagLab.isChecked() and self.checkBoxTagLabTiles.isChecked()):
+            export_jobs.extend(self.tagLabTileJobs(ORTHO_RES, compression["taglab_ortho"], compression["taglab_dem"], quantize(codecs["taglab_dem"]), raster_defaults))
+        elif(self.checkBoxTagLab.isChecked()):
+            taglab_path = self.output_dir + "/taglab_outputs/" + self.project_name + "_" + self.chunk.label
+            export_jobs.append(raster_job("TagLab Orthomosaic", taglab_path + ".tif", "OrthomosaicData", compression["taglab_ortho"][0],
+                                          recompress = compression["taglab_ortho"][1], region = ortho_window,
+                                          block_width = 32767, block_height = 32767, split_in_blocks = True, clip_to_boundary = True,
+                                          title = 'Orthomosaic', description = 'Generated by Agisoft Metashape',
+                                          **export_resolution(self.chunk.orthomosaic, ORTHO_RES, ortho_window), **raster_defaults))
+            export_jobs.append(raster_job("TagLab DEM", taglab_path + "_DEM.tif", "ElevationData", compression["taglab_dem"][0],
+                                          recompress = compression["taglab_dem"][1], quantize = quantize(codecs["taglab_dem"]), region = taglab_dem_window,
+                                          nodata_value = DEM_NODATA, block_width = 32767, block_height = 32767, split_in_blocks = True, clip_to_boundary = True,
+                                          title = 'DEM', description = 'Generated by Agisoft Metashape',
+                                          **export_resolution(self.chunk.elevation, ORTHO_RES, taglab_dem_window), **raster_defaults))
+
+        # skip exports whose files are intact and were made from the current data with the current settings
+        export_cache = ExportCache(os.path.join(self.output_dir, EXPORT_CACHE_FILE))
+        export_jobs = export_cache.staleJobs(self.chunk, export_jobs)
+
+        # workers read the project from disk, so it must be saved first
+        self.updateAndSave()
+        scheduler = ExportScheduler(self.chunk, Metashape.app.document.path, self.spinboxConcurrentExports.value())
+        scheduler.start(export_jobs)
+
         # generate report              
         if self.checkBoxReport.isChecked():
             report_path = self.output_dir + "/" + self.project_name + "_" + self.chunk.label + ".pdf"
@@ -526,51 +918,27 @@ class FullWorkflowDlg(QtWidgets.QDialog):
                 for shape, original_type in original_boundaries:
                     shape.boundary_type = original_type
                      
-
-        # generate main orthomosaic and DEM for GIS
         if(self.checkBoxExport.isChecked()):
-            # export orthomosaic and DEM in full format
-            ortho_path = self.output_dir + "/" + self.project_name + "_" + self.chunk.label + ".tif"
-            dem_path = self.output_dir + "/" + self.project_name + "_" + self.chunk.label + "_DEM.tif"
-            if(not os.path.exists(ortho_path)):
-                self.chunk.exportRaster(path = ortho_path, resolution = ORTHO_RES,
-                                   source_data = Metashape.OrthomosaicData, split_in_blocks = False, image_compression = jpg,
-                                   save_kml=False, save_world=False, save_scheme=False, save_alpha=True, image_description='', network_links=True, global_profile=False,
-                                   min_zoom_level=-1, max_zoom_level=-1, white_background=True, clip_to_boundary=False,title='Orthomosaic', description='Generated by Agisoft Metashape with ReefShape')
-            
-            if(not os.path.exists(dem_path)):
-                self.chunk.exportRaster(path = dem_path, resolution = DEM_RES, nodata_value = -5,
-                                   source_data = Metashape.ElevationData, split_in_blocks = False, image_compression = lzw,
-                                   save_kml=False, save_world=False, save_scheme=False, save_alpha=True, image_description='', network_links=True, global_profile=False,
-                                   min_zoom_level=-1, max_zoom_level=-1, white_background=True, clip_to_boundary=False,title='DEM', description='Generated by Agisoft Metashape with ReefShape')
-
             # build output path for boundary shapefile - this is necessary since the files will be placed in their own new folder within the output folder that the user created/selected
             shape_dir = os.path.join(self.output_dir, self.project_name + "_" + self.chunk.label + "_boundary")
-            if(not os.path.exists(shape_dir)):
-                os.mkdir(shape_dir)
-            self.chunk.exportShapes(path = os.path.join(shape_dir, self.project_name + "_" + self.chunk.label + "_boundary.shp"), save_points=False, save_polylines=False, save_polygons=True,
-                               format = Metashape.ShapesFormatSHP, polygons_as_polylines=False, save_labels=True, save_attributes=True)
+            run_export_job(self.chunk, shapes_job("Boundary", os.path.join(shape_dir, self.project_name + "_" + self.chunk.label + "_boundary.shp"),
+                                                  save_points=False, save_polylines=False, save_polygons=True, polygons_as_polylines=False,
+                                                  save_labels=True, save_attributes=True))
 
+        scheduler.wait()
+        for job, files in scheduler.completed:
+            if job["type"] in ["raster", "raster_tiles"]:
+                export_cache.record(self.chunk, job, files)
+        export_cache.save()
+        print(" --- Exports Complete --- ")
 
-        # export ortho and dem in blockwise format for Taglab
-        if(self.checkBoxTagLab.isChecked()):
-            self.chunk.exportRaster(path = self.output_dir + "/taglab_outputs/" + self.project_name + "_" + self.chunk.label + ".tif", resolution = ORTHO_RES,
-                               source_data = Metashape.OrthomosaicData, block_width = 32767, block_height = 32767, split_in_blocks = True, image_compression = lzw, # remainder of parameters are defaults specified to ensure any alternate settings get oerridden
-                               save_kml=False, save_world=False, save_scheme=False, save_alpha=True, image_description='', network_links=True, global_profile=False,
-                               min_zoom_level=-1, max_zoom_level=-1, white_background=True, clip_to_boundary=True,title='Orthomosaic', description='Generated by Agisoft Metashape')
-            self.chunk.exportRaster(path = self.output_dir + "/taglab_outputs/" + self.project_name + "_" + self.chunk.label + "_DEM.tif", resolution = ORTHO_RES, nodata_value = -5,
-                               source_data = Metashape.ElevationData, block_width = 32767, block_height = 32767, split_in_blocks = True, image_compression = lzw, # remainder of parameters are defaults specified to ensure any alternate settings get overridden
-                               save_kml=False, save_world=False, save_scheme=False, save_alpha=True, image_description='', network_links=True, global_profile=False,
-                               min_zoom_level=-1, max_zoom_level=-1, white_background=True, clip_to_boundary=True,title='DEM', description='Generated by Agisoft Metashape')
-
-        
         ###### 4. Clean up project ######
         self.cleanProject()
         self.updateAndSave()
         
         ###### 5. Finish Script ######      
         print("Script finished")
-        Metashape.app.messageBox("ReefShape has finished processing!\n\nRemember to verify all data products to sufficient data quality before beginning analysis.")
+        self.notify("ReefShape has finished processing!\n\nRemember to verify all data products to sufficient data quality before beginning analysis.")
         self.saveSettings()
         self.close()
 
@@ -583,6 +951,13 @@ class FullWorkflowDlg(QtWidgets.QDialog):
         Metashape.app.document.save()
         print("Project Saved")
 
+    def notify(self, message):
+        ''' shows a message to the user, or just prints it when running unattended '''
+        if(self.unattended):
+            print(message)
+        else:
+            Metashape.app.messageBox(message)
+
     def refreshChunkNameDisplay(self):
         try:
             chunk = self.doc.chunk
@@ -767,6 +1142,289 @@ class FullWorkflowDlg(QtWidgets.QDialog):
                               adaptive_fitting=False, tiepoint_covariance=False)
 
 
+    def pruneRedundantCameras(self, min_views):
+        '''
+        Disables cameras that are not needed for every part of the sparse surface to be seen by at least
+        min_views cameras, so that depth maps and the mesh are built from fewer, less redundant views.
+        The keys of the disabled cameras are stored in the chunk metadata so they can always be restored,
+        even if processing is interrupted.
+        '''
+        cameras = [camera for camera in self.chunk.cameras if camera.transform and camera.enabled]
+        points = tie_point_coords(self.chunk)
+        if(len(cameras) == 0 or len(points) < 3):
+            print("Not enough aligned cameras or tie points to prune cameras")
+            return
+
+        grid = surface_grid(points)
+        footprints = camera_footprints(cameras, grid["points"])
+        selected = set(greedy_view_selection(footprints, len(grid["points"]), min_views))
+        pruned = [camera for index, camera in enumerate(cameras) if index not in selected]
+
+        for camera in pruned:
+            camera.enabled = False
+        self.chunk.meta['pruned_cameras'] = ",".join(str(camera.key) for camera in pruned)
+        print(" --- " + str(len(pruned)) + " of " + str(len(cameras)) + " cameras disabled for dense processing --- ")
+
+    def runPreview(self, step, target_type = None, georef_path = None, scalebars_path = None, ref_formatting = None):
+        '''
+        Field preview profile: copies the chunk, keeps every Nth photo, aligns them at low resolution, builds a DEM
+        from the tie points and a coarse orthomosaic, and exports them with a coverage map to a 'preview' folder.
+        The copy is removed afterwards, so the chunk being previewed is left exactly as it was.
+        If georeferencing files are given, markers are detected and the preview is scaled and referenced.
+        '''
+        PREVIEW_ALIGN_QUALITY = 4 # downscale for matching; corresponds to low accuracy in GUI
+        PREVIEW_RES = 0.005 # orthomosaic resolution in m
+        task_settings = load_processing_settings()
+        match_settings = task_settings["match_photos"]
+
+        preview_dir = os.path.join(self.output_dir, "preview")
+        if(not os.path.exists(preview_dir)):
+            os.mkdir(preview_dir)
+        original_chunk = self.chunk
+        preview_chunk = original_chunk.copy(items = [], keypoints = False)
+        preview_chunk.label = original_chunk.label + "_preview"
+        preview_chunk.remove([camera for index, camera in enumerate(preview_chunk.cameras) if index % step != 0])
+        print(" --- Preview using " + str(len(preview_chunk.cameras)) + " of " + str(len(original_chunk.cameras)) + " photos --- ")
+
+        # the workflow functions below all act on self.chunk
+        self.chunk = preview_chunk
+        try:
+            self.chunk.matchPhotos(downscale = PREVIEW_ALIGN_QUALITY, keypoint_limit_per_mpx = 300, generic_preselection = True,
+                                   reference_preselection = True, filter_mask = False, mask_tiepoints = True, filter_stationary_points = True,
+                                   keypoint_limit = 20000, tiepoint_limit = 2000, keep_keypoints = False, guided_matching = False,
+                                   reset_matches = True, subdivide_task = True, workitem_size_cameras = match_settings["workitem_size_cameras"],
+                                   workitem_size_pairs = match_settings["workitem_size_pairs"], max_workgroup_size = match_settings["max_workgroup_size"])
+            self.chunk.alignCameras(adaptive_fitting = True, min_image = 2, reset_alignment = True, subdivide_task = True)
+            print(" --- Preview alignment completed --- ")
+
+            if(georef_path and scalebars_path):
+                if(len(self.chunk.markers) == 0):
+                    self.chunk.detectMarkers(target_type = target_type, tolerance=20, filter_mask=False, inverted=False, noparity=False, maximum_residual=5, minimum_size=0, minimum_dist=5)
+                error = self.referenceModel(georef_path, ref_formatting)
+                if(not error and len(self.chunk.markers) > 0 and len(self.chunk.scalebars) == 0):
+                    error = self.createScalebars(scalebars_path)
+                if(error):
+                    print("Preview could not be referenced: " + error)
+            self.chunk.updateTransform()
+
+            if(self.checkBoxCoverage.isChecked()):
+                self.checkCoverage(self.spinboxCoverageViews.value(), preview_dir)
+
+            self.chunk.resetRegion()
+            self.chunk.buildDem(source_data = Metashape.TiePointsData, interpolation = Metashape.EnabledInterpolation, subdivide_task = True)
+            self.chunk.buildOrthomosaic(resolution = PREVIEW_RES, surface_data = Metashape.ElevationData, blending_mode = Metashape.MosaicBlending,
+                                        fill_holes = True, ghosting_filter = False, cull_faces = False, refine_seamlines = False, subdivide_task = True)
+            print(" --- Preview DEM and Orthomosaic Built --- ")
+
+            jpg = Metashape.ImageCompression()
+            jpg.tiff_compression = Metashape.ImageCompression.TiffCompressionJPEG
+            jpg.jpeg_quality = 75
+            jpg.tiff_overviews = True
+            lzw = Metashape.ImageCompression()
+            lzw.tiff_compression = Metashape.ImageCompression.TiffCompressionLZW
+            lzw.tiff_overviews = True
+            preview_name = os.path.join(preview_dir, self.project_name + "_" + original_chunk.label + "_preview")
+            self.chunk.exportRaster(path = preview_name + ".tif", resolution = PREVIEW_RES, source_data = Metashape.OrthomosaicData,
+                                    split_in_blocks = False, image_compression = jpg, save_alpha = True, white_background = True, clip_to_boundary = False)
+            self.chunk.exportRaster(path = preview_name + "_DEM.tif", source_data = Metashape.ElevationData, nodata_value = DEM_NODATA,
+                                    split_in_blocks = False, image_compression = lzw, save_alpha = True, clip_to_boundary = False)
+            print(" --- Preview Exported --- ")
+        finally:
+            self.chunk = original_chunk
+            self.doc.remove([preview_chunk])
+            self.doc.chunk = original_chunk
+            self.updateAndSave()
+
+        print("Script finished")
+        self.notify("Field preview complete. The preview orthomosaic, DEM and coverage map are in:\n" + preview_dir)
+        self.saveSettings()
+        if(not self.unattended):
+            self.close()
+
+    def checkCoverage(self, min_views, output_dir = None):
+        '''
+        Counts how many aligned cameras see each part of the plot (inside the corner markers, if they exist) and
+        writes a coverage map PNG and a CSV of under-covered cells to the output folder (or output_dir, if given).
+        The fraction of the plot seen by fewer than min_views cameras is recorded in the chunk metadata and returned.
+        '''
+        cameras = [camera for camera in self.chunk.cameras if camera.transform and camera.enabled]
+        points = tie_point_coords(self.chunk)
+        if(len(cameras) == 0 or len(points) < 3):
+            print("Not enough aligned cameras or tie points to check coverage")
+            return 0.0
+
+        boundary = [[marker.position.x, marker.position.y, marker.position.z] for marker in self.getCornerMarkers() if marker.position]
+        coverage = coverage_analysis(cameras, points, boundary if len(boundary) >= 3 else None, min_views)
+
+        output_name = (output_dir or self.output_dir) + "/" + self.project_name + "_" + self.chunk.label
+        write_coverage_png(output_name + "_coverage.png", coverage, min_views)
+        # gap locations are written in the chunk's coordinate system if it is referenced
+        T = self.chunk.transform.matrix
+        with open(output_name + "_coverage_gaps.csv", 'w', newline = '') as f:
+            writer = csv.writer(f)
+            writer.writerow(["row", "col", "views", "x", "y", "z"])
+            grid = coverage["grid"]
+            for row, col in zip(*coverage["gaps"].nonzero()):
+                point = Metashape.Vector(grid["points"][row * grid["shape"][1] + col])
+                if(T is not None and self.chunk.crs):
+                    point = self.chunk.crs.project(T.mulp(point))
+                writer.writerow([row, col, coverage["counts"][row, col], point.x, point.y, point.z])
+
+        self.chunk.meta['coverage_gap_fraction'] = "{:.4f}".format(coverage["gap_fraction"])
+        self.chunk.meta['coverage_min_views'] = str(min_views)
+        print(" --- Coverage checked: {:.1f}% of the plot seen by fewer than {} cameras --- ".format(100 * coverage["gap_fraction"], min_views))
+        return coverage["gap_fraction"]
+
+    def restorePrunedCameras(self):
+        '''
+        Re-enables any cameras disabled by pruneRedundantCameras()
+        '''
+        if(not self.chunk.meta['pruned_cameras']):
+            return
+        pruned_keys = set(int(key) for key in self.chunk.meta['pruned_cameras'].split(","))
+        for camera in self.chunk.cameras:
+            if(camera.key in pruned_keys):
+                camera.enabled = True
+        self.chunk.meta['pruned_cameras'] = ""
+        print(" --- Pruned cameras re-enabled --- ")
+
+    def tagLabTileJobs(self, resolution, ortho_compression, dem_compression, dem_quantize, raster_defaults):
+        '''
+        Lays a tile grid over the boundary (or the whole orthomosaic, if there is no boundary), writes the tile
+        index, and returns export jobs for the orthomosaic and DEM tiles. The compressions are (Metashape compression,
+        GDAL recompression or None) pairs as returned by export_compression(), and dem_quantize the compact DEM
+        options (or None). resolution is in metres (0 for the orthomosaic's own). The tiles of each product are split
+        into one job per concurrent export so they are exported in parallel.
+        '''
+        ortho = self.chunk.orthomosaic
+        # the resolution is in metres, the extent and tile regions in the orthomosaic's coordinate system units
+        pixel = pixel_size(ortho, resolution)
+        extent = self.boundaryExtent(ortho.crs) or [ortho.left, ortho.bottom, ortho.right, ortho.top]
+        tiles = tile_grid(extent, pixel, self.spinboxTileSize.value(), self.spinboxTileOverlap.value())
+
+        name = self.project_name + "_" + self.chunk.label
+        tile_dir = os.path.join(self.output_dir, "taglab_outputs", name + "_tiles")
+        if not os.path.exists(tile_dir):
+            os.makedirs(tile_dir)
+        ortho_file = lambda tile: name + "_" + tile["id"] + ".tif"
+        dem_file = lambda tile: name + "_" + tile["id"] + "_DEM.tif"
+        write_tile_manifest(os.path.join(tile_dir, name + "_tiles.geojson"), tiles, ortho.crs, pixel,
+                            self.spinboxTileSize.value(), self.spinboxTileOverlap.value(), {"orthomosaic": ortho_file, "dem": dem_file})
+        print(" --- " + str(len(tiles)) + " TagLab tiles indexed --- ")
+
+        jobs = []
+        groups = self.spinboxConcurrentExports.value()
+        for group in range(groups):
+            group_tiles = tiles[group::groups]
+            if not group_tiles:
+                continue
+            suffix = " tiles " + str(group + 1) + "/" + str(groups)
+            jobs.append(tiles_job("TagLab Orthomosaic" + suffix, [{"path": os.path.join(tile_dir, ortho_file(tile)), "region": tile["region"]} for tile in group_tiles],
+                                  "OrthomosaicData", ortho_compression[0], recompress = ortho_compression[1], resolution_x = pixel[0], resolution_y = pixel[1], split_in_blocks = False, clip_to_boundary = True,
+                                  title = 'Orthomosaic', description = 'Generated by Agisoft Metashape', **raster_defaults))
+            jobs.append(tiles_job("TagLab DEM" + suffix, [{"path": os.path.join(tile_dir, dem_file(tile)), "region": tile["region"]} for tile in group_tiles],
+                                  "ElevationData", dem_compression[0], recompress = dem_compression[1], quantize = dem_quantize, resolution_x = pixel[0], resolution_y = pixel[1], nodata_value = DEM_NODATA, split_in_blocks = False,
+                                  clip_to_boundary = True, title = 'DEM', description = 'Generated by Agisoft Metashape', **raster_defaults))
+        return jobs
+
+    def exportQuickLooks(self):
+        '''
+        Writes a quick-look set to the quicklook folder: the orthomosaic as a JPEG about QUICKLOOK_SIZE pixels
+        across, a hillshaded DEM, and the orthomosaic with the aligned cameras (yellow) and markers (red) drawn on
+        it. Everything is exported at the quick-look resolution, so it only takes a few seconds.
+        '''
+        QUICKLOOK_SIZE = 2048 # px along the longest side
+
+        ortho = self.chunk.orthomosaic
+        if not ortho:
+            return
+        name = self.project_name + "_" + self.chunk.label
+        quicklook_dir = os.path.join(self.output_dir, "quicklook")
+        if not os.path.exists(quicklook_dir):
+            os.makedirs(quicklook_dir)
+
+        # quick-look pixels are square on the ground: resolution is their size in metres (used for the hillshade), and
+        # pixel their size in the orthomosaic's coordinate system units (used for the window and the exports)
+        resolution = ortho.resolution * max(ortho.width, ortho.height) / QUICKLOOK_SIZE
+        pixel = pixel_size(ortho, resolution)
+        window = window_extent([ortho.left, ortho.bottom, ortho.right, ortho.top], pixel)
+        common = dict(region = export_region(window), resolution_x = pixel[0], resolution_y = pixel[1], split_in_blocks = False, clip_to_boundary = False,
+                      save_alpha = False, white_background = True)
+        jpg = Metashape.ImageCompression()
+        jpg.jpeg_quality = 85
+        raw = Metashape.ImageCompression()
+        raw.tiff_compression = Metashape.ImageCompression.TiffCompressionNone
+        raw.tiff_big = False
+        raw.tiff_overviews = False
+
+        self.chunk.exportRaster(path = os.path.join(quicklook_dir, name + "_ortho.jpg"), source_data = Metashape.OrthomosaicData,
+                                image_format = Metashape.ImageFormat.ImageFormatJPEG, image_compression = jpg, **common)
+
+        temp_dir = tempfile.mkdtemp(prefix = "reefshape_quicklook_")
+        try:
+            # uncompressed copies are read back with NumPy to draw the overlay and hillshade
+            ortho_tif = os.path.join(temp_dir, "ortho.tif")
+            self.chunk.exportRaster(path = ortho_tif, source_data = Metashape.OrthomosaicData,
+                                    image_format = Metashape.ImageFormat.ImageFormatTIFF, image_compression = raw, **common)
+            rgb = read_tiff_array(ortho_tif)[:, :, :3].copy()
+
+            T = self.chunk.transform.matrix
+            def pixel(position):
+                point = self.chunk.crs.project(T.mulp(position))
+                if ortho.crs and self.chunk.crs.wkt != ortho.crs.wkt:
+                    point = Metashape.CoordinateSystem.transform(point, self.chunk.crs, ortho.crs)
+                return (window[3] - point[1]) / pixel[1], (point[0] - window[0]) / pixel[0]
+            if T is not None and self.chunk.crs:
+                mark_points(rgb, [pixel(camera.center) for camera in self.chunk.cameras if camera.transform], (255, 220, 0), radius = 2)
+                mark_points(rgb, [pixel(marker.position) for marker in self.chunk.markers if marker.position], (255, 0, 0), radius = 8, cross = True)
+            write_png(os.path.join(quicklook_dir, name + "_cameras.png"), rgb)
+
+            if self.chunk.elevation:
+                dem_tif = os.path.join(temp_dir, "dem.tif")
+                self.chunk.exportRaster(path = dem_tif, source_data = Metashape.ElevationData, nodata_value = DEM_NODATA,
+                                        image_format = Metashape.ImageFormat.ImageFormatTIFF, image_compression = raw, **common)
+                write_png(os.path.join(quicklook_dir, name + "_hillshade.png"), hillshade(read_tiff_array(dem_tif)[:, :, 0], resolution, DEM_NODATA))
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors = True)
+        print(" --- Quick-Look Previews Exported to " + quicklook_dir + " --- ")
+
+    def boundaryWindow(self, asset, resolution):
+        '''
+        Returns the export window [xmin, ymin, xmax, ymax] of the boundary (plus the margin) in the pixel grid of the
+        given orthomosaic or DEM at the given resolution (0 for the asset's own), or None if windowed exports are
+        turned off or the chunk has no boundary
+        '''
+        if not self.checkBoxWindowExports.isChecked() or not asset:
+            return None
+        extent = self.boundaryExtent(asset.crs)
+        if extent is None:
+            return None
+        # the resolution and margin are in metres, the extent in the asset's coordinate system units
+        pixel = pixel_size(asset, resolution)
+        margin = self.spinboxWindowMargin.value() / (resolution or asset.resolution)
+        return window_extent(extent, pixel, (margin * pixel[0], margin * pixel[1]))
+
+    def boundaryExtent(self, crs):
+        '''
+        Returns the bounding box [xmin, ymin, xmax, ymax] of the outer boundary shapes in the given coordinate
+        system, or None if the chunk has no outer boundary
+        '''
+        if not self.chunk.shapes:
+            return None
+        shape_crs = self.chunk.shapes.crs
+        points = []
+        for shape in self.chunk.shapes:
+            if shape.boundary_type != Metashape.Shape.BoundaryType.OuterBoundary or shape.geometry.type != Metashape.Geometry.Type.PolygonType:
+                continue
+            for vertex in shape.geometry.coordinates[0]:
+                vertex = Metashape.Vector([vertex[0], vertex[1], vertex[2] if len(vertex) > 2 else 0])
+                if shape_crs and crs and shape_crs.wkt != crs.wkt:
+                    vertex = Metashape.CoordinateSystem.transform(vertex, shape_crs, crs)
+                points.append(vertex)
+        if not points:
+            return None
+        return [min(p[0] for p in points), min(p[1] for p in points), max(p[0] for p in points), max(p[1] for p in points)]
+
     def create_shape_from_markers(self, marker_list):
         '''
         Creates a boundary shape from a given set of markers
@@ -803,13 +1461,18 @@ class FullWorkflowDlg(QtWidgets.QDialog):
         such that the resulting shape will not be crossed into an hourglass shape if the
         corner markers are positioned incorrectly.
         '''
+        self.create_shape_from_markers(self.getCornerMarkers())
+
+    def getCornerMarkers(self):
+        '''
+        Returns the (up to four) corner markers in the chunk, in the order given by the corner marker arrangement
+        '''
         m_list = []
         for corner_num in self.corner_markers:
             for marker in self.chunk.markers:
                 if(str(corner_num) == re.search('(\d+)', marker.label).group(0)):
                     m_list.append(marker)
-        m_list_short = m_list[:4]
-        self.create_shape_from_markers(m_list_short)
+        return m_list[:4]
 
 
 
@@ -863,6 +1526,34 @@ class FullWorkflowDlg(QtWidgets.QDialog):
         self.labelCustomRes.setEnabled(not use_default_res)
         self.spinboxCustomRes.setEnabled(not use_default_res)
 
+    def onProcessingModeChange(self):
+        '''
+        Slot: vertex colors only apply to a mesh, so the option is disabled in map-only modes, and the
+        preview photo subsampling only applies to the field preview
+        '''
+        processing_mode = self.processingModes[self.comboProcessingMode.currentIndex()][1]
+        self.checkBoxVertexColors.setEnabled(processing_mode == "full")
+        self.labelPreviewStep.setEnabled(processing_mode == "preview")
+        self.spinboxPreviewStep.setEnabled(processing_mode == "preview")
+
+    def onPruneCamerasChange(self):
+        '''
+        Slot: enables/disables the pruning options
+        '''
+        prune = self.checkBoxPruneCameras.isChecked()
+        self.labelMinViews.setEnabled(prune)
+        self.spinboxMinViews.setEnabled(prune)
+        self.checkBoxOrthoAllCameras.setEnabled(prune)
+
+    def onCoverageChange(self):
+        '''
+        Slot: enables/disables the coverage check options
+        '''
+        check_coverage = self.checkBoxCoverage.isChecked()
+        self.labelCoverageViews.setEnabled(check_coverage)
+        self.spinboxCoverageViews.setEnabled(check_coverage)
+        self.checkBoxStopOnGaps.setEnabled(check_coverage)
+
     # END CLASS FullWorkflowDlg
 
 def run_script():
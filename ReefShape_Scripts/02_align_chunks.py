@@ -9,12 +9,15 @@ implemented in FullUW_dialog.py. Once the user has collected two sets of photos,
 can be used to make sure the two sets line up before processing the second data set. The
 data from the first time point must be already processed before this script is used.
 
-The script works by exporting Metashape's estimated reference information for markers in the first
-time point at sub-millimeter precision, then using this information to georeference markers in the
-second time point (and subsequent data sets). Using high-precision estimated coordinates rather
+The script works by reading Metashape's estimated positions of the markers in the first time point
+at full precision, then using them to georeference the markers with the same labels (or target numbers)
+in the second time point (and subsequent data sets). Using high-precision estimated coordinates rather
 than the source coordinates enables Metashape to warp the data products from the second time point
 so that they align pixel-to-pixel with those from the first, even though the actual georeferencing
 (ie where on earth the reef is located) can never be that precise.
+
+The reference chunk can be in the same project or in another project, which is opened read-only, so each time point
+can be kept in a project of its own.
 '''
 
 import Metashape
@@ -24,6 +27,7 @@ import csv
 import re
 from PySide2 import QtGui, QtCore, QtWidgets # NOTE: the style enums (such as alignment) seem to be in QtCore.Qt
 from ui_components import AddPhotosGroupBox, BoundaryMarkerDlg, GeoreferenceGroupBox
+from timeseries_tools import transfer_reference, chunk_reference, check_marker_residuals, record_alignment_qa, has_aligned_markers, open_reference_project, find_reference_chunk
 
 
 class AlignChunksDlg(QtWidgets.QDialog):
@@ -38,6 +42,7 @@ class AlignChunksDlg(QtWidgets.QDialog):
         self.project_folder = path.dirname(self.doc.path)
         self.project_name = path.basename(self.doc.path)[:-4] # extracts project name from file path
         self.reference_chunk = self.doc.chunk # set default reference chunk to current active chunk
+        self.reference_project = "" # path of the project holding the reference chunk, if it is not in this project
         self.chunk = self.doc.chunk
         self.chunk_keys = []
         self.output_dir = self.project_folder
@@ -92,9 +97,12 @@ class AlignChunksDlg(QtWidgets.QDialog):
         # ---- General Groupbox ----
         self.labelRefChunk = QtWidgets.QLabel("Select Reference Chunk:")
         self.comboRefChunk = QtWidgets.QComboBox()
+        self.btnRefProject = QtWidgets.QPushButton("Other Project...")
+        self.btnRefProject.setToolTip("Use a chunk from another project as the reference (the project is opened read-only)")
         ref_chunk_layout = QtWidgets.QHBoxLayout()
         ref_chunk_layout.addWidget(self.labelRefChunk)
         ref_chunk_layout.addWidget(self.comboRefChunk)
+        ref_chunk_layout.addWidget(self.btnRefProject)
 
         self.labelNewChunk = QtWidgets.QLabel("Select Active Chunk:")
         self.comboNewChunk = QtWidgets.QComboBox()
@@ -153,6 +161,7 @@ class AlignChunksDlg(QtWidgets.QDialog):
         # connect signals and slots
         self.btnCreateChunk.clicked.connect(self.createChunk)
         self.comboRefChunk.activated.connect(self.setReferenceChunk)
+        self.btnRefProject.clicked.connect(self.getReferenceProject)
         self.comboNewChunk.activated.connect(self.setActiveChunk)
         self.comboDamagedMarkers.currentIndexChanged.connect(self.addDamagedMarker)
         self.comboTargetType.currentIndexChanged.connect(self.onTargetTypeChange)
@@ -170,34 +179,32 @@ class AlignChunksDlg(QtWidgets.QDialog):
         print("Script started...")
         self.setEnabled(False)
 
-        if(len(self.doc.chunks) < 2):
+        if(not self.reference_project and len(self.doc.chunks) < 2):
             Metashape.app.messageBox("Unable to align chunks: Please create a second chunk to align")
             self.setEnabled(True)
             return
 
-        est_ref_path = os.path.join(self.project_folder, self.reference_chunk.label + "_est_ref.csv")
-        # export estimated reference from old chunk - in decimal degrees, 9 decimal places is about 0.1mm
-        self.reference_chunk.exportReference(path = est_ref_path, format = Metashape.ReferenceFormatCSV,
-                            items = Metashape.ReferenceItemsMarkers, columns = 'nouvwUVW', delimiter = ",", precision = 9)
-
-        self.correctEnabledMarkers(est_ref_path)
-
-        # detect markers in new chunk
-        if(len(self.chunk.markers) == 0): # only detect markers if there are currently no markers in selected chunk
-            self.chunk.detectMarkers(target_type = self.target_type, tolerance=20, filter_mask=False, inverted=False, noparity=False, maximum_residual=5, minimum_size=0, minimum_dist=5)
-
-        # import reference to new chunk
-        self.chunk.importReference(path = est_ref_path, format = Metashape.ReferenceFormatCSV, delimiter = ',', columns = "noxyz", skip_rows = 1,
-                              crs = self.reference_chunk.crs, ignore_labels=False, create_markers=False, threshold=0.1, shutter_lag=0)
-
-        # adjust accuracy for damaged markers - accuracy is set in meters
-        for marker in self.chunk.markers:
-            marker.reference.accuracy = [0.0001, 0.0001, 0.0001]
-            for damaged_marker in self.damaged_markers:
-                if(marker.label == damaged_marker.label):
-                    marker.reference.accuracy = [1, 1, 1]
-
-        self.chunk.updateTransform()
+        # detect markers in the new chunk and copy the estimated positions of the same markers in the old chunk to their reference
+        try:
+            transfer_reference(chunk_reference(self.reference_chunk, self.reference_project), self.chunk, self.target_type,
+                               [marker.label for marker in self.damaged_markers])
+        except Exception as e:
+            Metashape.app.messageBox("Unable to align chunks: " + str(e))
+            self.setEnabled(True)
+            return
+        if(self.chunk.meta['coregistration'] == "pending"):
+            Metashape.app.messageBox("Fewer than three markers could be matched to the reference chunk. The full workflow will co-register this "
+                                     "chunk to the reference chunk from its DEM instead, so it must be roughly georeferenced another way "
+                                     "(e.g. from its own georeferencing file) - or place the missing markers by hand and run this script again.")
+        # if the new chunk is already aligned, check for moved markers now - otherwise the full workflow checks them after aligning
+        if(has_aligned_markers(self.chunk)):
+            moved_markers = check_marker_residuals(self.chunk, self.project_folder)
+            if(moved_markers):
+                Metashape.app.messageBox("These markers appear to have moved or been damaged since the reference time point, and were given a low accuracy: "
+                                         + ", ".join(moved_markers) + "\n\nMarker residuals were saved to:\n" + self.chunk.meta['marker_check'])
+            qa = record_alignment_qa(self.chunk, self.project_folder)
+            if(qa["review"]):
+                Metashape.app.messageBox("The alignment to the reference chunk should be reviewed: " + ", ".join(qa["review"]))
         self.updateAndSave()
         self.reject()
 
@@ -244,7 +251,12 @@ class AlignChunksDlg(QtWidgets.QDialog):
             self.comboRefChunk.addItem(chunk.label)
             self.comboNewChunk.addItem(chunk.label)
             self.chunk_keys.append(chunk.key)
-        self.comboRefChunk.setCurrentIndex(self.chunk_keys.index(self.reference_chunk.key))
+        if(self.reference_project):
+            # a reference chunk from another project is listed after this project's chunks
+            self.comboRefChunk.addItem(self.reference_chunk.label + " (" + path.basename(self.reference_project) + ")")
+            self.comboRefChunk.setCurrentIndex(len(self.chunk_keys))
+        else:
+            self.comboRefChunk.setCurrentIndex(self.chunk_keys.index(self.reference_chunk.key))
         self.comboNewChunk.setCurrentIndex(self.chunk_keys.index(self.chunk.key))
         self.updateMarkerList()
         
@@ -253,8 +265,33 @@ class AlignChunksDlg(QtWidgets.QDialog):
         Slot: when the user selects a new chunk to be the reference chunk, updates the corresponding
         member variable and adds the chunk's markers to the markers combo box
         '''
+        if(self.comboRefChunk.currentIndex() >= len(self.chunk_keys)): # the reference chunk from another project
+            return
         self.reference_chunk = self.doc.findChunk(self.chunk_keys[self.comboRefChunk.currentIndex()])
-        self.updateMarkerList()
+        self.reference_project = ""
+        self.updateChunkList()
+
+    def getReferenceProject(self):
+        '''
+        Slot: lets the user pick a reference chunk from another project, which is opened read-only, so each
+        time point can be kept in a project of its own
+        '''
+        project_path, _ = QtWidgets.QFileDialog.getOpenFileName(self, "Select Reference Project", self.project_folder, "Metashape Project (*.psx)")
+        if(not project_path):
+            return
+        reference_doc = open_reference_project(project_path)
+        labels = [chunk.label for chunk in reference_doc.chunks]
+        if(not labels):
+            Metashape.app.messageBox("The selected project has no chunks.")
+            return
+        default_chunk = find_reference_chunk(reference_doc)
+        label, ok = QtWidgets.QInputDialog.getItem(self, "Reference Chunk", "Select the reference chunk:", labels,
+                                                   labels.index(default_chunk.label) if default_chunk else 0, False)
+        if(not ok):
+            return
+        self.reference_chunk = reference_doc.chunks[labels.index(label)]
+        self.reference_project = project_path
+        self.updateChunkList()
 
     def setActiveChunk(self):
         '''
@@ -325,39 +362,6 @@ class AlignChunksDlg(QtWidgets.QDialog):
         self.target_type = self.targetTypes[target_type_index][1]
 
 
-    def correctEnabledMarkers(self, path):
-        '''
-        Edits the estimated reference file so that only markers used for georeferencing in
-        time point 1 are used to align time point 2.
-        Currently, this functionality is broken in metashape, and all markers are marked as
-        enabled.
-        '''
-        # read in raw georeferencing data and put it in a list
-        file = open(path)
-        eof = False
-        header = file.readline() # skip first header containing crs info
-        header = file.readline()
-        ref = [header.split(sep = ",")] # save second header line containing column headers
-        line = file.readline()
-        index = 0 # use marker index to match file lines with markers - Metashape exports markers in the order of their indices
-
-        while not eof:
-            marker_ref = line.split(sep = ",")
-            if(self.reference_chunk.markers[index].reference.enabled):
-                ref.append(marker_ref)
-            # marker_ref[1] = int(self.reference_chunk.markers[index].reference.enabled) # rewrite enabled flag
-            line = file.readline()
-            index += 1
-            if (index >= len(self.reference_chunk.markers) or not len(line)):
-                eof = True
-                break
-        file.close()
-        # write edited reference info back to the file
-        with open(path, 'w', newline = '') as f:
-            writer = csv.writer(f)
-            writer.writerows(ref)
-        f.close()
-    
     def closeEvent(self, event):
         self.reject()
         event.accept()
@@ -8,73 +8,47 @@ This script takes an existing model and outer boundary shape and uses them to ca
 
     Usage notes:
         - The script requires there to be a single model in the chunk that is activated as default
-        - The script also requires there to be a single shape in the project that is set as the
-        outer boundary. This is generated automatically by the Full UW Workflow script, or this 
-        can be done manually by deleting any existing shapes, drawing your own boundary shape on a 
-        completed orthomosaic, and setting it as "outer boundary" by right-clicking on it and 
-        setting "boundary type" to "outer boundary".
+        - The script also requires an outer boundary shape in the chunk. This is generated automatically
+        by the Full UW Workflow script, or this can be done manually by drawing your own boundary shape
+        on a completed orthomosaic, and setting it as "outer boundary" by right-clicking on it and
+        setting "boundary type" to "outer boundary". Other shapes are ignored, and holes in the
+        boundary are left out of both areas.
+        - The areas are computed from the model's faces (see complexity_tools.py), clipping the faces
+        that cross the boundary exactly, so the model is not duplicated in the project. The results are
+        also saved in the chunk metadata.
 """
 import Metashape
 from PySide2 import QtGui, QtCore, QtWidgets
 from PySide2.QtWidgets import QMessageBox
-
-# Function to calculate 3D surface area of a mesh
-def calculate_3d_surface_area(mesh):
-    sa = mesh.area()
-    return sa
-
-# Function to calculate 2D planar surface area
-def calculate_2d_surface_area(outer_boundary):
-    pa = outer_boundary.area()
-    return pa
-
-# Function to duplicate the 3D model and clip it by an outer boundary shape
-def duplicate_and_clip_model(chunk):
-	task = Metashape.Tasks.DuplicateAsset()
-	task.asset_key = chunk.model.key
-	task.asset_type = Metashape.DataSource.ModelData
-	task.clip_to_boundary = True
-	task.apply(chunk)
-	
-	chunk.model.label = "Cropped 3D Model"
-
-# Function to delete a model from the chunk
-def delete_model(chunk):
-    chunk.remove(chunk.model)
-
-# Function to divide 3D surface area by 2D planar surface area
-def calculate_ratio(surface_area_3d, surface_area_2d):
-    return surface_area_3d / surface_area_2d
+from complexity_tools import surface_area_ratio
 
 # Main function to execute the script
 def main():
     # Get the active chunk
     chunk = Metashape.app.document.chunk
 
-    # Assume outer boundary is already defined
-    outer_boundary = chunk.shapes[0]  # Assuming the outer boundary is the first shape in the chunk
-
-    # Duplicate and clip the 3D model
-    duplicate_and_clip_model(chunk)
-    
-    duplicated_model = chunk.model
-
-    # Calculate 3D surface area
-    surface_area_3d = calculate_3d_surface_area(duplicated_model)
-
-    # Calculate 2D planar surface area
-    surface_area_2d = calculate_2d_surface_area(outer_boundary)
-
-    # Delete the duplicated and clipped model
-    delete_model(chunk)
-    
-    #Set old model as default
-    model_index = 0
-
-    chunk.model = chunk.models[model_index]
-
-    # Calculate the ratio
-    ratio = calculate_ratio(surface_area_3d, surface_area_2d)
+    # 2.5D map-only chunks have no mesh, so a 3D surface area cannot be calculated
+    if chunk.model is None:
+        if chunk.meta['processing_mode'] and chunk.meta['processing_mode'] != "full":
+            QMessageBox.warning(None, "No Model", "This chunk was processed in 2.5D map-only mode, so it has no 3D model. "
+                                "Re-run the full workflow in Full 3D Model mode to calculate the surface area ratio.")
+        else:
+            QMessageBox.warning(None, "No Model", "No 3D model found in the active chunk.")
+        return
+
+    # 3D surface area inside the outer boundary, computed from the model's faces without duplicating the model
+    print("Calculating surface area ratio...")
+    try:
+        result = surface_area_ratio(chunk)
+    except Exception as e:
+        QMessageBox.warning(None, "Unable to Calculate Ratio", str(e))
+        return
+    ratio = result["ratio"]
+    chunk.meta['surface_area_3d'] = "{:.6f}".format(result["surface_area_3d"])
+    chunk.meta['planar_area'] = "{:.6f}".format(result["planar_area"])
+    chunk.meta['surface_area_ratio'] = "{:.6f}".format(ratio)
+    print("3D surface area: {:.4f} m2, planar area: {:.4f} m2 ({} faces, {} clipped at the boundary)".format(
+          result["surface_area_3d"], result["planar_area"], result["faces"], result["clipped_faces"]))
     
     #print the ratio to make sure the value isn't lost when closing the dialog box
     print("The ratio of 3D surface area to 2D planar surface area is:")
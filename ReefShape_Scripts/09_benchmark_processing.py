@@ -0,0 +1,241 @@
+'''
+Benchmark Processing Settings
+Perry Institute for Marine Science
+
+This script tunes the task settings used by the full ReefShape workflow (depth map neighbours, work item
+sizes, workgroup sizes) to the computer it is run on. It copies a small, spatially contiguous set of aligned
+cameras from the active chunk into a temporary chunk, runs photo matching, depth maps, DEM and orthomosaic
+building on it for every combination in the parameter grids below, and records the time and peak memory of
+each run. The fastest settings for each stage are written to a tuned profile for this computer (see
+processing_settings.py), which the full workflow loads automatically the next time it runs.
+
+Usage notes:
+    - The active chunk must already be aligned. A referenced chunk gives the most representative DEM and
+    orthomosaic timings.
+    - The temporary benchmark chunk is deleted when the benchmark finishes; the active chunk is not modified.
+    - max_neighbors and pm_enable change the depth maps themselves, not just how the work is split up. They are
+    timed so their cost is visible in the results, but they are only tuned if TUNE_QUALITY_PARAMETERS is True.
+'''
+
+import Metashape
+import os
+import sys
+import time
+import copy
+import itertools
+import threading
+from processing_settings import DEFAULT_SETTINGS, save_processing_settings
+
+# parameter grids swept for each stage - edit these to widen or narrow the search
+BENCHMARK_GRIDS = {
+    "depth_maps": {"max_neighbors": [8, 16, 32], "workitem_size_cameras": [10, 20, 40], "max_workgroup_size": [50, 100], "pm_enable": [True]},
+    "build_dem": {"workitem_size_tiles": [5, 10, 20], "max_workgroup_size": [50, 100]},
+    "build_orthomosaic": {"workitem_size_cameras": [10, 20, 40], "workitem_size_tiles": [5, 10, 20], "max_workgroup_size": [100]},
+    "match_photos": {"workitem_size_cameras": [10, 20, 40], "workitem_size_pairs": [40, 80, 160], "max_workgroup_size": [100]}
+}
+QUALITY_PARAMETERS = ["max_neighbors", "pm_enable"]
+TUNE_QUALITY_PARAMETERS = False
+BENCHMARK_CAMERAS = 40 # default size of the camera subset
+DM_QUALITY = 4 # depth map downscale used for the benchmark; corresponds to medium in GUI (the workflow default)
+TIME_TOLERANCE = 0.05 # runs within 5% of the fastest are treated as equally fast, and the one using the least memory wins
+
+
+def current_memory():
+    '''
+    Returns the resident memory of the Metashape process in bytes, without needing psutil
+    (which is not bundled with Metashape)
+    '''
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    if sys.platform.startswith("linux"):
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    if sys.platform == "win32":
+        import ctypes
+        from ctypes import wintypes
+        class ProcessMemoryCounters(ctypes.Structure):
+            _fields_ = [("cb", wintypes.DWORD), ("PageFaultCount", wintypes.DWORD),
+                        ("PeakWorkingSetSize", ctypes.c_size_t), ("WorkingSetSize", ctypes.c_size_t),
+                        ("QuotaPeakPagedPoolUsage", ctypes.c_size_t), ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t), ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                        ("PagefileUsage", ctypes.c_size_t), ("PeakPagefileUsage", ctypes.c_size_t)]
+        counters = ProcessMemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        ctypes.windll.kernel32.GetCurrentProcess.restype = wintypes.HANDLE
+        ctypes.windll.psapi.GetProcessMemoryInfo(ctypes.windll.kernel32.GetCurrentProcess(), ctypes.byref(counters), counters.cb)
+        return counters.WorkingSetSize
+    # macOS - only the peak is available, reported in bytes
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class MemoryMonitor(threading.Thread):
+    '''
+    Samples process memory in the background while a processing task runs and keeps the peak.
+    If a task does not release the interpreter, only the samples taken before and after it are available.
+    '''
+    def __init__(self, interval = 0.5):
+        super().__init__(daemon = True)
+        self.interval = interval
+        self.peak = current_memory()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.peak = max(self.peak, current_memory())
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.peak = max(self.peak, current_memory())
+        return self.peak
+
+
+def run_timed(stage_function):
+    ''' runs a processing stage and returns its time in seconds, peak memory in MB, and any error message '''
+    monitor = MemoryMonitor()
+    monitor.start()
+    start = time.perf_counter()
+    error = ""
+    try:
+        stage_function()
+    except Exception as e:
+        error = str(e)
+    elapsed = time.perf_counter() - start
+    peak = monitor.stop()
+    return elapsed, peak / 1024 ** 2, error
+
+
+def parameter_grid(stage):
+    ''' returns every combination of parameter values in the grid for the given stage as a list of dicts '''
+    grid = BENCHMARK_GRIDS[stage]
+    keys = list(grid.keys())
+    return [dict(zip(keys, values)) for values in itertools.product(*[grid[key] for key in keys])]
+
+
+def select_camera_subset(chunk, count):
+    '''
+    Returns the indices of the aligned cameras closest to the centre of the aligned cameras, so the subset is
+    a contiguous patch of the plot with realistic overlap rather than scattered frames
+    '''
+    aligned = [(index, camera) for index, camera in enumerate(chunk.cameras) if camera.transform and camera.enabled]
+    if not aligned:
+        return []
+    centre = sum([camera.center for index, camera in aligned], Metashape.Vector([0, 0, 0])) / len(aligned)
+    aligned.sort(key = lambda item: (item[1].center - centre).norm())
+    return [index for index, camera in aligned[:count]]
+
+
+def create_benchmark_chunk(doc, chunk, count):
+    '''
+    Copies the chunk's alignment into a new chunk and removes every camera outside the benchmark subset
+    '''
+    subset = set(select_camera_subset(chunk, count))
+    bench = chunk.copy(items = [Metashape.DataSource.TiePointsData], keypoints = False)
+    bench.label = chunk.label + "_benchmark"
+    bench.remove([camera for index, camera in enumerate(bench.cameras) if index not in subset])
+    bench.resetRegion()
+    return bench
+
+
+def choose_best(stage, results):
+    '''
+    Picks the settings for a stage from its benchmark results: the least memory among the runs that are
+    within TIME_TOLERANCE of the fastest. Quality parameters are held at their defaults unless tuning them is enabled.
+    '''
+    runs = [run for run in results if run["stage"] == stage and not run["error"]]
+    if not TUNE_QUALITY_PARAMETERS:
+        runs = [run for run in runs if all(run["settings"][key] == DEFAULT_SETTINGS[stage][key]
+                                           for key in QUALITY_PARAMETERS if key in run["settings"])]
+    if not runs:
+        return copy.deepcopy(DEFAULT_SETTINGS[stage])
+    fastest = min(run["time_s"] for run in runs)
+    candidates = [run for run in runs if run["time_s"] <= fastest * (1 + TIME_TOLERANCE)]
+    best = min(candidates, key = lambda run: run["peak_memory_mb"])
+    settings = copy.deepcopy(DEFAULT_SETTINGS[stage])
+    settings.update(best["settings"])
+    return settings
+
+
+def benchmark_stage(bench, stage, results):
+    ''' runs every combination in the grid for one stage on the benchmark chunk and appends the results '''
+    for params in parameter_grid(stage):
+        settings = copy.deepcopy(DEFAULT_SETTINGS[stage])
+        settings.update(params)
+
+        if stage == "depth_maps":
+            def stage_function():
+                task = Metashape.Tasks.BuildDepthMaps()
+                task.downscale = DM_QUALITY
+                task.filter_mode = Metashape.FilterMode.MildFiltering
+                task.reuse_depth = False
+                task.max_neighbors = settings["max_neighbors"]
+                task.subdivide_task = True
+                task.workitem_size_cameras = settings["workitem_size_cameras"]
+                task.max_workgroup_size = settings["max_workgroup_size"]
+                task["pm_enable"] = "1" if settings["pm_enable"] else "0"
+                task.apply(bench)
+        elif stage == "build_dem":
+            if bench.elevation:
+                bench.remove(bench.elevation)
+            def stage_function():
+                bench.buildDem(source_data = Metashape.DepthMapsData, interpolation = Metashape.EnabledInterpolation, subdivide_task = True,
+                               workitem_size_tiles = settings["workitem_size_tiles"], max_workgroup_size = settings["max_workgroup_size"])
+        elif stage == "build_orthomosaic":
+            if bench.orthomosaic:
+                bench.remove(bench.orthomosaic)
+            def stage_function():
+                bench.buildOrthomosaic(surface_data = Metashape.ElevationData, blending_mode = Metashape.MosaicBlending, fill_holes = True,
+                                       subdivide_task = True, workitem_size_cameras = settings["workitem_size_cameras"],
+                                       workitem_size_tiles = settings["workitem_size_tiles"], max_workgroup_size = settings["max_workgroup_size"])
+        else:
+            def stage_function():
+                bench.matchPhotos(downscale = 1, keypoint_limit_per_mpx = 300, generic_preselection = True, reference_preselection = True,
+                                  filter_mask = False, mask_tiepoints = True, filter_stationary_points = True, keypoint_limit = 40000,
+                                  tiepoint_limit = 4000, keep_keypoints = False, guided_matching = False, reset_matches = True, subdivide_task = True,
+                                  workitem_size_cameras = settings["workitem_size_cameras"], workitem_size_pairs = settings["workitem_size_pairs"],
+                                  max_workgroup_size = settings["max_workgroup_size"])
+
+        elapsed, peak, error = run_timed(stage_function)
+        results.append({"stage": stage, "settings": params, "time_s": round(elapsed, 2), "peak_memory_mb": round(peak, 1), "error": error})
+        print(f"{stage} {params}: {elapsed:.1f} s, {peak:.0f} MB {error}")
+
+
+def benchmark_processing():
+    doc = Metashape.app.document
+    chunk = doc.chunk
+    if not chunk or not chunk.tie_points:
+        Metashape.app.messageBox("The active chunk must be aligned before processing settings can be benchmarked.")
+        return
+
+    count = Metashape.app.getInt("Number of aligned cameras to benchmark with:", BENCHMARK_CAMERAS)
+    if not count or count < 2:
+        return
+
+    print("Benchmark started...")
+    bench = create_benchmark_chunk(doc, chunk, count)
+    results = []
+    tuned = {}
+    try:
+        # matching runs last because resetting matches discards the copied alignment the other stages rely on
+        for stage in ["depth_maps", "build_dem", "build_orthomosaic", "match_photos"]:
+            benchmark_stage(bench, stage, results)
+            tuned[stage] = choose_best(stage, results)
+            print(f" --- {stage} benchmarked: {tuned[stage]} --- ")
+    finally:
+        doc.remove([bench])
+        doc.chunk = chunk
+
+    path = save_processing_settings(tuned, results)
+    print("Tuned processing settings saved to " + path)
+    Metashape.app.messageBox("Benchmark complete. Tuned settings for this computer were saved to:\n" + path +
+                             "\n\nThe Full ReefShape Workflow will use them automatically.")
+
+
+label = "ReefShape/Tools/Benchmark Processing Settings"
+Metashape.app.removeMenuItem(label)
+Metashape.app.addMenuItem(label, benchmark_processing)
+print("To execute this script press {}".format(label))
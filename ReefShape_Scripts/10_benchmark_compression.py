@@ -0,0 +1,126 @@
+'''
+Benchmark Export Compression
+Perry Institute for Marine Science
+
+This script measures how well different TIFF codecs suit the orthomosaics and DEMs of the active chunk, and
+writes a recommended compression profile that the full ReefShape workflow uses for its exports. It exports a
+sample window from the centre of the orthomosaic and DEM without compression, writes it again with every codec
+and predictor in the lists below, and records the encode time, decode (full read) time, file size and, for
+lossy codecs, the peak signal-to-noise ratio against the uncompressed sample.
+
+Recommendations:
+    - orthomosaics: the smallest file whose quality is at least the minimum PSNR for that product (lossless
+    codecs always qualify). TagLab orthomosaics are held to a higher minimum, since they are annotated at full zoom.
+    - DEMs: the smallest lossless file among the codecs that encode within ENCODE_TIME_FACTOR of the fastest,
+    so a marginally smaller but much slower codec is not chosen.
+
+Usage notes:
+    - The active chunk must have an orthomosaic and a DEM.
+    - GDAL is required (see raster_tools.py). Codecs Metashape cannot write itself (ZSTD, predictors) are applied
+    by recompressing the exported files with GDAL, so exports using them also need GDAL.
+    - The profile is saved to the .reefshape folder in the user's home folder. Delete it to return to the defaults.
+'''
+
+import Metashape
+import os
+import shutil
+import tempfile
+from processing_settings import save_compression_profile
+from export_tools import window_extent, export_region, pixel_size
+from raster_tools import require_gdal, benchmark_codec, DEM_NODATA
+
+# codecs measured for each kind of raster - edit these to widen or narrow the search
+ORTHO_CODECS = [{"compression": "JPEG", "quality": quality, "predictor": None} for quality in [75, 85, 90, 95]] + \
+               [{"compression": compression, "quality": 90, "predictor": predictor} for compression in ["LZW", "DEFLATE", "ZSTD"] for predictor in [None, 2]]
+DEM_CODECS = [{"compression": compression, "quality": 90, "predictor": predictor} for compression in ["LZW", "DEFLATE", "ZSTD"] for predictor in [None, 3]]
+SAMPLE_SIZE = 4096 # px, side of the sample window
+MIN_PSNR = {"ortho": 38, "taglab_ortho": 45} # dB, minimum quality for lossy orthomosaic codecs
+ENCODE_TIME_FACTOR = 3 # DEM codecs may take up to this many times longer to encode than the fastest
+
+
+def export_sample(chunk, source_data, asset, path, nodata = None):
+    ''' exports an uncompressed SAMPLE_SIZE window from the centre of the orthomosaic or DEM '''
+    centre_x, centre_y = (asset.left + asset.right) / 2, (asset.bottom + asset.top) / 2
+    pixel = pixel_size(asset) # the extent is in coordinate system units, the asset resolution in metres
+    half_x, half_y = SAMPLE_SIZE * pixel[0] / 2, SAMPLE_SIZE * pixel[1] / 2
+    window = window_extent([centre_x - half_x, centre_y - half_y, centre_x + half_x, centre_y + half_y], pixel)
+    compression = Metashape.ImageCompression()
+    compression.tiff_compression = Metashape.ImageCompression.TiffCompressionNone
+    compression.tiff_overviews = False
+    params = {} if nodata is None else {"nodata_value": nodata}
+    chunk.exportRaster(path = path, source_data = source_data, region = export_region(window), resolution_x = pixel[0], resolution_y = pixel[1],
+                       image_compression = compression, split_in_blocks = False, clip_to_boundary = False, save_alpha = False, **params)
+
+
+def benchmark_codecs(sample_path, codecs, kind, temp_dir, results):
+    ''' writes the sample with each codec and appends the measurements to results '''
+    for index, codec in enumerate(codecs):
+        try:
+            measured = benchmark_codec(sample_path, os.path.join(temp_dir, kind + "_" + str(index) + ".tif"),
+                                       codec["compression"], codec["quality"], codec["predictor"])
+            error = ""
+        except Exception as e:
+            measured, error = {}, str(e) # e.g. ZSTD is missing from some GDAL builds
+        results.append(dict(codec, kind = kind, error = error, **measured))
+        print(f"{kind} {codec}: {measured} {error}")
+
+
+def recommend_ortho(results, min_psnr):
+    ''' the smallest orthomosaic codec that is lossless or at least min_psnr dB '''
+    runs = [run for run in results if run["kind"] == "ortho" and not run["error"]
+            and (run["psnr_db"] is None or run["psnr_db"] >= min_psnr)]
+    return min(runs, key = lambda run: run["size_mb"]) if runs else None
+
+
+def recommend_dem(results):
+    ''' the smallest lossless DEM codec among those encoding within ENCODE_TIME_FACTOR of the fastest '''
+    runs = [run for run in results if run["kind"] == "dem" and not run["error"] and run["psnr_db"] is None]
+    if not runs:
+        return None
+    fastest = min(run["encode_s"] for run in runs)
+    return min([run for run in runs if run["encode_s"] <= fastest * ENCODE_TIME_FACTOR], key = lambda run: run["size_mb"])
+
+
+def benchmark_compression():
+    chunk = Metashape.app.document.chunk
+    if not chunk or not chunk.orthomosaic or not chunk.elevation:
+        Metashape.app.messageBox("The active chunk must have an orthomosaic and a DEM before export compression can be benchmarked.")
+        return
+    try:
+        require_gdal()
+    except Exception as e:
+        Metashape.app.messageBox(str(e))
+        return
+
+    print("Compression benchmark started...")
+    temp_dir = tempfile.mkdtemp(prefix = "reefshape_compression_")
+    results = []
+    try:
+        ortho_sample = os.path.join(temp_dir, "ortho_sample.tif")
+        dem_sample = os.path.join(temp_dir, "dem_sample.tif")
+        export_sample(chunk, Metashape.OrthomosaicData, chunk.orthomosaic, ortho_sample)
+        export_sample(chunk, Metashape.ElevationData, chunk.elevation, dem_sample, nodata = DEM_NODATA)
+        benchmark_codecs(ortho_sample, ORTHO_CODECS, "ortho", temp_dir, results)
+        benchmark_codecs(dem_sample, DEM_CODECS, "dem", temp_dir, results)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors = True)
+
+    recommended = {"ortho": recommend_ortho(results, MIN_PSNR["ortho"]), "taglab_ortho": recommend_ortho(results, MIN_PSNR["taglab_ortho"]),
+                   "dem": recommend_dem(results), "taglab_dem": recommend_dem(results)}
+    compression = {product: {key: run[key] for key in ["compression", "quality", "predictor"]}
+                   for product, run in recommended.items() if run}
+    for product, codec in compression.items():
+        print(f" --- {product}: {codec} --- ")
+
+    path = save_compression_profile(compression, results)
+    print("Recommended export compression saved to " + path)
+    Metashape.app.messageBox("Compression benchmark complete. The recommended export compression was saved to:\n" + path +
+                             "\n\n" + "\n".join(f"{product}: {codec['compression']}" + (f" quality {codec['quality']}" if codec["compression"] == "JPEG" else "") +
+                                                (f" predictor {codec['predictor']}" if codec["predictor"] else "") for product, codec in compression.items()) +
+                             "\n\nThe Full ReefShape Workflow will use it automatically.")
+
+
+label = "ReefShape/Tools/Benchmark Export Compression"
+Metashape.app.removeMenuItem(label)
+Metashape.app.addMenuItem(label, benchmark_compression)
+print("To execute this script press {}".format(label))
@@ -0,0 +1,143 @@
+'''
+Resample Exported Products
+Perry Institute for Marine Science
+
+This script makes lower resolution copies of an exported orthomosaic or DEM (e.g. 5 mm and 2 cm versions of a
+1 mm orthomosaic) without reopening the Metashape project. Copies are written to a "derived" folder next to the
+exported file and recorded in derived_products.json there, which acts as a pyramid: each new resolution is made
+from the coarsest existing copy it is a whole multiple of (a 2 cm copy is made from the 5 mm copy, not the 1 mm
+original), and a resolution that already exists is reused as long as the original has not been re-exported.
+
+Orthomosaics are area averaged. DEMs can be reduced with the mean, minimum or maximum of each group of cells.
+Resolutions that are not a whole multiple of an existing copy are resampled with GDAL's warper instead.
+Resolutions are in metres, so the export must be in a projected (e.g. UTM) or local coordinate system in metres -
+exports in a geographic coordinate system such as the workflow's default WGS84 + EGM96 are in degrees, and are refused.
+
+Usage:
+    - In Metashape: ReefShape/Tools/Resample Exported Products, then choose the file, resolutions and method.
+    - From any Python with GDAL and NumPy (Metashape not needed):
+        python 11_resample_products.py <exported .tif> <resolution in m> [<resolution in m> ...] [--method mean|min|max]
+This script requires GDAL (see raster_tools.py).
+'''
+
+import os
+import json
+from raster_tools import gdal, require_gdal, require_metres, downsample_raster, warp_raster
+
+try:
+    import Metashape
+except ImportError:
+    Metashape = None
+
+DERIVED_FOLDER = "derived"
+DERIVED_INDEX = "derived_products.json"
+METHODS = ["mean", "min", "max"]
+
+
+def raster_resolution(path):
+    ''' returns the pixel size of a GeoTIFF in its coordinate system units '''
+    return abs(gdal.Open(path).GetGeoTransform()[1])
+
+
+def source_state(path):
+    ''' size and modification time of the original export, to tell when it has been re-exported '''
+    return {"size": os.path.getsize(path), "mtime": os.path.getmtime(path)}
+
+
+def whole_multiple(target, resolution):
+    ''' returns target / resolution if it is a whole number greater than 1, otherwise None '''
+    factor = round(target / resolution)
+    return factor if factor > 1 and abs(target / resolution - factor) < 1e-6 else None
+
+
+def resample_product(path, resolution, method = "mean"):
+    '''
+    Returns the path of a copy of the exported raster at the given resolution (in metres), making it from the
+    coarsest suitable cached copy if it does not exist yet. The raster must be in metres (see require_metres()).
+    '''
+    require_gdal()
+    require_metres(path) # resolutions, file names and cached levels are all in metres
+    if method not in METHODS:
+        raise Exception("Resampling method must be one of " + ", ".join(METHODS))
+    if gdal.Open(path).RasterCount > 1: # orthomosaics are always area averaged
+        method = "mean"
+    derived_dir = os.path.join(os.path.dirname(os.path.abspath(path)), DERIVED_FOLDER)
+    if not os.path.exists(derived_dir):
+        os.makedirs(derived_dir)
+    index_path = os.path.join(derived_dir, DERIVED_INDEX)
+    index = {}
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            index = json.load(f)
+
+    # cached copies of this export that are still current, plus the export itself
+    source = os.path.basename(path)
+    state = source_state(path)
+    levels = [(raster_resolution(path), path)]
+    for name, entry in index.items():
+        if (entry["source"] == source and entry["source_state"] == state and entry["method"] == method
+                and os.path.exists(os.path.join(derived_dir, name))):
+            levels.append((entry["resolution"], os.path.join(derived_dir, name)))
+
+    for level_resolution, level_path in levels:
+        if abs(level_resolution - resolution) < 1e-9:
+            print(" --- " + os.path.basename(level_path) + " already exists --- ")
+            return level_path
+
+    stem = os.path.splitext(source)[0]
+    name = stem + "_" + ("%g" % (resolution * 1000)) + "mm" + ("" if method == "mean" else "_" + method) + ".tif"
+    dst_path = os.path.join(derived_dir, name)
+    candidates = [(level_resolution, level_path) for level_resolution, level_path in levels
+                  if level_resolution < resolution and whole_multiple(resolution, level_resolution)]
+    if candidates:
+        level_resolution, level_path = max(candidates)
+        print("Reducing " + os.path.basename(level_path) + " by " + str(whole_multiple(resolution, level_resolution)) + " to " + name)
+        downsample_raster(level_path, dst_path, whole_multiple(resolution, level_resolution), method)
+    else:
+        print("Resampling " + source + " to " + name)
+        warp_raster(path, dst_path, resolution, method)
+
+    index[name] = {"source": source, "source_state": state, "resolution": resolution, "method": method}
+    with open(index_path, 'w') as f:
+        json.dump(index, f, indent = 1)
+    return dst_path
+
+
+def resample_products():
+    ''' asks for an exported raster, resolutions and method, and makes the copies '''
+    try:
+        require_gdal()
+    except Exception as e:
+        Metashape.app.messageBox(str(e))
+        return
+    path = Metashape.app.getOpenFileName("Select an exported orthomosaic or DEM", filter = "GeoTIFF (*.tif *.tiff)")
+    if not path:
+        return
+    resolutions = Metashape.app.getString("Resolutions in metres, separated by commas:", "0.005, 0.02")
+    if not resolutions:
+        return
+    method = "mean"
+    if gdal.Open(path).RasterCount == 1: # DEMs have a single band
+        method = Metashape.app.getString("Reduce DEM cells with (mean, min or max):", "mean").strip().lower()
+    try:
+        outputs = [resample_product(path, float(resolution), method) for resolution in resolutions.split(",") if resolution.strip()]
+    except Exception as e:
+        Metashape.app.messageBox("Unable to resample " + path + ":\n" + str(e))
+        return
+    Metashape.app.messageBox("Resampled products saved:\n" + "\n".join(outputs))
+
+
+if Metashape is not None:
+    label = "ReefShape/Tools/Resample Exported Products"
+    Metashape.app.removeMenuItem(label)
+    Metashape.app.addMenuItem(label, resample_products)
+    print("To execute this script press {}".format(label))
+elif __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description = "Make lower resolution copies of an exported ReefShape orthomosaic or DEM")
+    parser.add_argument("raster", help = "exported orthomosaic or DEM (.tif)")
+    parser.add_argument("resolutions", type = float, nargs = "+", help = "output resolutions in m (the raster must be in a projected coordinate system in metres)")
+    parser.add_argument("--method", choices = METHODS, default = "mean", help = "how groups of cells are reduced (orthomosaics always use mean)")
+    args = parser.parse_args()
+    for resolution in args.resolutions:
+        print(resample_product(args.raster, resolution, args.method))
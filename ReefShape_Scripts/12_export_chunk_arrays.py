@@ -0,0 +1,209 @@
+'''
+Export Chunk Data Arrays
+Perry Institute for Marine Science
+
+This script dumps the camera poses and calibration, camera and marker errors, and tie points of the active
+chunk in one pass into a folder of columnar NumPy arrays (one .npy file per column, plus a manifest.json),
+so QA and research scripts can memory-map them with chunk_arrays.load_chunk_arrays() instead of reopening
+the project and looping over cameras and tie points in Metashape.
+
+Tables written:
+    sensors - label, type, image size and calibration (f, cx, cy, k1-k4, p1, p2, b1, b2)
+    cameras - label, enabled/aligned flags, sensor index, transform and centre (internal coordinates), source
+    and estimated locations with their difference, and the RMS reprojection error of the camera's tie points
+    markers - label, enabled flag, position (internal coordinates), source and estimated locations with their
+    difference, and the RMS pixel error of the marker projections
+    tie_points - position (internal coordinates), track id, validity, number of cameras, mean reprojection error,
+    and Metashape's gradual selection metrics (reprojection error, reconstruction uncertainty, projection accuracy)
+
+Locations are in the chunk coordinate system; positions in internal coordinates can be converted with the
+chunk transform stored in the manifest. Reprojection errors are computed for frame cameras only.
+'''
+
+import Metashape
+import os
+import numpy as np
+from datetime import datetime
+from camera_selection import matrix_to_numpy
+from chunk_arrays import write_table, write_manifest, project_frame
+
+CALIBRATION_TERMS = ["f", "cx", "cy", "k1", "k2", "k3", "k4", "p1", "p2", "b1", "b2"]
+FILTER_CRITERIA = {"gradual_reprojection_error": "ReprojectionError", "reconstruction_uncertainty": "ReconstructionUncertainty",
+                   "projection_accuracy": "ProjectionAccuracy"}
+
+
+def vector_or_nan(vector, size = 3):
+    return [vector[i] for i in range(size)] if vector is not None else [np.nan] * size
+
+
+def world_location(chunk, position):
+    ''' converts a position in internal coordinates to the chunk coordinate system, or NaN if the chunk is not referenced '''
+    if position is None or chunk.transform.matrix is None:
+        return [np.nan] * 3
+    point = chunk.transform.matrix.mulp(position)
+    if chunk.crs:
+        point = chunk.crs.project(point)
+    return vector_or_nan(point)
+
+
+def sensor_columns(chunk):
+    columns = {"label": [], "type": [], "width": [], "height": []}
+    columns.update({term: [] for term in CALIBRATION_TERMS})
+    for sensor in chunk.sensors:
+        calib = sensor.calibration
+        columns["label"].append(sensor.label)
+        columns["type"].append(str(sensor.type).split(".")[-1])
+        columns["width"].append(sensor.width)
+        columns["height"].append(sensor.height)
+        for term in CALIBRATION_TERMS:
+            columns[term].append(float(getattr(calib, term, 0) or 0) if calib else np.nan)
+    columns = {name: np.array(values) for name, values in columns.items()}
+    columns["type"] = columns["type"].astype(str)
+    columns["label"] = columns["label"].astype(str)
+    return columns
+
+
+def tie_point_columns(chunk):
+    ''' reads every tie point once, and Metashape's per-point quality metrics in bulk '''
+    points = chunk.tie_points.points
+    count = len(points)
+    coords = np.full((count, 3), np.nan)
+    track_ids = np.zeros(count, dtype = np.int64)
+    valid = np.zeros(count, dtype = bool)
+    for index, point in enumerate(points):
+        coord = point.coord
+        coords[index] = [coord[0] / coord[3], coord[1] / coord[3], coord[2] / coord[3]]
+        track_ids[index] = point.track_id
+        valid[index] = point.valid
+    columns = {"coord": coords, "track_id": track_ids, "valid": valid}
+    for name, criterion in FILTER_CRITERIA.items():
+        try:
+            selection = Metashape.TiePoints.Filter()
+            selection.init(chunk, criterion = getattr(Metashape.TiePoints.Filter, criterion))
+            columns[name] = np.array(selection.values, dtype = np.float32)
+        except Exception as e:
+            print("Unable to compute " + name + ": " + str(e))
+    return columns
+
+
+def camera_and_point_errors(chunk, sensors, tie_points):
+    '''
+    Projects each aligned frame camera's tie points with its calibration and compares them with the observed
+    projections. Returns per-camera RMS error and projection count, and per-point mean error and camera count.
+    '''
+    track_to_point = np.full(len(chunk.tie_points.tracks), -1, dtype = np.int64)
+    valid_points = np.flatnonzero(tie_points["valid"])
+    track_to_point[tie_points["track_id"][valid_points]] = valid_points
+    sensor_index = {sensor.key: index for index, sensor in enumerate(chunk.sensors)}
+
+    camera_rms = np.full(len(chunk.cameras), np.nan)
+    camera_projections = np.zeros(len(chunk.cameras), dtype = np.int64)
+    point_error = np.zeros(len(tie_points["valid"]))
+    point_cameras = np.zeros(len(tie_points["valid"]), dtype = np.int64)
+    projections = chunk.tie_points.projections
+    for index, camera in enumerate(chunk.cameras):
+        if not camera.transform or camera.sensor is None:
+            continue
+        observed = projections[camera]
+        if not observed:
+            continue
+        pixels = np.array([[projection.coord[0], projection.coord[1]] for projection in observed])
+        points = track_to_point[np.array([projection.track_id for projection in observed])]
+        keep = points >= 0
+        camera_projections[index] = int(keep.sum())
+        if str(camera.sensor.type).split(".")[-1] != "Frame" or not keep.any():
+            continue
+        transform = matrix_to_numpy(camera.transform)
+        local = (tie_points["coord"][points[keep]] - transform[:3, 3]) @ np.linalg.inv(transform[:3, :3]).T
+        calibration = {name: values[sensor_index[camera.sensor.key]] for name, values in sensors.items() if name not in ["label", "type"]}
+        errors = np.linalg.norm(project_frame(local, calibration) - pixels[keep], axis = 1)
+        camera_rms[index] = float(np.sqrt(np.nanmean(errors ** 2)))
+        np.add.at(point_error, points[keep], np.nan_to_num(errors))
+        np.add.at(point_cameras, points[keep], 1)
+    mean_error = np.where(point_cameras > 0, point_error / np.maximum(point_cameras, 1), np.nan).astype(np.float32)
+    return camera_rms, camera_projections, mean_error, point_cameras
+
+
+def camera_columns(chunk):
+    sensor_index = {sensor.key: index for index, sensor in enumerate(chunk.sensors)}
+    transforms = np.array([matrix_to_numpy(camera.transform) if camera.transform else np.full((4, 4), np.nan) for camera in chunk.cameras]).reshape(-1, 4, 4)
+    source = np.array([vector_or_nan(camera.reference.location) for camera in chunk.cameras]).reshape(-1, 3)
+    estimated = np.array([world_location(chunk, camera.center) for camera in chunk.cameras]).reshape(-1, 3)
+    return {"label": np.array([camera.label for camera in chunk.cameras], dtype = str),
+            "key": np.array([camera.key for camera in chunk.cameras], dtype = np.int64),
+            "enabled": np.array([camera.enabled for camera in chunk.cameras], dtype = bool),
+            "aligned": np.array([camera.transform is not None for camera in chunk.cameras], dtype = bool),
+            "sensor": np.array([sensor_index.get(camera.sensor.key, -1) if camera.sensor else -1 for camera in chunk.cameras], dtype = np.int64),
+            "transform": transforms, "center": transforms[:, :3, 3],
+            "location_source": source, "location_estimated": estimated, "location_error": estimated - source}
+
+
+def marker_columns(chunk):
+    pixel_rms = []
+    for marker in chunk.markers:
+        errors = []
+        if marker.position is not None:
+            for camera, projection in marker.projections.items():
+                if camera.transform:
+                    estimate = camera.project(marker.position)
+                    if estimate is not None:
+                        errors.append((estimate - projection.coord).norm() ** 2)
+        pixel_rms.append(float(np.sqrt(np.mean(errors))) if errors else np.nan)
+    source = np.array([vector_or_nan(marker.reference.location) for marker in chunk.markers]).reshape(-1, 3)
+    estimated = np.array([world_location(chunk, marker.position) for marker in chunk.markers]).reshape(-1, 3)
+    return {"label": np.array([marker.label for marker in chunk.markers], dtype = str),
+            "key": np.array([marker.key for marker in chunk.markers], dtype = np.int64),
+            "enabled": np.array([marker.reference.enabled for marker in chunk.markers], dtype = bool),
+            "position": np.array([vector_or_nan(marker.position) for marker in chunk.markers]).reshape(-1, 3),
+            "location_source": source, "location_estimated": estimated, "location_error": estimated - source,
+            "projection_count": np.array([len(marker.projections.keys()) for marker in chunk.markers], dtype = np.int64),
+            "pixel_rms": np.array(pixel_rms)}
+
+
+def export_chunk_arrays(chunk, folder):
+    ''' writes the chunk tables to folder and returns the manifest '''
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    manifest = {"chunk": chunk.label, "chunk_key": chunk.key, "project": Metashape.app.document.path,
+                "created": datetime.now().isoformat(timespec = "seconds"),
+                "crs_wkt": chunk.crs.wkt if chunk.crs else None,
+                "chunk_transform": matrix_to_numpy(chunk.transform.matrix).tolist() if chunk.transform.matrix is not None else None}
+
+    sensors = sensor_columns(chunk)
+    write_table(folder, "sensors", sensors, manifest)
+    cameras = camera_columns(chunk)
+    markers = marker_columns(chunk)
+    write_table(folder, "markers", markers, manifest)
+    if chunk.tie_points:
+        tie_points = tie_point_columns(chunk)
+        cameras["reprojection_rms"], cameras["projection_count"], tie_points["reprojection_error"], tie_points["camera_count"] = \
+            camera_and_point_errors(chunk, sensors, tie_points)
+        write_table(folder, "tie_points", tie_points, manifest)
+    write_table(folder, "cameras", cameras, manifest)
+    write_manifest(folder, manifest)
+    return manifest
+
+
+def export_arrays():
+    doc = Metashape.app.document
+    chunk = doc.chunk
+    if not chunk:
+        Metashape.app.messageBox("No active chunk.")
+        return
+    output_dir = Metashape.app.getExistingDirectory("Select the folder to save the chunk data arrays to")
+    if not output_dir:
+        return
+    project_name = os.path.splitext(os.path.basename(doc.path))[0] if doc.path else "project"
+    folder = os.path.join(output_dir, project_name + "_" + chunk.label + "_arrays")
+    print("Exporting chunk data arrays...")
+    manifest = export_chunk_arrays(chunk, folder)
+    summary = ", ".join(table + ": " + str(columns["label" if "label" in columns else "coord"]["shape"][0]) + " rows"
+                        for table, columns in manifest["tables"].items())
+    print(" --- Chunk data arrays exported to " + folder + " (" + summary + ") --- ")
+    Metashape.app.messageBox("Chunk data arrays exported to:\n" + folder + "\n\n" + summary)
+
+
+label = "ReefShape/Tools/Export Chunk Data Arrays"
+Metashape.app.removeMenuItem(label)
+Metashape.app.addMenuItem(label, export_arrays)
+print("To execute this script press {}".format(label))
@@ -0,0 +1,283 @@
+'''
+Align All Timepoints
+Perry Institute for Marine Science
+
+This script aligns every unprocessed chunk of a project to a processed reference chunk in one go, instead of running
+the Align Timepoints dialog (02_align_chunks.py) once per chunk, and can then process each chunk with the Full ReefShape
+Workflow straight after it is aligned. The chunks are queued in chronological order (by the YYYYMMDD date in their
+labels), and a chunk that fails is skipped so the rest of the queue still runs, leaving the computer to work unattended.
+
+The reference chunk can be chosen, or detected automatically as the earliest processed chunk with referenced markers.
+It can also be in another project (opened read-only), or given as a reference marker file saved from one, so each time
+point can be kept in a project of its own (see timeseries_tools.py).
+Processing uses the settings last used in the Full ReefShape Workflow dialog (processing mode, resolution, exports and
+coordinate system), so run that dialog once on the reference chunk first. Products are exported to the project folder.
+
+Usage:
+    - In Metashape: ReefShape/Align All Timepoints
+    - Headless, e.g. overnight on a processing computer:
+        metashape -platform offscreen -r 13_align_all_timepoints.py <project>.psx [--reference <chunk label>]
+                  [--reference-project <project>.psx | <reference markers>.json] [--target-type "Circular Target 12 Bit"]
+                  [--damaged <marker label> ...] [--no-process]
+'''
+
+import Metashape
+import os
+import sys
+import importlib
+
+sys.path.append(os.path.dirname(os.path.abspath(sys.argv[0] if sys.argv and sys.argv[0] else __file__)))
+from PySide2 import QtGui, QtCore, QtWidgets
+from timeseries_tools import TARGET_TYPES, chronological, find_reference_chunk, pending_chunks, align_timepoints, chunk_reference, external_reference, open_reference_project
+
+
+def workflow_processor():
+    '''
+    Returns a function that runs the Full ReefShape Workflow on a chunk with the saved dialog settings, without
+    showing the dialog or waiting on message boxes, and returns the processing mode for the chunk's status.
+    Raises ValueError if the saved processing mode is Field Preview, which only exports a preview from a temporary
+    chunk and would leave every chunk unprocessed
+    '''
+    workflow = importlib.import_module("01_full_reefshape_workflow")
+    dlg = workflow.FullWorkflowDlg(None, unattended = True)
+    mode_label, mode = dlg.processingModes[dlg.comboProcessingMode.currentIndex()]
+    if(mode == "preview"):
+        raise ValueError("The Full ReefShape Workflow was last run in " + mode_label + " mode, which does not process the chunks. "
+                         "Select another processing mode in the workflow dialog and run it once on the reference chunk, or align the chunks without processing.")
+    def process(chunk):
+        dlg.runWorkFlow() # works on the document's active chunk
+        return mode_label
+    return process
+
+
+def summary(results):
+    return "\n".join(label + ": " + status for label, status in results)
+
+
+class AlignAllTimepointsDlg(QtWidgets.QDialog):
+    def __init__(self, parent):
+        QtWidgets.QDialog.__init__(self, parent)
+        self.setWindowModality(QtCore.Qt.ApplicationModal)
+        self.setWindowTitle("Align All Timepoints")
+        self.setMinimumWidth(450)
+        self.doc = Metashape.app.document
+        self.settings = QtCore.QSettings("ReefShape", "UnderwaterWorkflow")
+        self.external = None # reference from another project or a reference marker file
+
+        # reference chunk - the first entry detects it automatically
+        self.labelRefChunk = QtWidgets.QLabel("Reference Chunk:")
+        self.comboRefChunk = QtWidgets.QComboBox()
+        self.comboRefChunk.addItem("Auto-detect (earliest processed chunk)")
+        for chunk in self.doc.chunks:
+            self.comboRefChunk.addItem(chunk.label)
+        self.btnRefProject = QtWidgets.QPushButton("Other Project...")
+        self.btnRefProject.setToolTip("Use a chunk from another project, or a reference marker file, as the reference")
+        ref_chunk_layout = QtWidgets.QHBoxLayout()
+        ref_chunk_layout.addWidget(self.labelRefChunk)
+        ref_chunk_layout.addWidget(self.comboRefChunk)
+        ref_chunk_layout.addWidget(self.btnRefProject)
+
+        # chunks to align - every unprocessed chunk is checked by default
+        self.labelChunks = QtWidgets.QLabel("Chunks to Align:")
+        self.listChunks = QtWidgets.QListWidget()
+
+        self.labelTargetType = QtWidgets.QLabel("Target Type:")
+        self.comboTargetType = QtWidgets.QComboBox()
+        for target_type in TARGET_TYPES:
+            self.comboTargetType.addItem(target_type[0])
+        target_type_layout = QtWidgets.QHBoxLayout()
+        target_type_layout.addWidget(self.labelTargetType)
+        target_type_layout.addWidget(self.comboTargetType)
+
+        self.labelDamagedMarkers = QtWidgets.QLabel("Damaged Markers:")
+        self.txtDamagedMarkers = QtWidgets.QLineEdit()
+        self.txtDamagedMarkers.setPlaceholderText("Marker labels, separated by commas")
+        damaged_marker_layout = QtWidgets.QHBoxLayout()
+        damaged_marker_layout.addWidget(self.labelDamagedMarkers)
+        damaged_marker_layout.addWidget(self.txtDamagedMarkers)
+
+        self.checkBoxProcess = QtWidgets.QCheckBox("Process Each Chunk After Aligning")
+        self.checkBoxProcess.setToolTip("Runs the Full ReefShape Workflow on each chunk straight after it is aligned, "
+                                        "with the settings last used in the workflow dialog")
+
+        self.btnOk = QtWidgets.QPushButton("Ok")
+        self.btnOk.setFixedSize(70, 40)
+        self.btnOk.setToolTip("Align the checked chunks")
+        self.btnClose = QtWidgets.QPushButton("Close")
+        self.btnClose.setFixedSize(70, 40)
+        ok_layout = QtWidgets.QHBoxLayout()
+        ok_layout.addWidget(self.btnOk)
+        ok_layout.addWidget(self.btnClose)
+
+        main_layout = QtWidgets.QVBoxLayout()
+        main_layout.addLayout(ref_chunk_layout)
+        main_layout.addWidget(self.labelChunks)
+        main_layout.addWidget(self.listChunks)
+        main_layout.addLayout(target_type_layout)
+        main_layout.addLayout(damaged_marker_layout)
+        main_layout.addWidget(self.checkBoxProcess)
+        main_layout.addLayout(ok_layout)
+        self.setLayout(main_layout)
+
+        self.comboTargetType.setCurrentIndex(self.settings.value("batchAlignTargetType", 0, type=int))
+        self.checkBoxProcess.setChecked(self.settings.value("batchAlignProcess", True, type=bool))
+        self.updateChunkList()
+
+        self.comboRefChunk.currentIndexChanged.connect(self.updateChunkList)
+        self.btnRefProject.clicked.connect(self.getReferenceProject)
+        self.btnOk.clicked.connect(self.alignAll)
+        QtCore.QObject.connect(self.btnClose, QtCore.SIGNAL("clicked()"), self, QtCore.SLOT("reject()"))
+
+        self.exec()
+
+    def referenceChunk(self):
+        ''' the selected reference chunk in this project, or None for an external reference '''
+        if(self.comboRefChunk.currentIndex() == 0):
+            return find_reference_chunk(self.doc)
+        if(self.comboRefChunk.currentIndex() > len(self.doc.chunks)):
+            return None
+        return self.doc.chunks[self.comboRefChunk.currentIndex() - 1]
+
+    def reference(self):
+        ''' the selected reference (see timeseries_tools.chunk_reference()), or None if there is none '''
+        if(self.comboRefChunk.currentIndex() > len(self.doc.chunks)):
+            return self.external
+        reference_chunk = self.referenceChunk()
+        return chunk_reference(reference_chunk) if reference_chunk is not None else None
+
+    def getReferenceProject(self):
+        '''
+        Slot: selects a reference chunk in another project (opened read-only) or a reference marker file
+        '''
+        path, _ = QtWidgets.QFileDialog.getOpenFileName(self, "Select Reference Project", os.path.dirname(self.doc.path),
+                                                        "Metashape Project or Reference Markers (*.psx *.json)")
+        if(not path):
+            return
+        try:
+            label = None
+            if(path.lower().endswith(".psx")):
+                reference_doc = open_reference_project(path)
+                labels = [chunk.label for chunk in reference_doc.chunks]
+                default_chunk = find_reference_chunk(reference_doc)
+                label, ok = QtWidgets.QInputDialog.getItem(self, "Reference Chunk", "Select the reference chunk:", labels,
+                                                           labels.index(default_chunk.label) if default_chunk else 0, False)
+                if(not ok):
+                    return
+            self.external = external_reference(path, label)
+        except Exception as e:
+            Metashape.app.messageBox("Unable to use " + path + " as the reference:\n" + str(e))
+            return
+        if(self.comboRefChunk.count() > len(self.doc.chunks) + 1):
+            self.comboRefChunk.removeItem(self.comboRefChunk.count() - 1)
+        self.comboRefChunk.addItem(self.external["chunk"] + " (" + os.path.basename(path) + ")")
+        self.comboRefChunk.setCurrentIndex(self.comboRefChunk.count() - 1)
+
+    def updateChunkList(self):
+        '''
+        Slot: lists the chunks that can be aligned to the selected reference chunk, checking the unprocessed ones
+        '''
+        self.listChunks.clear()
+        reference_chunk = self.referenceChunk()
+        if(reference_chunk is None and self.reference() is None):
+            return
+        pending = [chunk.key for chunk in pending_chunks(self.doc, reference_chunk)]
+        for chunk in self.doc.chunks:
+            if(reference_chunk is not None and chunk.key == reference_chunk.key):
+                continue
+            item = QtWidgets.QListWidgetItem(chunk.label)
+            item.setData(QtCore.Qt.UserRole, chunk.key)
+            item.setCheckState(QtCore.Qt.Checked if chunk.key in pending else QtCore.Qt.Unchecked)
+            self.listChunks.addItem(item)
+
+    def alignAll(self):
+        '''
+        Contains main workflow
+        '''
+        try:
+            reference = self.reference()
+        except Exception as e:
+            Metashape.app.messageBox("Unable to use the selected reference chunk: " + str(e))
+            return
+        if(reference is None):
+            Metashape.app.messageBox("No processed chunk with referenced markers was found. Process the first time point, or select the reference chunk.")
+            return
+        keys = [self.listChunks.item(i).data(QtCore.Qt.UserRole) for i in range(self.listChunks.count())
+                if self.listChunks.item(i).checkState() == QtCore.Qt.Checked]
+        chunks = chronological([chunk for chunk in self.doc.chunks if chunk.key in keys])
+        if(not chunks):
+            Metashape.app.messageBox("No chunks selected to align.")
+            return
+        self.settings.setValue("batchAlignTargetType", self.comboTargetType.currentIndex())
+        self.settings.setValue("batchAlignProcess", self.checkBoxProcess.isChecked())
+
+        try:
+            process = workflow_processor() if self.checkBoxProcess.isChecked() else None
+        except ValueError as e:
+            Metashape.app.messageBox(str(e))
+            return
+
+        print("Script started...")
+        self.setEnabled(False)
+        damaged_markers = [label.strip() for label in self.txtDamagedMarkers.text().split(",") if label.strip()]
+        results = align_timepoints(self.doc, reference, chunks, TARGET_TYPES[self.comboTargetType.currentIndex()][1],
+                                   damaged_markers, process)
+        Metashape.app.update()
+        print("Script finished")
+        Metashape.app.messageBox("Time points aligned to " + reference["chunk"] + ":\n\n" + summary(results))
+        self.reject()
+
+    # END CLASS AlignAllTimepointsDlg
+
+
+def run_headless(args):
+    import argparse
+    parser = argparse.ArgumentParser(description = "Align every unprocessed chunk of a ReefShape project to a reference chunk")
+    parser.add_argument("project", help = "Metashape project (.psx)")
+    parser.add_argument("--reference", help = "label of the reference chunk (default: earliest processed chunk with referenced markers)")
+    parser.add_argument("--reference-project", help = "project (.psx) holding the reference chunk, or a reference marker file (.json), if it is not in this project")
+    parser.add_argument("--target-type", default = TARGET_TYPES[0][0], choices = [name for name, _ in TARGET_TYPES])
+    parser.add_argument("--damaged", nargs = "*", default = [], help = "labels of damaged markers")
+    parser.add_argument("--no-process", action = "store_true", help = "only align the chunks, without running the workflow")
+    args = parser.parse_args(args)
+
+    doc = Metashape.app.document
+    doc.open(args.project)
+    reference_chunk = None
+    if(args.reference_project):
+        reference = external_reference(args.reference_project, args.reference)
+    else:
+        if(args.reference):
+            reference_chunk = next((chunk for chunk in doc.chunks if chunk.label == args.reference), None)
+        else:
+            reference_chunk = find_reference_chunk(doc)
+        if(reference_chunk is None):
+            print("No reference chunk found")
+            return
+        reference = chunk_reference(reference_chunk)
+    process = None if args.no_process else workflow_processor() # refuses Field Preview before anything is aligned
+    chunks = pending_chunks(doc, reference_chunk)
+    print("Aligning " + ", ".join(chunk.label for chunk in chunks) + " to " + reference["chunk"])
+    results = align_timepoints(doc, reference, chunks, dict(TARGET_TYPES)[args.target_type], args.damaged, process)
+    print(summary(results))
+
+
+def run_script():
+    try:
+        app = QtWidgets.QApplication.instance()
+        parent = app.activeWindow()
+        dlg = AlignAllTimepointsDlg(parent)
+    except Exception as e:
+        QtWidgets.QMessageBox.critical(None, "Error", str(e))
+
+
+if len(sys.argv) > 1 and os.path.basename(sys.argv[0]) == "13_align_all_timepoints.py":
+    try:
+        run_headless(sys.argv[1:])
+    except Exception as e:
+        print("Batch alignment failed: " + str(e))
+    Metashape.app.quit()
+else:
+    label = "ReefShape/Align All Timepoints"
+    Metashape.app.removeMenuItem(label)
+    Metashape.app.addMenuItem(label, run_script)
+    print("To execute this script press {}".format(label))
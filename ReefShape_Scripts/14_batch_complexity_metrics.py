@@ -0,0 +1,320 @@
+'''
+Batch Structural Complexity Metrics
+Perry Institute for Marine Science
+
+This script computes structural complexity metrics for every chunk of a set of projects (e.g. all the plots of a
+survey campaign) and writes them to one table, instead of running the surface area ratio tool on each chunk by hand.
+For each chunk with an outer boundary shape it computes, inside the boundary:
+    - the 3D/2D surface area ratio, from the 3D model (see 07_calculate_area_ratio.py)
+    - DEM rugosity, vector ruggedness measure (VRM), fractal dimension (height range method) and height range, from
+    the DEM exported over the window of the boundary only (see complexity_tools.py)
+
+The projects are opened read-only, so they must be saved first. Several projects are processed at the same time,
+each in its own headless Metashape process (as the workflow does for exports), and a project whose worker fails is
+processed again in this session. The table has one row per chunk (project, chunk, date from the chunk label, then
+the metrics, with areas in m2 and lengths in m) and a status column giving the reason for any missing metric.
+
+Usage:
+    - In Metashape: ReefShape/Tools/Batch Complexity Metrics
+    - Headless:
+        metashape -platform offscreen -r 14_batch_complexity_metrics.py <campaign folder or projects.psx ...>
+                  [--output <table>.csv] [--resolution <m>] [--no-mesh] [--processes 2]
+'''
+
+import Metashape
+import os
+import sys
+import csv
+import glob
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.dirname(os.path.abspath(sys.argv[0] if sys.argv and sys.argv[0] else __file__)))
+from PySide2 import QtGui, QtCore, QtWidgets
+from complexity_tools import project_metrics, METRIC_COLUMNS
+from export_tools import metashape_executable
+
+SCRIPT_NAME = "14_batch_complexity_metrics.py"
+
+
+def find_projects(paths):
+    ''' returns the projects (.psx) given, and those in the folders given (searched recursively), in order '''
+    projects = []
+    for path in paths:
+        if os.path.isdir(path):
+            projects.extend(sorted(glob.glob(os.path.join(path, "**", "*.psx"), recursive = True)))
+        elif path.lower().endswith(".psx"):
+            projects.append(path)
+    return projects
+
+
+def run_worker(project_path, resolution, use_mesh, temp_dir, index, executable):
+    '''
+    Computes the metrics of one project in a separate Metashape process - called on a pool thread. Returns the rows,
+    or None if the worker failed, and the path of its log.
+    '''
+    job_path = os.path.join(temp_dir, "metrics_" + str(index) + ".json")
+    log_path = os.path.join(temp_dir, "metrics_" + str(index) + ".log")
+    with open(job_path, 'w') as f:
+        json.dump({"project_path": project_path, "resolution": resolution, "use_mesh": use_mesh}, f)
+    with open(log_path, 'w') as log:
+        subprocess.run([executable, "-platform", "offscreen", "-r", os.path.abspath(__file__), "--worker", job_path],
+                       stdout = log, stderr = subprocess.STDOUT)
+    # the worker writes the rows next to the job file once it has finished without errors
+    if not os.path.exists(job_path + ".done"):
+        return None, log_path
+    with open(job_path + ".done") as f:
+        return json.load(f), log_path
+
+
+def batch_metrics(projects, output_path, resolution = None, use_mesh = True, processes = 2):
+    '''
+    Computes the metrics of every chunk of the projects, up to processes projects at a time in headless Metashape
+    processes (or one after another in this session with processes of 1, or if Metashape cannot be found), and writes
+    them to output_path. Returns the rows.
+    '''
+    start = time.perf_counter()
+    executable = metashape_executable() if processes > 1 else None
+    results = [None] * len(projects)
+    if executable:
+        temp_dir = tempfile.mkdtemp(prefix = "reefshape_metrics_")
+        failed = True
+        try:
+            with ThreadPoolExecutor(max_workers = processes) as pool:
+                futures = [pool.submit(run_worker, project, resolution, use_mesh, temp_dir, index, executable)
+                           for index, project in enumerate(projects)]
+                for index, future in enumerate(futures):
+                    results[index], log_path = future.result()
+                    if results[index] is None:
+                        print("Metrics worker failed for " + projects[index] + " (see " + log_path + "), computing in this session instead")
+            failed = any(result is None for result in results)
+        finally:
+            # the worker logs are kept for inspection if any worker failed
+            if failed:
+                print("Metrics worker logs kept in " + temp_dir)
+            else:
+                shutil.rmtree(temp_dir, ignore_errors = True)
+    for index, project in enumerate(projects):
+        if results[index] is None:
+            try:
+                results[index] = project_metrics(project, resolution, use_mesh)
+            except Exception as e:
+                results[index] = [{"project": project, "status": "failed: " + str(e)}]
+
+    rows = [row for project_rows in results for row in project_rows]
+    with open(output_path, 'w', newline = '') as f:
+        writer = csv.DictWriter(f, fieldnames = METRIC_COLUMNS, extrasaction = 'ignore')
+        writer.writeheader()
+        for row in rows:
+            # metrics that could not be computed (NaN) are left empty
+            writer.writerow({key: ("{:.6g}".format(value) if value == value else "") if isinstance(value, float) else value
+                             for key, value in row.items()})
+    print(" --- Complexity metrics of {} chunks in {} projects written to {} in {:.0f} s --- ".format(
+          len(rows), len(projects), output_path, time.perf_counter() - start))
+    return rows
+
+
+class BatchMetricsDlg(QtWidgets.QDialog):
+    def __init__(self, parent):
+        QtWidgets.QDialog.__init__(self, parent)
+        self.setWindowModality(QtCore.Qt.ApplicationModal)
+        self.setWindowTitle("Batch Complexity Metrics")
+        self.setMinimumWidth(500)
+        self.settings = QtCore.QSettings("ReefShape", "UnderwaterWorkflow")
+
+        self.labelProjects = QtWidgets.QLabel("Projects:")
+        self.listProjects = QtWidgets.QListWidget()
+        self.btnAddFolder = QtWidgets.QPushButton("Add Folder...")
+        self.btnAddFolder.setToolTip("Add every project in a folder and its subfolders, e.g. a survey campaign")
+        self.btnAddProjects = QtWidgets.QPushButton("Add Projects...")
+        self.btnRemove = QtWidgets.QPushButton("Remove")
+        project_button_layout = QtWidgets.QHBoxLayout()
+        project_button_layout.addWidget(self.btnAddFolder)
+        project_button_layout.addWidget(self.btnAddProjects)
+        project_button_layout.addWidget(self.btnRemove)
+
+        self.labelOutput = QtWidgets.QLabel("Output Table:")
+        self.txtOutput = QtWidgets.QLineEdit()
+        self.btnOutput = QtWidgets.QPushButton("...")
+        self.btnOutput.setFixedSize(30, 25)
+        output_layout = QtWidgets.QHBoxLayout()
+        output_layout.addWidget(self.labelOutput)
+        output_layout.addWidget(self.txtOutput)
+        output_layout.addWidget(self.btnOutput)
+
+        self.labelResolution = QtWidgets.QLabel("DEM Resolution (m):")
+        self.spinboxResolution = QtWidgets.QDoubleSpinBox()
+        self.spinboxResolution.setDecimals(4)
+        self.spinboxResolution.setRange(0, 1)
+        self.spinboxResolution.setSingleStep(0.001)
+        self.spinboxResolution.setSpecialValueText("DEM resolution")
+        self.spinboxResolution.setToolTip("Cell size the DEM metrics are computed at - use the same value for every plot to compare them")
+        resolution_layout = QtWidgets.QHBoxLayout()
+        resolution_layout.addWidget(self.labelResolution)
+        resolution_layout.addWidget(self.spinboxResolution)
+
+        self.labelProcesses = QtWidgets.QLabel("Projects at Once:")
+        self.spinboxProcesses = QtWidgets.QSpinBox()
+        self.spinboxProcesses.setRange(1, 16)
+        self.spinboxProcesses.setToolTip("Number of projects processed at the same time, each in its own Metashape process")
+        processes_layout = QtWidgets.QHBoxLayout()
+        processes_layout.addWidget(self.labelProcesses)
+        processes_layout.addWidget(self.spinboxProcesses)
+
+        self.checkBoxMesh = QtWidgets.QCheckBox("Surface Area Ratio from 3D Models")
+        self.checkBoxMesh.setToolTip("Reads every face of each model - untick to compute the DEM metrics only")
+
+        self.btnOk = QtWidgets.QPushButton("Ok")
+        self.btnOk.setFixedSize(70, 40)
+        self.btnOk.setToolTip("Compute the metrics of every chunk of the listed projects")
+        self.btnClose = QtWidgets.QPushButton("Close")
+        self.btnClose.setFixedSize(70, 40)
+        ok_layout = QtWidgets.QHBoxLayout()
+        ok_layout.addWidget(self.btnOk)
+        ok_layout.addWidget(self.btnClose)
+
+        main_layout = QtWidgets.QVBoxLayout()
+        main_layout.addWidget(self.labelProjects)
+        main_layout.addWidget(self.listProjects)
+        main_layout.addLayout(project_button_layout)
+        main_layout.addLayout(output_layout)
+        main_layout.addLayout(resolution_layout)
+        main_layout.addLayout(processes_layout)
+        main_layout.addWidget(self.checkBoxMesh)
+        main_layout.addLayout(ok_layout)
+        self.setLayout(main_layout)
+
+        self.spinboxResolution.setValue(self.settings.value("metricsResolution", 0, type=float))
+        self.spinboxProcesses.setValue(self.settings.value("metricsProcesses", 2, type=int))
+        self.checkBoxMesh.setChecked(self.settings.value("metricsUseMesh", True, type=bool))
+        if(Metashape.app.document.path):
+            self.addProjects([Metashape.app.document.path])
+
+        self.btnAddFolder.clicked.connect(self.addFolder)
+        self.btnAddProjects.clicked.connect(self.getProjects)
+        self.btnRemove.clicked.connect(self.removeProjects)
+        self.btnOutput.clicked.connect(self.getOutputPath)
+        self.btnOk.clicked.connect(self.computeMetrics)
+        QtCore.QObject.connect(self.btnClose, QtCore.SIGNAL("clicked()"), self, QtCore.SLOT("reject()"))
+
+        self.exec()
+
+    def addProjects(self, projects):
+        listed = [self.listProjects.item(i).text() for i in range(self.listProjects.count())]
+        for project in projects:
+            if(project not in listed):
+                self.listProjects.addItem(project)
+        # the table goes next to the first project's folder by default, named after it
+        if(not self.txtOutput.text() and self.listProjects.count() > 0):
+            folder = os.path.dirname(self.listProjects.item(0).text())
+            self.txtOutput.setText(os.path.join(folder, os.path.basename(folder) + "_complexity_metrics.csv"))
+
+    def addFolder(self):
+        folder = QtWidgets.QFileDialog.getExistingDirectory(self, "Select Campaign Folder")
+        if(folder):
+            projects = find_projects([folder])
+            if(not projects):
+                Metashape.app.messageBox("No projects found in " + folder)
+            if(not self.txtOutput.text()):
+                self.txtOutput.setText(os.path.join(folder, os.path.basename(folder) + "_complexity_metrics.csv"))
+            self.addProjects(projects)
+
+    def getProjects(self):
+        projects, _ = QtWidgets.QFileDialog.getOpenFileNames(self, "Select Projects", "", "Metashape Projects (*.psx)")
+        self.addProjects(projects)
+
+    def removeProjects(self):
+        for item in self.listProjects.selectedItems():
+            self.listProjects.takeItem(self.listProjects.row(item))
+
+    def getOutputPath(self):
+        path, _ = QtWidgets.QFileDialog.getSaveFileName(self, "Save Metrics Table", self.txtOutput.text(), "CSV Files (*.csv)")
+        if(path):
+            self.txtOutput.setText(path)
+
+    def computeMetrics(self):
+        projects = [self.listProjects.item(i).text() for i in range(self.listProjects.count())]
+        output_path = self.txtOutput.text()
+        if(not projects or not output_path):
+            Metashape.app.messageBox("Add the projects to measure and choose the output table first.")
+            return
+        doc = Metashape.app.document
+        if(doc.path in projects and doc.modified):
+            Metashape.app.messageBox("Save the open project first - projects are read from disk.")
+            return
+        self.settings.setValue("metricsResolution", self.spinboxResolution.value())
+        self.settings.setValue("metricsProcesses", self.spinboxProcesses.value())
+        self.settings.setValue("metricsUseMesh", self.checkBoxMesh.isChecked())
+
+        print("Script started...")
+        self.setEnabled(False)
+        try:
+            rows = batch_metrics(projects, output_path, self.spinboxResolution.value() or None, self.checkBoxMesh.isChecked(),
+                                 self.spinboxProcesses.value())
+        except Exception as e:
+            Metashape.app.messageBox("Unable to compute the metrics: " + str(e))
+            self.setEnabled(True)
+            return
+        print("Script finished")
+        problems = [row["chunk"] if "chunk" in row else row["project"] for row in rows if row["status"] != "ok"]
+        Metashape.app.messageBox("Metrics of {} chunks saved to:\n{}".format(len(rows), output_path) +
+                                 ("\n\nSome metrics are missing for: " + ", ".join(problems) + " (see the status column)" if problems else ""))
+        self.reject()
+
+    # END CLASS BatchMetricsDlg
+
+
+def run_headless(args):
+    import argparse
+    parser = argparse.ArgumentParser(description = "Compute structural complexity metrics for every chunk of a set of ReefShape projects")
+    parser.add_argument("paths", nargs = "+", help = "projects (.psx), or folders to search for projects")
+    parser.add_argument("--output", help = "output table (default: <first folder>_complexity_metrics.csv in that folder)")
+    parser.add_argument("--resolution", type = float, help = "cell size of the DEM metrics in m (default: the DEM resolution)")
+    parser.add_argument("--no-mesh", action = "store_true", help = "skip the surface area ratio from the 3D models")
+    parser.add_argument("--processes", type = int, default = 2, help = "number of projects processed at the same time")
+    args = parser.parse_args(args)
+
+    projects = find_projects(args.paths)
+    if(not projects):
+        print("No projects found")
+        return
+    folder = args.paths[0] if os.path.isdir(args.paths[0]) else os.path.dirname(os.path.abspath(projects[0]))
+    output_path = args.output or os.path.join(folder, os.path.basename(os.path.normpath(folder)) + "_complexity_metrics.csv")
+    batch_metrics(projects, output_path, args.resolution, not args.no_mesh, args.processes)
+
+
+def run_worker_job(job_path):
+    with open(job_path) as f:
+        job = json.load(f)
+    rows = project_metrics(job["project_path"], job["resolution"], job["use_mesh"])
+    with open(job_path + ".done", 'w') as f:
+        json.dump(rows, f)
+
+
+def run_script():
+    try:
+        app = QtWidgets.QApplication.instance()
+        parent = app.activeWindow()
+        dlg = BatchMetricsDlg(parent)
+    except Exception as e:
+        QtWidgets.QMessageBox.critical(None, "Error", str(e))
+
+
+if len(sys.argv) > 1 and os.path.basename(sys.argv[0]) == SCRIPT_NAME:
+    try:
+        if(sys.argv[1] == "--worker"):
+            run_worker_job(sys.argv[2])
+        else:
+            run_headless(sys.argv[1:])
+    except Exception as e:
+        print("Complexity metrics failed: " + str(e))
+    Metashape.app.quit()
+else:
+    label = "ReefShape/Tools/Batch Complexity Metrics"
+    Metashape.app.removeMenuItem(label)
+    Metashape.app.addMenuItem(label, run_script)
+    print("To execute this script press {}".format(label))
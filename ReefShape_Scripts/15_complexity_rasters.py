@@ -0,0 +1,98 @@
+'''
+Gridded Complexity Rasters
+Perry Institute for Marine Science
+
+This script maps how structural complexity varies across a plot, rather than giving one value for the whole plot.
+From a DEM exported by the full workflow (<project>_<chunk>_DEM.tif) it writes GeoTIFF rasters at one or more cell
+sizes (e.g. 10 cm, 50 cm and 1 m) to a "complexity" folder next to the DEM, one per layer:
+    - surface_area_ratio: surface area of the DEM in each cell over its plan area
+    - slope: mean slope in degrees
+    - vrm: mean vector ruggedness measure
+    - height_range: highest minus lowest point in the cell
+Cell sizes are rounded to a whole number of DEM pixels. Cells less than half covered by the DEM are left as nodata.
+Compact (int16) DEMs are read with their scale and offset. The DEM must be in a projected (e.g. UTM) or local
+coordinate system in metres - DEMs in a geographic coordinate system such as the workflow's default WGS84 + EGM96
+are in degrees, and are refused.
+
+The DEM is read one block at a time and the blocks are computed in parallel, so DEMs of any size can be gridded
+without fitting them in memory. Outside Metashape the blocks run in separate processes; inside Metashape, whose
+Python cannot start them, they run on threads.
+
+Usage:
+    - In Metashape: ReefShape/Tools/Gridded Complexity Rasters, then choose the DEM and cell sizes.
+    - From any Python with GDAL and NumPy (Metashape not needed):
+        python 15_complexity_rasters.py <exported DEM .tif> <cell size in m> [<cell size in m> ...] [--processes 4]
+This script requires GDAL (see raster_tools.py).
+'''
+
+import os
+from raster_tools import gdal, require_gdal, complexity_rasters
+
+try:
+    import Metashape
+except ImportError:
+    Metashape = None
+
+COMPLEXITY_FOLDER = "complexity"
+DEFAULT_CELL_SIZES = "0.1, 0.5, 1"
+
+
+def grid_complexity(dem_path, cell_sizes, processes = os.cpu_count() or 1):
+    ''' writes the complexity rasters of an exported DEM at each cell size (m) and returns their paths '''
+    require_gdal()
+    if gdal.Open(dem_path).RasterCount != 1:
+        raise Exception(os.path.basename(dem_path) + " is not a DEM")
+    out_dir = os.path.join(os.path.dirname(os.path.abspath(dem_path)), COMPLEXITY_FOLDER)
+    outputs = []
+    for cell_size in cell_sizes:
+        print("Gridding " + os.path.basename(dem_path) + " into " + ("%g" % cell_size) + " m cells")
+        outputs.extend(complexity_rasters(dem_path, cell_size, out_dir, processes).values())
+    return outputs
+
+
+def workflow_dem_path():
+    ''' the DEM the full workflow exports for the active chunk (to the project folder by default), or an empty string '''
+    doc = Metashape.app.document
+    if not doc.path or not doc.chunk:
+        return ""
+    project_name = os.path.splitext(os.path.basename(doc.path))[0]
+    return os.path.join(os.path.dirname(doc.path), project_name + "_" + doc.chunk.label + "_DEM.tif")
+
+
+def complexity_dialog():
+    ''' asks for an exported DEM and cell sizes, and writes the rasters '''
+    try:
+        require_gdal()
+    except Exception as e:
+        Metashape.app.messageBox(str(e))
+        return
+    dem_path = workflow_dem_path()
+    path = Metashape.app.getOpenFileName("Select an exported DEM", dem_path if os.path.exists(dem_path) else "",
+                                         filter = "GeoTIFF (*.tif *.tiff)")
+    if not path:
+        return
+    cell_sizes = Metashape.app.getString("Cell sizes in metres, separated by commas:", DEFAULT_CELL_SIZES)
+    if not cell_sizes:
+        return
+    try:
+        outputs = grid_complexity(path, [float(cell_size) for cell_size in cell_sizes.split(",") if cell_size.strip()])
+    except Exception as e:
+        Metashape.app.messageBox("Unable to grid " + path + ":\n" + str(e))
+        return
+    Metashape.app.messageBox("Complexity rasters saved:\n" + "\n".join(outputs))
+
+
+if Metashape is not None:
+    label = "ReefShape/Tools/Gridded Complexity Rasters"
+    Metashape.app.removeMenuItem(label)
+    Metashape.app.addMenuItem(label, complexity_dialog)
+    print("To execute this script press {}".format(label))
+elif __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description = "Grid the structural complexity of an exported ReefShape DEM into GeoTIFF rasters")
+    parser.add_argument("dem", help = "exported DEM (.tif)")
+    parser.add_argument("cell_sizes", type = float, nargs = "+", help = "cell sizes in m (the DEM must be in a projected coordinate system in metres)")
+    parser.add_argument("--processes", type = int, default = os.cpu_count() or 1, help = "number of blocks computed at the same time")
+    args = parser.parse_args()
+    for path in grid_complexity(args.dem, args.cell_sizes, args.processes):
+        print(path)
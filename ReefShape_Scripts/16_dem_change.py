@@ -0,0 +1,189 @@
+'''
+DEM Change Detection
+Perry Institute for Marine Science
+
+This script measures growth and loss between time points of a plot from their DEMs, instead of differencing them by
+hand in a GIS. It takes the DEMs of two or more aligned time points exported by the full workflow, ordered by the dates
+their chunk labels start with (or in the order given on the command line), checks that they share a pixel grid (same
+coordinate system, resolution and pixel edges, as the boundary-windowed exports of time points aligned with
+02_align_chunks.py do), and for each pair of consecutive time points (and the first and last, with more than two) writes:
+    - a difference raster (later minus earlier, in m) to a "change" folder next to the later DEM
+    - a row of <last DEM>_change_summary.csv in that folder: net, gain and loss volumes (m3) and the areas of gain,
+    loss and compared cells (m2) inside the plot boundary
+
+Changes smaller than the minimum detectable change are not counted as gain or loss. By default it is 1.96 times the
+combined height uncertainty of the two DEMs, taken from the alignment QA of each time point (timeseries_alignment_qa.csv
+next to the DEMs - the spread of the height differences over stable areas, or the marker RMS without a DEM comparison),
+with the reference time point counted as exact. It can also be given directly.
+The DEMs must be in a projected (e.g. UTM) or local coordinate system in metres - DEMs in a geographic coordinate system
+such as the workflow's default WGS84 + EGM96 are in degrees, and are refused.
+The plot boundary is the boundary shapefile the workflow exports with the first DEM (<name>_boundary/<name>_boundary.shp),
+if present, or another given shapefile. The DEMs are differenced one block at a time, so they never need to fit in memory.
+
+Usage:
+    - In Metashape: ReefShape/Tools/DEM Change Detection, then choose the DEMs.
+    - From any Python with GDAL and NumPy (Metashape not needed):
+        python 16_dem_change.py <earlier DEM .tif> <later DEM .tif> [<later DEM .tif> ...] [--min-change <m>]
+                                [--boundary <shapefile>] [--qa <timeseries_alignment_qa.csv>]
+This script requires GDAL (see raster_tools.py).
+'''
+
+import os
+import re
+import csv
+import math
+from raster_tools import require_gdal, require_metres, grid_overlap, dem_change
+
+try:
+    import Metashape
+except ImportError:
+    Metashape = None
+
+CHANGE_FOLDER = "change"
+QA_FILE = "timeseries_alignment_qa.csv" # written by the alignment QA (see timeseries_tools.py)
+CONFIDENCE = 1.96 # minimum detectable change at 95% confidence
+SUMMARY_COLUMNS = ["before", "after", "min_change", "area_compared", "net_volume", "mean_change", "gain_volume", "loss_volume",
+                   "detectable_net_volume", "gain_area", "loss_area", "boundary", "difference_raster"]
+
+
+def dem_stem(dem_path):
+    ''' <project>_<chunk> for a DEM exported by the workflow as <project>_<chunk>_DEM.tif '''
+    stem = os.path.splitext(os.path.basename(dem_path))[0]
+    return stem[:-4] if stem.endswith("_DEM") else stem
+
+
+def dem_date(dem_path):
+    '''
+    the YYYYMMDD date that starts the chunk label (the naming convention ReefShape suggests) in the name of a DEM exported
+    as <project>_<chunk>_DEM.tif, or None
+    '''
+    dates = re.findall(r"(?:^|_)(\d{8})", dem_stem(dem_path))
+    return dates[-1] if dates else None
+
+
+def chronological(dem_paths):
+    ''' sorts DEMs by the date of their chunk, keeping DEMs without a date in the given order after the dated ones '''
+    return sorted(dem_paths, key = lambda path: (dem_date(path) is None, dem_date(path) or ""))
+
+
+def boundary_shapefile(dem_path):
+    ''' the boundary shapefile the workflow exports alongside a DEM, or None '''
+    path = os.path.join(os.path.dirname(os.path.abspath(dem_path)), dem_stem(dem_path) + "_boundary", dem_stem(dem_path) + "_boundary.shp")
+    return path if os.path.exists(path) else None
+
+
+def alignment_uncertainty(dem_path, qa_path):
+    '''
+    Height uncertainty (m) of a time point's DEM relative to the reference time point, from the last alignment QA row
+    of its chunk: the spread of the DEM differences over stable areas, or the marker RMS. None if there is no row,
+    as for the reference time point itself.
+    '''
+    if not qa_path or not os.path.exists(qa_path):
+        return None
+    uncertainty = None
+    with open(qa_path, newline = '') as f:
+        for row in csv.DictReader(f):
+            project_name = os.path.splitext(os.path.basename(row["project"]))[0]
+            if project_name + "_" + row["chunk"] == dem_stem(dem_path):
+                value = row.get("dem_nmad_m") or row.get("marker_rms_m")
+                uncertainty = float(value) if value else uncertainty
+    return uncertainty
+
+
+def minimum_detectable_change(before_path, after_path, qa_path):
+    ''' CONFIDENCE times the combined alignment uncertainty of two DEMs (0 if neither has been checked) '''
+    uncertainties = [alignment_uncertainty(path, qa_path) or 0.0 for path in [before_path, after_path]]
+    if not any(uncertainties):
+        print("No alignment QA found for " + os.path.basename(before_path) + " or " + os.path.basename(after_path) +
+              " - every change is counted (give a minimum detectable change to filter noise)")
+    return CONFIDENCE * math.sqrt(sum(uncertainty ** 2 for uncertainty in uncertainties))
+
+
+def change_between(dem_paths, min_change = None, boundary_path = None, qa_path = None):
+    '''
+    Differences each pair of consecutive DEMs (and the first and last, with more than two), writes the difference
+    rasters and the summary table, and returns the summary path and rows
+    '''
+    require_gdal()
+    if len(dem_paths) < 2:
+        raise Exception("At least two DEMs are needed")
+    grid_overlap(dem_paths) # all the DEMs must share a grid
+    require_metres(dem_paths[0]) # and be in metres, for volumes in m3
+    boundary_path = boundary_path or boundary_shapefile(dem_paths[0])
+    qa_path = qa_path or os.path.join(os.path.dirname(os.path.abspath(dem_paths[-1])), QA_FILE)
+    pairs = list(zip(dem_paths[:-1], dem_paths[1:]))
+    if len(dem_paths) > 2:
+        pairs.append((dem_paths[0], dem_paths[-1]))
+
+    out_dir = os.path.join(os.path.dirname(os.path.abspath(dem_paths[-1])), CHANGE_FOLDER)
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    rows = []
+    for before_path, after_path in pairs:
+        threshold = min_change if min_change is not None else minimum_detectable_change(before_path, after_path, qa_path)
+        dst_path = os.path.join(out_dir, dem_stem(after_path) + "_minus_" + dem_stem(before_path) + ".tif")
+        print("Differencing " + os.path.basename(after_path) + " and " + os.path.basename(before_path) +
+              " (minimum detectable change {:.4f} m)".format(threshold))
+        stats = dem_change(before_path, after_path, dst_path, threshold, boundary_path)
+        rows.append(dict(stats, before = os.path.basename(before_path), after = os.path.basename(after_path), min_change = threshold,
+                         boundary = boundary_path or "", difference_raster = dst_path))
+        print(" --- Net volume change {:.4f} m3 (gain {:.4f} m3, loss {:.4f} m3) over {:.2f} m2 --- ".format(
+              stats["net_volume"], stats["gain_volume"], stats["loss_volume"], stats["area_compared"]))
+
+    summary_path = os.path.join(out_dir, dem_stem(dem_paths[-1]) + "_change_summary.csv")
+    with open(summary_path, 'w', newline = '') as f:
+        writer = csv.DictWriter(f, fieldnames = SUMMARY_COLUMNS)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow({key: "{:.6g}".format(value) if isinstance(value, float) else value for key, value in row.items()})
+    return summary_path, rows
+
+
+def change_dialog():
+    ''' asks for the DEMs of the time points and the minimum detectable change, and differences them '''
+    try:
+        require_gdal()
+    except Exception as e:
+        Metashape.app.messageBox(str(e))
+        return
+    paths = Metashape.app.getOpenFileNames("Select the DEMs of the time points", filter = "GeoTIFF (*.tif *.tiff)")
+    if len(paths) < 2:
+        if paths:
+            Metashape.app.messageBox("Select the DEMs of at least two time points.")
+        return
+    # differenced earliest first - by the date of their chunks, not their paths, which may be in different folders or projects
+    paths = chronological(paths)
+    if any(dem_date(path) is None for path in paths):
+        order = "\n".join(os.path.basename(path) for path in paths)
+        if not Metashape.app.getBool("Not every DEM has a date in its name. Compare them in this order (earliest first)?\n\n" + order):
+            Metashape.app.messageBox("Add the date (YYYYMMDD) to the start of the chunk labels and export the DEMs again, or run "
+                                     "this script from the command line, which compares the DEMs in the order given.")
+            return
+    min_change = Metashape.app.getString("Minimum detectable change in metres (blank to use the alignment QA):", "")
+    if min_change is None:
+        return
+    try:
+        summary_path, rows = change_between(paths, float(min_change) if min_change.strip() else None)
+    except Exception as e:
+        Metashape.app.messageBox("Unable to compare the DEMs:\n" + str(e))
+        return
+    Metashape.app.messageBox("\n".join("{} - {}: net {:.4f} m3, gain {:.4f} m3, loss {:.4f} m3".format(
+                             row["after"], row["before"], row["net_volume"], row["gain_volume"], row["loss_volume"]) for row in rows)
+                             + "\n\nSummary saved to:\n" + summary_path)
+
+
+if Metashape is not None:
+    label = "ReefShape/Tools/DEM Change Detection"
+    Metashape.app.removeMenuItem(label)
+    Metashape.app.addMenuItem(label, change_dialog)
+    print("To execute this script press {}".format(label))
+elif __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description = "Difference the DEMs of aligned ReefShape time points and summarise the volume change")
+    parser.add_argument("dems", nargs = "+", help = "exported DEMs (.tif), earliest first")
+    parser.add_argument("--min-change", type = float, help = "minimum detectable change in m (default: from the alignment QA)")
+    parser.add_argument("--boundary", help = "plot boundary shapefile (default: the one exported with the first DEM)")
+    parser.add_argument("--qa", help = "alignment QA table (default: " + QA_FILE + " next to the last DEM)")
+    args = parser.parse_args()
+    summary_path, rows = change_between(args.dems, args.min_change, args.boundary, args.qa)
+    print(summary_path)
@@ -0,0 +1,223 @@
+'''
+Camera Footprint and View Selection Functions for the ReefShape Workflow
+
+This file contains functions used by the full workflow script to work out which part of the plot each
+aligned camera sees, and to pick a smaller set of cameras that still sees every part of the plot enough
+times for dense reconstruction. It cannot function as a standalone script.
+
+Footprints are computed on a regular grid of points laid over the sparse (tie point) surface. The grid is
+built in the plane that best fits the tie points, so it works for referenced and unreferenced chunks alike,
+and every camera is projected onto it at once with NumPy rather than one point at a time. Lens distortion
+and occlusion are ignored, which is a good approximation for footprints on a 2.5D reef surface.
+'''
+
+import heapq
+import numpy as np
+from raster_tools import write_png
+
+MAX_SURFACE_POINTS = 200000 # tie points are subsampled to at most this many before gridding
+SURFACE_CELLS = 10000 # approximate number of grid cells laid over the sparse surface
+CAMERA_BATCH = 64 # cameras projected together - bounds memory to CAMERA_BATCH x grid points
+FOOTPRINT_MARGIN = 0.05 # fraction of the image trimmed from each edge, since edges are poorly matched
+
+
+def matrix_to_numpy(matrix, size = 4):
+    ''' converts a Metashape.Matrix to a NumPy array '''
+    return np.array([[matrix[row, col] for col in range(size)] for row in range(size)], dtype = float)
+
+
+def tie_point_coords(chunk, max_points = MAX_SURFACE_POINTS):
+    '''
+    Returns the valid tie point positions of a chunk in internal coordinates as an (N, 3) array,
+    subsampled evenly to at most max_points
+    '''
+    points = chunk.tie_points.points
+    step = max(1, len(points) // max_points)
+    coords = []
+    for i in range(0, len(points), step):
+        point = points[i]
+        if point.valid:
+            coord = point.coord
+            coords.append([coord[0] / coord[3], coord[1] / coord[3], coord[2] / coord[3]])
+    return np.array(coords, dtype = float).reshape(-1, 3)
+
+
+def surface_grid(points, cell_count = SURFACE_CELLS, include_empty = False, x_direction = None, up_direction = None):
+    '''
+    Lays a regular grid over the best-fit plane of the given points and returns a dict describing it:
+        centre, axes - origin and orientation of the plane (axes rows are the two in-plane axes and the normal)
+        origin, cell_size, shape - grid geometry in plane coordinates, shape is (rows, columns)
+        cells - flat indices of the grid cells that contain surface points (or of every cell, if include_empty)
+        points - the surface position of each of those cells in internal coordinates, (M, 3)
+    The surface height of each cell is the mean height of the points falling inside it. Empty cells, which
+    are only returned if include_empty is set, are placed on the best-fit plane.
+
+    The in-plane axes are arbitrary unless x_direction (a vector in internal coordinates, projected onto the
+    plane) is given, and the normal points along up_direction if given, which keeps maps from being mirrored.
+    '''
+    centre = points.mean(axis = 0)
+    axes = np.linalg.svd(points - centre, full_matrices = False)[2]
+    if up_direction is not None and np.dot(axes[2], up_direction) < 0:
+        axes[2] = -axes[2]
+    if x_direction is not None:
+        x_axis = np.asarray(x_direction, dtype = float) - np.dot(x_direction, axes[2]) * axes[2]
+        if np.linalg.norm(x_axis) > 0:
+            axes[0] = x_axis / np.linalg.norm(x_axis)
+    axes[1] = np.cross(axes[2], axes[0])
+    local = (points - centre) @ axes.T
+
+    origin = local[:, :2].min(axis = 0)
+    extent = np.maximum(local[:, :2].max(axis = 0) - origin, 1e-9)
+    cell_size = float(np.sqrt(extent[0] * extent[1] / cell_count)) or float(extent.max())
+    cols, rows = [int(n) for n in np.floor(extent / cell_size) + 1]
+    ix = np.minimum(((local[:, 0] - origin[0]) / cell_size).astype(int), cols - 1)
+    iy = np.minimum(((local[:, 1] - origin[1]) / cell_size).astype(int), rows - 1)
+    flat = iy * cols + ix
+
+    counts = np.bincount(flat, minlength = rows * cols)
+    heights = np.bincount(flat, weights = local[:, 2], minlength = rows * cols)
+    heights = np.divide(heights, counts, out = np.zeros_like(heights), where = counts > 0)
+    cells = np.arange(rows * cols) if include_empty else np.flatnonzero(counts)
+    cell_local = np.column_stack([origin[0] + (cells % cols + 0.5) * cell_size,
+                                  origin[1] + (cells // cols + 0.5) * cell_size,
+                                  heights[cells]])
+
+    return {"centre": centre, "axes": axes, "origin": origin, "cell_size": cell_size, "shape": (rows, cols),
+            "cells": cells, "points": centre + cell_local @ axes}
+
+
+def camera_footprints(cameras, ground_points, margin = FOOTPRINT_MARGIN):
+    '''
+    Projects the ground points into every camera with a pinhole model and returns, for each camera, an array
+    of the indices of the ground points that fall inside its image (minus the margin on each edge)
+    '''
+    footprints = []
+    for start in range(0, len(cameras), CAMERA_BATCH):
+        batch = cameras[start:start + CAMERA_BATCH]
+        transforms = np.array([matrix_to_numpy(camera.transform) for camera in batch])
+        rotations_inv = np.linalg.inv(transforms[:, :3, :3])
+        centres = transforms[:, :3, 3]
+        calibs = [camera.sensor.calibration for camera in batch]
+        f = np.array([calib.f for calib in calibs])[:, None]
+        cx = np.array([calib.cx + calib.width / 2 for calib in calibs])[:, None]
+        cy = np.array([calib.cy + calib.height / 2 for calib in calibs])[:, None]
+        width = np.array([calib.width for calib in calibs], dtype = float)[:, None]
+        height = np.array([calib.height for calib in calibs], dtype = float)[:, None]
+
+        # points in each camera's frame, (cameras, points, 3)
+        local = np.einsum('cij,cpj->cpi', rotations_inv, ground_points[None, :, :] - centres[:, None, :])
+        z = local[:, :, 2]
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            u = f * local[:, :, 0] / z + cx
+            v = f * local[:, :, 1] / z + cy
+        visible = ((z > 0) & (u >= margin * width) & (u < (1 - margin) * width)
+                   & (v >= margin * height) & (v < (1 - margin) * height))
+        footprints.extend(np.flatnonzero(row) for row in visible)
+    return footprints
+
+
+def coverage_counts(footprints, point_count):
+    ''' returns the number of cameras seeing each ground point '''
+    counts = np.zeros(point_count, dtype = int)
+    for footprint in footprints:
+        counts[footprint] += 1
+    return counts
+
+
+def greedy_view_selection(footprints, point_count, min_views):
+    '''
+    Picks a subset of cameras such that every ground point is seen by at least min_views of them
+    (or by all cameras that see it, where fewer than min_views do). This is a greedy set multicover:
+    the camera covering the most still-under-covered points is picked each round. Gains only ever
+    decrease, so stale gains are kept in a heap and only recomputed when they reach the top.
+
+    Returns the indices of the selected cameras.
+    '''
+    demand = np.minimum(coverage_counts(footprints, point_count), min_views)
+    heap = [(-len(footprint), index) for index, footprint in enumerate(footprints) if len(footprint)]
+    heapq.heapify(heap)
+    selected = []
+    while heap and demand.any():
+        stale_gain, index = heapq.heappop(heap)
+        gain = int(np.count_nonzero(demand[footprints[index]]))
+        if gain == 0:
+            continue
+        if heap and gain < -heap[0][0]:
+            heapq.heappush(heap, (-gain, index))
+            continue
+        selected.append(index)
+        covered = footprints[index]
+        demand[covered] = np.maximum(demand[covered] - 1, 0)
+    return selected
+
+
+def plane_coords(grid, points):
+    ''' returns the in-plane (x, y) coordinates of points given in internal coordinates, (N, 2) '''
+    return ((np.asarray(points, dtype = float) - grid["centre"]) @ grid["axes"].T)[:, :2]
+
+
+def points_in_polygon(xy, polygon):
+    '''
+    Even-odd point in polygon test for many points at once - xy is (N, 2), polygon is (K, 2).
+    Returns a boolean array
+    '''
+    x, y = xy[:, 0], xy[:, 1]
+    inside = np.zeros(len(xy), dtype = bool)
+    for (x1, y1), (x2, y2) in zip(polygon, np.roll(polygon, -1, axis = 0)):
+        crosses = (y1 > y) != (y2 > y)
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            x_cross = x1 + (y - y1) * (x2 - x1) / (y2 - y1)
+        inside ^= crosses & (x < x_cross)
+    return inside
+
+
+def coverage_analysis(cameras, points, boundary = None, min_views = 3, cell_count = SURFACE_CELLS):
+    '''
+    Counts how many cameras see each cell of a grid laid over the sparse surface. Cells with no tie points
+    are included (placed on the best-fit plane), since a missed patch of reef usually has no tie points at all.
+
+    boundary is an optional (K, 3) array of boundary vertices in internal coordinates (e.g. the corner markers).
+    Cells inside it are checked; without it, the cells containing tie points are checked.
+
+    Returns a dict with the grid, the (rows, cols) counts, the inside and gap masks, and the fraction of the
+    checked area seen by fewer than min_views cameras.
+    '''
+    # orient the grid along the first boundary edge, looking down from the cameras, so the map reads like the plot
+    up_direction = np.mean([matrix_to_numpy(camera.transform)[:3, 3] for camera in cameras], axis = 0) - points.mean(axis = 0)
+    x_direction = None
+    if boundary is not None and len(boundary) >= 2:
+        x_direction = np.asarray(boundary[1], dtype = float) - np.asarray(boundary[0], dtype = float)
+    grid = surface_grid(points, cell_count, include_empty = True, x_direction = x_direction, up_direction = up_direction)
+    rows, cols = grid["shape"]
+    counts = coverage_counts(camera_footprints(cameras, grid["points"]), rows * cols)
+
+    if boundary is not None and len(boundary) >= 3:
+        cells = grid["cells"]
+        cell_xy = np.column_stack([grid["origin"][0] + (cells % cols + 0.5) * grid["cell_size"],
+                                   grid["origin"][1] + (cells // cols + 0.5) * grid["cell_size"]])
+        inside = points_in_polygon(cell_xy, plane_coords(grid, boundary))
+    else:
+        inside = np.zeros(rows * cols, dtype = bool)
+        inside[surface_grid(points, cell_count, x_direction = x_direction, up_direction = up_direction)["cells"]] = True
+
+    gaps = inside & (counts < min_views)
+    gap_fraction = float(gaps.sum()) / max(int(inside.sum()), 1)
+    return {"grid": grid, "counts": counts.reshape(rows, cols), "inside": inside.reshape(rows, cols),
+            "gaps": gaps.reshape(rows, cols), "gap_fraction": gap_fraction}
+
+
+def write_coverage_png(path, coverage, min_views, scale = 4):
+    '''
+    Writes a colour-coded coverage map as a PNG: red cells are gaps (fewer than min_views cameras),
+    green cells are covered (brighter means more views), grey is outside the checked area.
+    Each grid cell is drawn as a scale x scale block.
+    '''
+    counts, inside, gaps = coverage["counts"], coverage["inside"], coverage["gaps"]
+    shade = np.clip(counts / float(3 * min_views), 0, 1)
+    rgb = np.empty(counts.shape + (3,), dtype = np.uint8)
+    rgb[...] = (200, 200, 200)
+    covered = inside & ~gaps
+    rgb[covered] = np.column_stack([np.zeros(covered.sum()), 90 + 165 * shade[covered], np.zeros(covered.sum())]).astype(np.uint8)
+    rgb[gaps] = (220, 30, 30)
+    rgb = np.repeat(np.repeat(rgb[::-1], scale, axis = 0), scale, axis = 1) # flip so the plane's y axis points up
+    write_png(path, rgb)
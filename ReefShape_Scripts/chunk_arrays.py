@@ -0,0 +1,74 @@
+'''
+Chunk Data Arrays for ReefShape
+
+This file contains functions to write and read the columnar chunk data exported by the Export Chunk Data
+Arrays tool (12_export_chunk_arrays.py), and the frame camera projection model used to compute reprojection
+errors from those arrays. It cannot function as a standalone script, and does not need Metashape, so QA and
+research scripts can import it in any Python with NumPy.
+
+An export is a folder holding one .npy file per column, named <table>.<column>.npy (e.g. cameras.transform.npy),
+and a manifest.json describing the chunk and every column. Rows of the columns of a table line up. Each .npy
+file can be memory-mapped, so a script only reads the columns (and rows) it uses:
+
+    from chunk_arrays import load_chunk_arrays
+    data = load_chunk_arrays("plot1_2024_arrays")
+    errors = data["tie_points"]["reprojection_error"]
+'''
+
+import os
+import json
+import numpy as np
+
+MANIFEST = "manifest.json"
+
+
+def write_table(folder, table, columns, manifest):
+    '''
+    Writes each column (name -> array) of a table as <table>.<column>.npy in folder, and describes them in the
+    manifest dict (which is written separately by write_manifest())
+    '''
+    manifest.setdefault("tables", {})[table] = {}
+    for name, values in columns.items():
+        values = np.asarray(values)
+        np.save(os.path.join(folder, table + "." + name + ".npy"), values)
+        manifest["tables"][table][name] = {"dtype": values.dtype.str, "shape": list(values.shape)}
+
+
+def write_manifest(folder, manifest):
+    with open(os.path.join(folder, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent = 1)
+
+
+def load_chunk_arrays(folder, mmap_mode = "r"):
+    '''
+    Returns the exported tables as {table: {column: array}}, with the arrays memory-mapped by default.
+    The chunk description from the manifest is available under "manifest".
+    '''
+    with open(os.path.join(folder, MANIFEST)) as f:
+        manifest = json.load(f)
+    data = {"manifest": manifest}
+    for table, columns in manifest["tables"].items():
+        data[table] = {name: np.load(os.path.join(folder, table + "." + name + ".npy"), mmap_mode = mmap_mode)
+                       for name in columns}
+    return data
+
+
+def project_frame(local, calibration):
+    '''
+    Projects points given in a camera's frame, (N, 3), to pixel coordinates with Metashape's frame camera model
+    (focal length, principal point offset, radial k1-k4, tangential p1/p2 and affinity/skew b1/b2).
+    calibration is a dict or structured row with those values and the image width and height.
+    Returns (N, 2) pixel coordinates; points behind the camera are NaN.
+    '''
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        x = local[:, 0] / local[:, 2]
+        y = local[:, 1] / local[:, 2]
+    r2 = x * x + y * y
+    radial = 1 + r2 * (calibration["k1"] + r2 * (calibration["k2"] + r2 * (calibration["k3"] + r2 * calibration["k4"])))
+    xd = x * radial + calibration["p1"] * (r2 + 2 * x * x) + 2 * calibration["p2"] * x * y
+    yd = y * radial + calibration["p2"] * (r2 + 2 * y * y) + 2 * calibration["p1"] * x * y
+    u = calibration["width"] * 0.5 + calibration["cx"] + xd * (calibration["f"] + calibration["b1"]) + yd * calibration["b2"]
+    v = calibration["height"] * 0.5 + calibration["cy"] + yd * calibration["f"]
+    pixels = np.column_stack([u, v])
+    pixels[local[:, 2] <= 0] = np.nan
+    return pixels
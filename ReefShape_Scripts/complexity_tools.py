@@ -0,0 +1,380 @@
+'''
+Structural Complexity Tools for ReefShape
+
+This file contains the functions used to measure the structural complexity of a plot from its 3D model and DEM, shared
+by the surface area ratio tool (07_calculate_area_ratio.py) and the batch complexity metrics script
+(14_batch_complexity_metrics.py). It cannot function as a standalone script.
+
+The 3D surface area inside the outer boundary is computed straight from the model's vertex and face arrays, so the
+model does not have to be duplicated and clipped in the project. The model is read in batches of faces: every face
+is converted to a local east-north-up frame in metres, faces wholly inside or outside the boundary are summed (or
+skipped) at once with NumPy, and only the faces that straddle the boundary are clipped exactly against it. A planar
+face keeps the same ratio of 3D to plan area when it is clipped, so the clipped 3D area is the face area times the
+fraction of its plan area inside the boundary.
+
+The DEM metrics are computed on the DEM exported over the window of the boundary only, at the DEM's own resolution
+(coarsened if the window would be too large to hold in memory), from the cells inside the boundary:
+    - DEM rugosity: surface area of the DEM over its plan area
+    - vector ruggedness measure (VRM): one minus the length of the mean unit surface normal over each 3x3 window, averaged
+    - fractal dimension by the height range method: D = 3 - s, with s the slope of log(mean height range) against
+    log(scale) over square windows from 4 cells up to the largest size that fits in the boundary, doubling each time
+    - height range: the highest minus the lowest point
+'''
+
+import Metashape
+import os
+import shutil
+import tempfile
+import itertools
+import numpy as np
+from camera_selection import matrix_to_numpy, points_in_polygon
+from coregistration import interior
+from raster_tools import block_reduce, ruggedness
+from export_tools import window_extent, export_dem_grid, pixel_size
+from timeseries_tools import chunk_date
+
+FACE_BATCH = 250000 # faces read and processed together - bounds memory to a few arrays of FACE_BATCH x 3 vertices
+VERTEX_BATCH = 500000
+MIN_PLAN_AREA = 1e-12 # m2, faces with a smaller plan area (vertical faces) are kept or dropped whole by their centroid
+MAX_DEM_CELLS = 40000000 # the DEM is read at a coarser resolution if the boundary window would have more cells
+MIN_FRACTAL_COVERAGE = 0.95 # fraction of a window's cells that must be inside the boundary for its height range to count
+MASK_ROWS = 1024 # rows of the DEM tested against the boundary at a time
+# columns of the batch metrics table, one row per chunk (areas in m2, lengths in m)
+METRIC_COLUMNS = ["project", "chunk", "date", "boundary_area", "surface_area_3d", "surface_area_ratio", "dem_resolution",
+                  "dem_coverage", "dem_rugosity", "vrm", "fractal_dimension", "fractal_scale_min", "fractal_scale_max",
+                  "height_range", "status"]
+
+
+def local_frame(chunk):
+    '''
+    Returns the 4x4 matrix from the chunk's internal coordinates to a local frame in metres with z up: east-north-up
+    at the centre of the chunk region for a georeferenced chunk, or the chunk's own coordinates for a local one
+    '''
+    transform = matrix_to_numpy(chunk.transform.matrix)
+    if chunk.crs is None or chunk.crs.wkt.startswith("LOCAL_CS"):
+        return transform
+    centre = chunk.transform.matrix.mulp(chunk.region.center)
+    return matrix_to_numpy(chunk.crs.localframe(centre)) @ transform
+
+
+def boundary_rings(chunk, convert):
+    '''
+    Returns the outer boundary polygons of the chunk as a list of (outer ring, [hole rings]), each ring a (K, 2) array
+    of its vertices passed through convert(vertex), which takes a geocentric Metashape.Vector (world coordinates for a
+    local chunk). Boundaries are found by their boundary type, not by their position in the shape list.
+    '''
+    if not chunk.shapes:
+        return []
+    shape_crs = chunk.shapes.crs or chunk.crs
+    boundaries = []
+    for shape in chunk.shapes:
+        if shape.boundary_type != Metashape.Shape.BoundaryType.OuterBoundary or shape.geometry.type != Metashape.Geometry.Type.PolygonType:
+            continue
+        rings = []
+        for ring in shape.geometry.coordinates:
+            points = []
+            for vertex in ring:
+                vertex = Metashape.Vector([vertex[0], vertex[1], vertex[2] if len(vertex) > 2 else 0])
+                points.append(list(convert(shape_crs.unproject(vertex) if shape_crs else vertex))[:2])
+            points = np.array(points, dtype = float)
+            if len(points) > 1 and np.allclose(points[0], points[-1]): # closed rings repeat the first vertex
+                points = points[:-1]
+            if len(points) >= 3:
+                rings.append(points)
+        if rings:
+            boundaries.append((rings[0], rings[1:]))
+    return boundaries
+
+
+def outer_boundaries(chunk, frame):
+    ''' returns the outer boundary polygons of the chunk (see boundary_rings()) in the local frame '''
+    return boundary_rings(chunk, lambda point: frame[:3, :3] @ np.array(list(point)[:3]) + frame[:3, 3])
+
+
+def polygon_area(ring):
+    ''' plan area of a ring (K, 2) with the shoelace formula '''
+    x, y = ring[:, 0], ring[:, 1]
+    return 0.5 * abs(np.dot(x, np.roll(y, -1)) - np.dot(y, np.roll(x, -1)))
+
+
+def model_vertices(model, frame, batch = VERTEX_BATCH):
+    ''' returns the model's vertices in the local frame as an (N, 3) array, read in batches '''
+    vertices = model.vertices
+    count = len(vertices)
+    coords = np.empty((count, 3))
+    for start in range(0, count, batch):
+        end = min(start + batch, count)
+        block = np.array([tuple(vertices[i].coord) for i in range(start, end)], dtype = float).reshape(-1, 3)
+        coords[start:end] = block @ frame[:3, :3].T + frame[:3, 3]
+    return coords
+
+
+def face_batches(model, batch = FACE_BATCH):
+    ''' yields the model's faces as (M, 3) arrays of vertex indices, batch faces at a time '''
+    faces = iter(model.faces)
+    while True:
+        block = [face.vertices for face in itertools.islice(faces, batch)]
+        if not block:
+            return
+        yield np.array(block, dtype = np.int64).reshape(-1, 3)
+
+
+def triangle_areas(triangles):
+    ''' 3D areas of (M, 3, 3) triangles, or plan areas of (M, 3, 2) triangles (signed, positive anticlockwise) '''
+    ab, ac = triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0]
+    if triangles.shape[2] == 2:
+        return 0.5 * (ab[:, 0] * ac[:, 1] - ab[:, 1] * ac[:, 0])
+    return 0.5 * np.linalg.norm(np.cross(ab, ac), axis = 1)
+
+
+def crosses_ring(triangles, ring):
+    '''
+    Returns a mask of the plan triangles (M, 3, 2) that an edge of the ring crosses, or that contain the whole ring.
+    Each ring edge is tested against the three edges of every triangle whose bounding box it overlaps.
+    '''
+    lower, upper = triangles.min(axis = 1), triangles.max(axis = 1)
+    crossed = np.zeros(len(triangles), dtype = bool)
+    for p, q in zip(ring, np.roll(ring, -1, axis = 0)):
+        near = np.flatnonzero((upper[:, 0] >= min(p[0], q[0])) & (lower[:, 0] <= max(p[0], q[0])) &
+                              (upper[:, 1] >= min(p[1], q[1])) & (lower[:, 1] <= max(p[1], q[1])) & ~crossed)
+        if len(near) == 0:
+            continue
+        r = q - p
+        for i, j in [(0, 1), (1, 2), (2, 0)]:
+            a, b = triangles[near, i], triangles[near, j]
+            s = b - a
+            side_a = r[0] * (a[:, 1] - p[1]) - r[1] * (a[:, 0] - p[0])
+            side_b = r[0] * (b[:, 1] - p[1]) - r[1] * (b[:, 0] - p[0])
+            side_p = s[:, 0] * (p[1] - a[:, 1]) - s[:, 1] * (p[0] - a[:, 0])
+            side_q = s[:, 0] * (q[1] - a[:, 1]) - s[:, 1] * (q[0] - a[:, 0])
+            crossed[near[(side_a * side_b < 0) & (side_p * side_q < 0)]] = True
+    # a ring smaller than a triangle crosses none of its edges
+    sides = np.column_stack([(b[:, 0] - a[:, 0]) * (ring[0, 1] - a[:, 1]) - (b[:, 1] - a[:, 1]) * (ring[0, 0] - a[:, 0])
+                             for a, b in [(triangles[:, 0], triangles[:, 1]), (triangles[:, 1], triangles[:, 2]), (triangles[:, 2], triangles[:, 0])]])
+    contains = (sides > 0).all(axis = 1) | (sides < 0).all(axis = 1)
+    return crossed | contains
+
+
+def clip_ring_to_triangle(ring, triangle):
+    '''
+    Clips a ring (K, 2), convex or not, to an anticlockwise plan triangle (3, 2) and returns the plan area of the part
+    inside it (Sutherland-Hodgman - the clipped ring may have zero-width spurs, which do not change its area)
+    '''
+    points = [tuple(point) for point in ring]
+    for a, b in [(triangle[0], triangle[1]), (triangle[1], triangle[2]), (triangle[2], triangle[0])]:
+        if not points:
+            return 0.0
+        def side(point):
+            return (b[0] - a[0]) * (point[1] - a[1]) - (b[1] - a[1]) * (point[0] - a[0])
+        clipped = []
+        for current, following in zip(points, points[1:] + points[:1]):
+            side_current, side_following = side(current), side(following)
+            if side_current >= 0:
+                clipped.append(current)
+            if (side_current >= 0) != (side_following >= 0):
+                t = side_current / (side_current - side_following)
+                clipped.append((current[0] + t * (following[0] - current[0]), current[1] + t * (following[1] - current[1])))
+        points = clipped
+    return polygon_area(np.array(points)) if len(points) >= 3 else 0.0
+
+
+def area_inside_ring(triangles, areas, ring, inside):
+    '''
+    Returns the 3D area of the triangles (M, 3, 3) inside a ring (K, 2), given their 3D areas and which of their
+    vertices are inside the ring (M, 3), and the number of triangles clipped
+    '''
+    plan = triangles[:, :, :2]
+    straddling = (inside.any(axis = 1) & ~inside.all(axis = 1)) | crosses_ring(plan, ring)
+    total = float(areas[inside.all(axis = 1) & ~straddling].sum())
+    plan_areas = triangle_areas(plan)
+    for index in np.flatnonzero(straddling):
+        if abs(plan_areas[index]) < MIN_PLAN_AREA:
+            if points_in_polygon(plan[index].mean(axis = 0, keepdims = True), ring)[0]:
+                total += float(areas[index])
+            continue
+        triangle = plan[index] if plan_areas[index] > 0 else plan[index][::-1]
+        total += float(areas[index]) * min(clip_ring_to_triangle(ring, triangle) / abs(plan_areas[index]), 1.0)
+    return total, int(straddling.sum())
+
+
+def surface_area_ratio(chunk, model = None, face_batch = FACE_BATCH):
+    '''
+    Calculates the 3D surface area of the model (the chunk's active model by default) inside the chunk's outer boundary
+    shapes, without duplicating the model. Holes in the boundary are left out. Returns a dict with the 3D surface area
+    and plan area in square metres, their ratio, and the number of faces read and clipped.
+    '''
+    model = model or chunk.model
+    frame = local_frame(chunk)
+    boundaries = outer_boundaries(chunk, frame)
+    if not boundaries:
+        raise Exception("No outer boundary shape found in chunk " + chunk.label + " - create one first")
+    vertices = model_vertices(model, frame)
+    rings = []
+    for outer, holes in boundaries:
+        rings.append((outer, 1))
+        rings.extend((hole, -1) for hole in holes)
+    inside = [points_in_polygon(vertices[:, :2], ring) for ring, _ in rings]
+
+    surface_area, face_count, clipped = 0.0, 0, 0
+    for faces in face_batches(model, face_batch):
+        triangles = vertices[faces]
+        areas = triangle_areas(triangles)
+        for (ring, sign), vertex_inside in zip(rings, inside):
+            area, straddling = area_inside_ring(triangles, areas, ring, vertex_inside[faces])
+            surface_area += sign * area
+            clipped += straddling
+        face_count += len(faces)
+    plan_area = sum(polygon_area(outer) - sum(polygon_area(hole) for hole in holes) for outer, holes in boundaries)
+    return {"surface_area_3d": surface_area, "planar_area": plan_area, "ratio": surface_area / plan_area if plan_area > 0 else float("nan"),
+            "faces": face_count, "clipped_faces": clipped}
+
+
+def boundary_mask(boundaries, window, pixel, shape):
+    '''
+    marks the cells of a raster over window (rows from the top, with an (x, y) pixel size) whose centres are inside the
+    boundaries, row block by row block
+    '''
+    rows, cols = shape
+    mask = np.zeros(shape, dtype = bool)
+    x = window[0] + (np.arange(cols) + 0.5) * pixel[0]
+    for start in range(0, rows, MASK_ROWS):
+        end = min(start + MASK_ROWS, rows)
+        y = window[3] - (np.arange(start, end) + 0.5) * pixel[1]
+        centres = np.column_stack([np.tile(x, end - start), np.repeat(y, cols)])
+        block = np.zeros(len(centres), dtype = bool)
+        for outer, holes in boundaries:
+            inside = points_in_polygon(centres, outer)
+            for hole in holes:
+                inside &= ~points_in_polygon(centres, hole)
+            block |= inside
+        mask[start:end] = block.reshape(end - start, cols)
+    return mask
+
+
+def vector_ruggedness(gx, gy, cells):
+    ''' mean vector ruggedness measure over the cells whose whole 3x3 window is in cells, from the DEM slopes '''
+    vrm = ruggedness(gx, gy, cells)
+    return float(np.nanmean(vrm)) if np.isfinite(vrm).any() else float("nan")
+
+
+def height_range_dimension(dem, cells, resolution):
+    '''
+    Fractal dimension of the surface by the height range method: the mean height range of square windows, which must be
+    almost wholly inside the boundary, is found at window sizes from 4 cells up, doubling each time, and D = 3 - the slope
+    of log(height range) against log(window size). Returns (D, smallest and largest window size) or NaNs with fewer than three sizes.
+    '''
+    scales, ranges = [], []
+    factor = 4
+    while factor <= min(dem.shape):
+        rows, cols = (dem.shape[0] // factor) * factor, (dem.shape[1] // factor) * factor
+        values, valid = dem[None, :rows, :cols], cells[:rows, :cols]
+        highest, _ = block_reduce(values, valid, factor, "max")
+        lowest, _ = block_reduce(values, valid, factor, "min")
+        coverage, _ = block_reduce(valid[None].astype(float), np.ones(valid.shape, dtype = bool), factor, "mean")
+        full = coverage[0] >= MIN_FRACTAL_COVERAGE
+        if not full.any():
+            break
+        scales.append(factor * resolution)
+        ranges.append(float(np.mean((highest[0] - lowest[0])[full])))
+        factor *= 2
+    if len(scales) < 3 or min(ranges) <= 0:
+        return float("nan"), float("nan"), float("nan")
+    # the extremes of a window can be at most (size - 1) cells apart, so that is the scale fitted (exact for a plane)
+    slope = np.polyfit(np.log(np.array(scales) - resolution), np.log(ranges), 1)[0]
+    return float(3 - slope), scales[0], scales[-1]
+
+
+def dem_metrics(dem, valid, inside, resolution):
+    '''
+    Computes the DEM rugosity, vector ruggedness measure, fractal dimension and height range (see the top of this file)
+    from the DEM cells that are valid and inside the boundary. resolution is the cell size in metres.
+    '''
+    cells = valid & inside
+    if not cells.any():
+        raise Exception("The DEM does not cover the boundary")
+    gy, gx = np.gradient(np.where(valid, dem, 0), resolution)
+    inner = interior(valid) & inside # where the central difference slopes only use valid cells
+    dimension, smallest, largest = height_range_dimension(dem, cells, resolution)
+    return {"dem_rugosity": float(np.mean(np.sqrt(1 + gx[inner] ** 2 + gy[inner] ** 2))) if inner.any() else float("nan"),
+            "vrm": vector_ruggedness(np.where(inner, gx, 0), np.where(inner, gy, 0), inner),
+            "fractal_dimension": dimension, "fractal_scale_min": smallest, "fractal_scale_max": largest,
+            "height_range": float(dem[cells].max() - dem[cells].min()),
+            "dem_coverage": float(cells.sum()) / max(int(inside.sum()), 1)}
+
+
+def chunk_dem_metrics(chunk, resolution = None):
+    '''
+    Exports the chunk's DEM over the window of its outer boundary (at the DEM resolution by default, or resolution in
+    metres) and computes the DEM metrics inside the boundary. The exported cells are square on the ground, so the metrics
+    are in metres whatever the coordinate system - for a geographic one (such as the default WGS84 + EGM96) the cell size
+    is converted to degrees for the export (see pixel_size()).
+    '''
+    elevation = chunk.elevation
+    crs = elevation.crs or chunk.crs
+    boundaries = boundary_rings(chunk, lambda point: crs.project(point) if crs else point)
+    if not boundaries:
+        raise Exception("No outer boundary shape found in chunk " + chunk.label + " - create one first")
+    points = np.concatenate([outer for outer, _ in boundaries])
+    extent = [points[:, 0].min(), points[:, 1].min(), points[:, 0].max(), points[:, 1].max()]
+    resolution = resolution or elevation.resolution
+    pixel = pixel_size(elevation, resolution)
+    # coarsen the grid if the window would not fit in memory
+    cells = (extent[2] - extent[0]) * (extent[3] - extent[1]) / (pixel[0] * pixel[1])
+    if cells > MAX_DEM_CELLS:
+        resolution *= np.sqrt(cells / MAX_DEM_CELLS)
+        pixel = pixel_size(elevation, resolution)
+    window = window_extent(extent, pixel, pixel)
+    temp_dir = tempfile.mkdtemp(prefix = "reefshape_metrics_")
+    try:
+        dem, valid = export_dem_grid(chunk, window, pixel, os.path.join(temp_dir, "dem.tif"))
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors = True)
+    metrics = dem_metrics(dem, valid, boundary_mask(boundaries, window, pixel, dem.shape), resolution)
+    metrics["dem_resolution"] = float(resolution)
+    return metrics
+
+
+def chunk_metrics(chunk, resolution = None, use_mesh = True):
+    '''
+    Computes every metric available for a chunk: the surface area ratio from its model (if use_mesh is set) and the DEM
+    metrics from its DEM. Returns a row of the batch metrics table (see METRIC_COLUMNS) without the project; metrics that
+    cannot be computed are left empty and the reasons given in its status.
+    '''
+    row = {"chunk": chunk.label, "date": chunk_date(chunk) or ""}
+    problems = []
+    if use_mesh and chunk.model is not None:
+        try:
+            area = surface_area_ratio(chunk)
+            row.update(boundary_area = area["planar_area"], surface_area_3d = area["surface_area_3d"], surface_area_ratio = area["ratio"])
+        except Exception as e:
+            problems.append("surface area ratio: " + str(e))
+    if chunk.elevation is not None:
+        try:
+            row.update(chunk_dem_metrics(chunk, resolution))
+        except Exception as e:
+            problems.append("DEM metrics: " + str(e))
+    else:
+        problems.append("no DEM")
+    row["status"] = "; ".join(problems) or "ok"
+    return row
+
+
+def project_metrics(project_path, resolution = None, use_mesh = True, chunk_labels = None):
+    '''
+    Opens a project read-only and computes the metrics of each of its chunks (or those labelled in chunk_labels) that
+    have a model or DEM. Returns a list of rows of the batch metrics table.
+    '''
+    doc = Metashape.Document()
+    doc.open(project_path, read_only = True, ignore_lock = True)
+    rows = []
+    for chunk in doc.chunks:
+        if (chunk_labels and chunk.label not in chunk_labels) or (chunk.model is None and chunk.elevation is None):
+            continue
+        print(" --- Complexity metrics: " + os.path.basename(project_path) + " / " + chunk.label + " --- ")
+        try:
+            row = chunk_metrics(chunk, resolution, use_mesh)
+        except Exception as e:
+            row = {"chunk": chunk.label, "status": "failed: " + str(e)}
+        row["project"] = project_path
+        rows.append(row)
+    return rows
@@ -0,0 +1,141 @@
+'''
+DEM Co-registration for ReefShape
+
+This file contains the functions used to co-register the DEM of a time point to the DEM of a reference time point when
+too few markers could be transferred between them (see coregister_chunk() in timeseries_tools.py). It cannot function
+as a standalone script, and only needs NumPy.
+
+The two DEMs must be sampled on the same grid, with the target roughly in place (e.g. georeferenced from its own
+georeferencing file). The offset is found in two stages:
+    - a rotation search, with FFT phase correlation of the DEM gradients at each angle - gradients are used rather than
+    heights so growth, erosion or a vertical offset between the time points does not bias the match
+    - refinement of the rotation and shift, plus a vertical offset, by least squares matching of the two DEM surfaces
+Offsets are in pixels of the grid: a target pixel p (row, column) matches reference pixel R(angle) @ (p - centre) + centre + shift.
+'''
+
+import numpy as np
+
+
+def sample_bilinear(array, rows, cols, fill = 0.0):
+    ''' samples array at fractional (rows, cols) with bilinear interpolation, using fill outside it '''
+    height, width = array.shape
+    r0, c0 = np.floor(rows).astype(np.int64), np.floor(cols).astype(np.int64)
+    fr, fc = rows - r0, cols - c0
+    inside = (r0 >= 0) & (c0 >= 0) & (r0 < height - 1) & (c0 < width - 1)
+    r0, c0 = np.clip(r0, 0, height - 2), np.clip(c0, 0, width - 2)
+    values = (array[r0, c0] * (1 - fr) * (1 - fc) + array[r0, c0 + 1] * (1 - fr) * fc +
+              array[r0 + 1, c0] * fr * (1 - fc) + array[r0 + 1, c0 + 1] * fr * fc)
+    return np.where(inside, values, fill)
+
+
+def rotation_matrix(angle):
+    ''' rotation of (row, column) pixel coordinates by angle degrees '''
+    a = np.radians(angle)
+    return np.array([[np.cos(a), -np.sin(a)], [np.sin(a), np.cos(a)]])
+
+
+def map_pixels(points, angle, shift, shape):
+    ''' maps target pixels (N, 2) to reference pixels with the given rotation (degrees) and shift (rows, columns) '''
+    centre = (np.array(shape, dtype = float) - 1) / 2
+    return (np.asarray(points, dtype = float) - centre) @ rotation_matrix(angle).T + centre + np.asarray(shift)
+
+
+def warp_to_reference(array, angle, shift, fill = 0.0):
+    ''' resamples a target grid into the reference grid, so that warped[q] = array[p] for q = map_pixels(p) '''
+    rows, cols = np.indices(array.shape, dtype = float)
+    grid = np.column_stack([rows.ravel(), cols.ravel()])
+    centre = (np.array(array.shape, dtype = float) - 1) / 2
+    source = (grid - centre - np.asarray(shift)) @ rotation_matrix(angle) + centre # inverse of map_pixels
+    return sample_bilinear(array, source[:, 0], source[:, 1], fill).reshape(array.shape)
+
+
+def interior(valid):
+    ''' valid cells whose four neighbours are valid too, i.e. where central difference gradients are meaningful '''
+    inner = valid.copy()
+    inner[1:] &= valid[:-1]
+    inner[:-1] &= valid[1:]
+    inner[:, 1:] &= valid[:, :-1]
+    inner[:, :-1] &= valid[:, 1:]
+    return inner
+
+
+def gradient_magnitude(dem, valid):
+    ''' slope of the DEM per pixel, zero on and next to nodata so the edges of the data do not dominate the match '''
+    filled = np.where(valid, dem, dem[valid].mean() if valid.any() else 0)
+    gy, gx = np.gradient(filled)
+    return np.where(interior(valid), np.hypot(gx, gy), 0)
+
+
+def phase_correlation(reference, target):
+    '''
+    Returns the shift (rows, columns) that moves target onto reference, to a fraction of a pixel, and the height of the
+    correlation peak (close to 1 for identical images, close to 0 when nothing matches)
+    '''
+    window = np.outer(np.hanning(reference.shape[0]), np.hanning(reference.shape[1]))
+    cross = np.fft.fft2(reference * window) * np.conj(np.fft.fft2(target * window))
+    correlation = np.fft.ifft2(cross / np.maximum(np.abs(cross), 1e-12)).real
+    peak = np.unravel_index(np.argmax(correlation), correlation.shape)
+    shift = []
+    for axis, size in enumerate(correlation.shape):
+        # parabola through the peak and its neighbours (wrapping around) for the sub-pixel position
+        before, after = list(peak), list(peak)
+        before[axis] = (peak[axis] - 1) % size
+        after[axis] = (peak[axis] + 1) % size
+        low, centre, high = correlation[tuple(before)], correlation[peak], correlation[tuple(after)]
+        denominator = low - 2 * centre + high
+        offset = 0.5 * (low - high) / denominator if denominator != 0 else 0
+        position = peak[axis] + offset
+        shift.append(position - size if position > size / 2 else position)
+    return shift[0], shift[1], float(correlation[peak])
+
+
+def refine_surface(reference, target, ref_valid, tgt_valid, angle, shift, iterations = 10):
+    '''
+    Refines the rotation and shift and finds the vertical offset by least squares matching of the warped target DEM to
+    the reference DEM (Gauss-Newton), ignoring cells that changed by more than three times the median absolute deviation.
+    Returns (angle, shift, vertical offset, RMS height difference of the matched cells).
+    '''
+    shift = np.array(shift, dtype = float)
+    centre = (np.array(reference.shape, dtype = float) - 1) / 2
+    rows, cols = np.indices(reference.shape, dtype = float)
+    dz, rms = 0.0, np.nan
+    for _ in range(iterations):
+        warped = warp_to_reference(target, angle, shift, np.nan)
+        overlap = interior(ref_valid & (warp_to_reference(tgt_valid.astype(float), angle, shift) > 0.999) & np.isfinite(warped))
+        if overlap.sum() < 100:
+            break
+        difference = reference - warped
+        dz = float(np.median(difference[overlap]))
+        deviation = np.abs(difference - dz)
+        keep = overlap & (deviation <= 3 * max(float(np.median(deviation[overlap])), 1e-9))
+        gy, gx = np.gradient(np.where(np.isfinite(warped), warped, 0))
+        # a small extra rotation t about the rotation centre and shift d move each cell by d + t * (-v[1], v[0]), with v its
+        # offset from the centre, so reference ~ warped - gradient . (d + t * (-v[1], v[0])) + dz
+        v0, v1 = rows[keep] - centre[0] - shift[0], cols[keep] - centre[1] - shift[1]
+        design = np.column_stack([-gy[keep], -gx[keep], gy[keep] * v1 - gx[keep] * v0, np.ones(int(keep.sum()))])
+        solution = np.linalg.lstsq(design, difference[keep], rcond = None)[0]
+        shift += solution[:2]
+        angle += float(np.degrees(solution[2]))
+        dz = float(solution[3])
+        rms = float(np.sqrt(np.mean((difference[keep] - design @ solution) ** 2)))
+        if np.hypot(solution[0], solution[1]) < 0.01 and abs(np.degrees(solution[2])) < 0.001:
+            break
+    return angle, shift, dz, rms
+
+
+def estimate_offset(reference, target, ref_valid, tgt_valid, max_rotation = 5.0, rotation_step = 0.5):
+    '''
+    Estimates the rotation (degrees), shift (pixels) and vertical offset (DEM units) that bring the target DEM onto the
+    reference DEM, both on the same grid. Returns a dict with angle, shift, dz, peak (phase correlation peak height) and rms.
+    '''
+    ref_gradient = gradient_magnitude(reference, ref_valid)
+    tgt_gradient = gradient_magnitude(target, tgt_valid)
+    best = None
+    for angle in np.arange(-max_rotation, max_rotation + rotation_step / 2, rotation_step):
+        rotated = warp_to_reference(tgt_gradient, angle, (0, 0))
+        dy, dx, peak = phase_correlation(ref_gradient, rotated)
+        if best is None or peak > best["peak"]:
+            best = {"angle": float(angle), "shift": (dy, dx), "peak": peak}
+    best["angle"], best["shift"], best["dz"], best["rms"] = refine_surface(reference, target, ref_valid, tgt_valid, best["angle"], best["shift"])
+    best["shift"] = tuple(float(value) for value in best["shift"])
+    return best
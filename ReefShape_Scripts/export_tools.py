@@ -0,0 +1,504 @@
+'''
+Export Tools for the ReefShape Workflow
+
+This file contains functions used by the full workflow script to describe, run and schedule its exports
+(orthomosaics, DEMs, shapes). It cannot function as a standalone script.
+
+Each export is described by a plain dict (a "job") that only holds JSON-friendly values, with Metashape
+enums given by name. This lets the same job run either in the current Metashape session or in a separate
+headless Metashape process (see export_worker.py) that opens the saved project read-only. Most of the time
+spent exporting is compression and disk I/O rather than Metashape work, so running independent exports
+side by side in separate processes shortens the end of the workflow considerably.
+'''
+
+import Metashape
+import os
+import sys
+import json
+import time
+import tempfile
+import re
+import glob
+import math
+import hashlib
+import subprocess
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from raster_tools import convert_to_cog, validate_cog, recompress_tiff, quantize_dem, read_tiff_array, DEM_NODATA
+
+TILE_SIZE = 4096 # default TagLab tile size in pixels
+TILE_OVERLAP = 256 # default overlap between neighbouring tiles in pixels
+EXPORT_CACHE_FILE = "reefshape_export_cache.json" # export records, kept in the output folder
+# TIFF codecs Metashape can write itself (without a predictor)
+METASHAPE_CODECS = {"NONE": "TiffCompressionNone", "LZW": "TiffCompressionLZW", "JPEG": "TiffCompressionJPEG",
+                    "DEFLATE": "TiffCompressionDeflate", "PACKBITS": "TiffCompressionPackbits"}
+
+
+def raster_job(name, path, source_data, compression, cog = None, region = None, recompress = None, quantize = None, **params):
+    '''
+    Describes an exportRaster() call. source_data is the name of a Metashape.DataSource value (e.g.
+    "OrthomosaicData"), compression is a dict of Metashape.ImageCompression attributes (with tiff_compression
+    given by name, e.g. "TiffCompressionJPEG"), and params are passed on to exportRaster() as they are.
+    If cog is a dict of convert_to_cog() options, the export is converted to a Cloud-Optimized GeoTIFF afterwards.
+    If region is given as [xmin, ymin, xmax, ymax] in the export projection, only that window is exported.
+    If recompress is a dict of recompress_tiff() options, the files written are recompressed with GDAL afterwards
+    (see export_compression()). If quantize is a dict of quantize_dem() options, a DEM is rewritten in compact
+    16-bit form instead (and recompress is ignored).
+    '''
+    return {"name": name, "type": "raster", "path": path, "source_data": source_data, "compression": compression,
+            "cog": cog, "region": region, "recompress": recompress, "quantize": quantize, "params": params}
+
+
+def tiles_job(name, tiles, source_data, compression, recompress = None, quantize = None, **params):
+    '''
+    Describes a set of exportRaster() calls, one per tile. tiles is a list of dicts with the "path" of each
+    tile and its "region" as [xmin, ymin, xmax, ymax] in the export projection (see tile_grid()); the other
+    arguments are the same as for raster_job() and apply to every tile.
+    '''
+    return {"name": name, "type": "raster_tiles", "tiles": tiles, "source_data": source_data, "compression": compression,
+            "recompress": recompress, "quantize": quantize, "params": params}
+
+
+def shapes_job(name, path, **params):
+    ''' describes an exportShapes() call (as a shapefile); params are passed on to exportShapes() as they are '''
+    return {"name": name, "type": "shapes", "path": path, "params": params}
+
+
+def export_region(region):
+    ''' builds a Metashape.BBox from [xmin, ymin, xmax, ymax] '''
+    bbox = Metashape.BBox()
+    bbox.min = Metashape.Vector(region[:2])
+    bbox.max = Metashape.Vector(region[2:])
+    return bbox
+
+
+def is_geographic(crs):
+    ''' True for a coordinate system in degrees, including compound ones such as the default WGS84 + EGM96 '''
+    return crs is not None and "GEOGCS" in crs.wkt and "PROJCS" not in crs.wkt
+
+
+def pixel_size(asset, resolution = 0):
+    '''
+    Returns the (x, y) pixel size in coordinate system units of an orthomosaic or DEM exported at resolution (in metres,
+    0 for the asset's own). Metashape resolutions are in metres while extents and export regions are in coordinate
+    system units, so for a geographic coordinate system the size in degrees is scaled from the asset's own pixels.
+    '''
+    resolution = resolution or asset.resolution
+    if not is_geographic(asset.crs):
+        return resolution, resolution
+    scale = resolution / asset.resolution
+    return (asset.right - asset.left) / asset.width * scale, (asset.top - asset.bottom) / asset.height * scale
+
+
+def window_extent(extent, pixel, margin = 0):
+    '''
+    Grows an extent ([xmin, ymin, xmax, ymax]) by margin on every side and snaps it outwards to whole pixels
+    counted from the origin of the coordinate system, so the same boundary always gives the same window
+    and pixel grid at a given resolution. pixel and margin are in coordinate system units, as one value or
+    an (x, y) pair (see pixel_size()).
+    '''
+    pixel_x, pixel_y = pixel if isinstance(pixel, (list, tuple)) else (pixel, pixel)
+    margin_x, margin_y = margin if isinstance(margin, (list, tuple)) else (margin, margin)
+    xmin, ymin, xmax, ymax = extent
+    return [round(math.floor((xmin - margin_x) / pixel_x) * pixel_x, 12), round(math.floor((ymin - margin_y) / pixel_y) * pixel_y, 12),
+            round(math.ceil((xmax + margin_x) / pixel_x) * pixel_x, 12), round(math.ceil((ymax + margin_y) / pixel_y) * pixel_y, 12)]
+
+
+def export_resolution(asset, resolution, window = None):
+    '''
+    Returns the resolution arguments of exportRaster() for an orthomosaic or DEM: the pixel size of the window's grid
+    in coordinate system units if the export is windowed (see window_extent()), so its pixels line up with the window,
+    otherwise the resolution in metres (0 for the asset's own)
+    '''
+    if window is None:
+        return {"resolution": resolution}
+    pixel = pixel_size(asset, resolution)
+    return {"resolution_x": pixel[0], "resolution_y": pixel[1]}
+
+
+def export_dem_grid(chunk, window, pixel, path):
+    '''
+    Exports the chunk's DEM over window without compression, with pixels of size pixel in coordinate system units (one
+    value or an (x, y) pair, see pixel_size()), and returns it with its valid cell mask
+    '''
+    pixel_x, pixel_y = pixel if isinstance(pixel, (list, tuple)) else (pixel, pixel)
+    raw = Metashape.ImageCompression()
+    raw.tiff_compression = Metashape.ImageCompression.TiffCompressionNone
+    raw.tiff_big = False
+    raw.tiff_overviews = False
+    chunk.exportRaster(path = path, source_data = Metashape.ElevationData, region = export_region(window), resolution_x = pixel_x,
+                       resolution_y = pixel_y, nodata_value = DEM_NODATA, image_format = Metashape.ImageFormat.ImageFormatTIFF, image_compression = raw,
+                       split_in_blocks = False, clip_to_boundary = False, save_alpha = False)
+    dem = read_tiff_array(path)[:, :, 0].astype(np.float64)
+    return dem, dem != DEM_NODATA
+
+
+def export_compression(codec):
+    '''
+    Splits a product's codec (see DEFAULT_COMPRESSION in processing_settings.py) into the Metashape compression
+    to export with and the GDAL recompression to apply afterwards, if any. Codecs Metashape can write are
+    exported directly; others (ZSTD, or any predictor) are exported with LZW and then recompressed.
+    Returns (compression dict for raster_job(), recompress options or None).
+    '''
+    if codec["compression"] in METASHAPE_CODECS and not codec.get("predictor"):
+        compression = {"tiff_compression": METASHAPE_CODECS[codec["compression"]]}
+        if codec["compression"] == "JPEG":
+            compression["jpeg_quality"] = codec.get("quality", 90)
+        return compression, None
+    return {"tiff_compression": "TiffCompressionLZW"}, {"compression": codec["compression"], "quality": codec.get("quality", 90),
+                                                        "predictor": codec.get("predictor")}
+
+
+def image_compression(settings):
+    ''' builds a Metashape.ImageCompression from a dict of its attributes '''
+    compression = Metashape.ImageCompression()
+    for key, value in settings.items():
+        if key == "tiff_compression":
+            value = getattr(Metashape.ImageCompression, value)
+        setattr(compression, key, value)
+    return compression
+
+
+def run_export_job(chunk, job):
+    '''
+    Runs a single export job on the given chunk and returns a record of each file it wrote
+    (see output_records())
+    '''
+    # tiled jobs have no path of their own - the folder of each tile is made as it is exported
+    if "path" in job:
+        folder = os.path.dirname(job["path"])
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+
+    if job["type"] == "raster":
+        params = dict(job["params"])
+        if job.get("region"):
+            params["region"] = export_region(job["region"])
+        chunk.exportRaster(path = job["path"], source_data = getattr(Metashape.DataSource, job["source_data"]),
+                           image_compression = image_compression(job["compression"]), **params)
+    elif job["type"] == "raster_tiles":
+        for tile in job["tiles"]:
+            folder = os.path.dirname(tile["path"])
+            if folder and not os.path.exists(folder):
+                os.makedirs(folder)
+            chunk.exportRaster(path = tile["path"], source_data = getattr(Metashape.DataSource, job["source_data"]), region = export_region(tile["region"]),
+                               image_compression = image_compression(job["compression"]), **job["params"])
+    elif job["type"] == "shapes":
+        chunk.exportShapes(path = job["path"], format = Metashape.ShapesFormatSHP, **job["params"])
+    else:
+        raise Exception("Unknown export type: " + str(job["type"]))
+
+    # post-processing with GDAL - if any step fails, the file Metashape wrote is still valid, so it is only reported
+    for path in output_paths(job):
+        cog = job.get("cog")
+        if job.get("quantize"):
+            try:
+                quantize_dem(path, **job["quantize"])
+                if cog and job["quantize"]["mode"] == "float16":
+                    cog = dict(cog, nbits = 16)
+            except Exception as e:
+                print("Unable to write " + path + " as a compact " + job["quantize"]["mode"] + " DEM: " + str(e))
+                # the float DEM Metashape wrote is kept, so the COG keeps its nodata value and a floating point predictor
+                if cog:
+                    cog = dict(cog, nodata = DEM_NODATA, predictor = 3 if cog.get("predictor") else None)
+        elif job.get("recompress") and not cog:
+            try:
+                recompress_tiff(path, **job["recompress"])
+            except Exception as e:
+                print("Unable to recompress " + path + " with " + job["recompress"]["compression"] + ": " + str(e))
+        if cog:
+            try:
+                convert_to_cog(path, **cog)
+                problems = validate_cog(path)
+                if problems:
+                    print("Cloud-Optimized GeoTIFF layout problems in " + path + ": " + "; ".join(problems))
+                else:
+                    print(" --- Converted to Cloud-Optimized GeoTIFF: " + path + " --- ")
+            except Exception as e:
+                print("Unable to convert " + path + " to a Cloud-Optimized GeoTIFF: " + str(e))
+    return output_records(job)
+
+
+def output_paths(job):
+    '''
+    Returns the files written by a job that exist on disk. Exports split into blocks are found by their
+    block suffixes (e.g. "-1-2"), since Metashape only creates the blocks the raster actually covers.
+    '''
+    if job["type"] == "raster_tiles":
+        paths = [tile["path"] for tile in job["tiles"]]
+    elif job["type"] == "raster" and job["params"].get("split_in_blocks"):
+        base, extension = os.path.splitext(job["path"])
+        block = re.compile(re.escape(base) + r"(-\d+)*" + re.escape(extension) + "$")
+        paths = sorted(path for path in glob.glob(glob.escape(base) + "*" + extension) if block.match(path))
+    else:
+        paths = [job["path"]]
+    return [path for path in paths if os.path.exists(path)]
+
+
+def file_checksum(path, block_size = 8 * 1024 * 1024):
+    ''' returns the SHA-1 checksum of a file, read in blocks so large rasters need little memory '''
+    checksum = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            checksum.update(block)
+    return checksum.hexdigest()
+
+
+def output_records(job):
+    ''' returns the path, size, modification time and checksum of each file written by a job '''
+    return [{"path": path, "size": os.path.getsize(path), "mtime": os.path.getmtime(path), "checksum": file_checksum(path)}
+            for path in output_paths(job)]
+
+
+def source_state(chunk, job):
+    '''
+    Describes the state of the data a job exports from: the key and metadata of the source asset (which
+    change whenever it is rebuilt) and, for exports clipped to the boundary, the boundary vertices
+    '''
+    state = {}
+    if job["type"] in ["raster", "raster_tiles"]:
+        asset = chunk.orthomosaic if job["source_data"] == "OrthomosaicData" else chunk.elevation
+        if asset:
+            state["key"] = asset.key
+            state["meta"] = {key: asset.meta[key] for key in asset.meta.keys()}
+    if job["params"].get("clip_to_boundary") and chunk.shapes:
+        state["boundary"] = [[list(vertex) for vertex in shape.geometry.coordinates[0]] for shape in chunk.shapes
+                             if shape.boundary_type == Metashape.Shape.BoundaryType.OuterBoundary]
+    return state
+
+
+class ExportCache:
+    '''
+    Keeps a record of each raster export in a JSON file in the output folder: a fingerprint of the source data
+    state and export parameters, and the size, modification time and checksum of every file written. An export
+    only needs to run again if it has no record, its source data or parameters have changed, or one of its files
+    is missing or does not match the record (e.g. a file truncated by a crash). Files are only read to compare
+    their checksum if their modification time has changed, so checking up-to-date exports is quick.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.records = {}
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.records = json.load(f)
+            except Exception as e:
+                print("Unable to read export cache, all products will be exported: " + str(e))
+
+    def fingerprint(self, chunk, job):
+        description = {key: value for key, value in job.items() if key != "name"}
+        description["source"] = source_state(chunk, job)
+        return hashlib.sha1(json.dumps(description, sort_keys = True, default = str).encode()).hexdigest()
+
+    def key(self, job):
+        '''
+        the key a job is recorded under: its path or name, or for tiled jobs, which are recorded one tile at a time
+        (see tileJob()), the path of the tile
+        '''
+        if job["type"] == "raster_tiles":
+            return job["tiles"][0]["path"]
+        return job["path"] if "path" in job else job["name"]
+
+    def tileJob(self, job, tile):
+        '''
+        the part of a tiled job that exports one tile. Tiles are recorded on their own, so they stay up to date however
+        the tiles of a product are split into jobs (e.g. with a different number of concurrent exports)
+        '''
+        return dict(job, tiles = [tile])
+
+    def isCurrent(self, chunk, job):
+        record = self.records.get(self.key(job))
+        if not record or record["fingerprint"] != self.fingerprint(chunk, job) or not record["files"]:
+            return False
+        for output in record["files"]:
+            if not os.path.exists(output["path"]) or os.path.getsize(output["path"]) != output["size"]:
+                print("Export " + job["name"] + " does not match its record (" + output["path"] + ")")
+                return False
+            if os.path.getmtime(output["path"]) == output.get("mtime"):
+                continue
+            # touched since it was recorded (e.g. copied) - only the contents tell whether it changed
+            if file_checksum(output["path"]) != output["checksum"]:
+                print("Export " + job["name"] + " does not match its record (" + output["path"] + ")")
+                return False
+            output["mtime"] = os.path.getmtime(output["path"])
+        return True
+
+    def staleJobs(self, chunk, jobs):
+        '''
+        returns the jobs that need to run; only raster exports are cached, other jobs always run. Tiled jobs are
+        reduced to the tiles that need exporting
+        '''
+        stale = []
+        for job in jobs:
+            if job["type"] == "raster_tiles":
+                tiles = [tile for tile in job["tiles"] if not self.isCurrent(chunk, self.tileJob(job, tile))]
+                if not tiles:
+                    print(" --- " + job["name"] + " is up to date, skipping export --- ")
+                    continue
+                if len(tiles) < len(job["tiles"]):
+                    print(" --- " + job["name"] + ": " + str(len(job["tiles"]) - len(tiles)) + " of " + str(len(job["tiles"])) + " tiles are up to date --- ")
+                stale.append(dict(job, tiles = tiles))
+            elif job["type"] == "raster" and self.isCurrent(chunk, job):
+                print(" --- " + job["name"] + " is up to date, skipping export --- ")
+            else:
+                stale.append(job)
+        return stale
+
+    def record(self, chunk, job, files):
+        parts = [(self.tileJob(job, tile), [output for output in files if output["path"] == tile["path"]]) for tile in job["tiles"]] \
+                if job["type"] == "raster_tiles" else [(job, files)]
+        for part, part_files in parts:
+            self.records[self.key(part)] = {"name": part["name"], "fingerprint": self.fingerprint(chunk, part), "files": part_files}
+
+    def save(self):
+        with open(self.path, 'w') as f:
+            json.dump(self.records, f, indent = 1)
+
+
+def tile_grid(extent, pixel, tile_size = TILE_SIZE, overlap = TILE_OVERLAP):
+    '''
+    Returns the tiles covering extent ([xmin, ymin, xmax, ymax] in coordinate system units) as a list of dicts
+    with the tile "id", grid "row" and "col", and "region" ([xmin, ymin, xmax, ymax]). pixel is the (x, y)
+    pixel size in the same units (see pixel_size()).
+
+    Tiles are tile_size pixels square and start every (tile_size - overlap) pixels, counted from the origin
+    of the coordinate system rather than from the extent. Tile edges therefore fall on the same pixel
+    boundaries, and a tile keeps the same row, column and id, in every timepoint of a plot exported with
+    the same coordinate system and resolution - whatever the extent of each timepoint.
+    Rows count upwards (north) and columns to the right (east).
+    '''
+    if overlap >= tile_size:
+        raise Exception("The tile overlap must be smaller than the tile size")
+    step_x, step_y = (tile_size - overlap) * pixel[0], (tile_size - overlap) * pixel[1]
+    length_x, length_y = tile_size * pixel[0], tile_size * pixel[1]
+    xmin, ymin, xmax, ymax = extent
+    tiles = []
+    # a tile is included if its part that is not shared with the next tile intersects the extent
+    for row in range(math.floor(ymin / step_y), math.ceil(ymax / step_y)):
+        for col in range(math.floor(xmin / step_x), math.ceil(xmax / step_x)):
+            x0, y0 = col * step_x, row * step_y
+            tiles.append({"id": "r{}_c{}".format(row, col), "row": row, "col": col,
+                          "region": [round(value, 12) for value in [x0, y0, x0 + length_x, y0 + length_y]]})
+    return tiles
+
+
+def write_tile_manifest(path, tiles, crs, pixel, tile_size, overlap, products):
+    '''
+    Writes a GeoJSON index of a tiled export: one polygon feature per tile, with its id, grid row and column
+    and the file of each product (products maps a product name, e.g. "orthomosaic", to a function returning
+    the file name of a tile). The grid definition needed to line tiles up across timepoints is stored
+    under "tiling". crs is a Metashape.CoordinateSystem and pixel the (x, y) pixel size in its units.
+    '''
+    features = []
+    for tile in tiles:
+        xmin, ymin, xmax, ymax = tile["region"]
+        properties = {"id": tile["id"], "row": tile["row"], "col": tile["col"], "width": tile_size, "height": tile_size}
+        properties.update({product: file_name(tile) for product, file_name in products.items()})
+        features.append({"type": "Feature", "properties": properties,
+                         "geometry": {"type": "Polygon", "coordinates": [[[xmin, ymin], [xmax, ymin], [xmax, ymax], [xmin, ymax], [xmin, ymin]]]}})
+    manifest = {"type": "FeatureCollection",
+                "crs": {"type": "name", "properties": {"name": crs.name}},
+                "tiling": {"crs_wkt": crs.wkt, "pixel_size": list(pixel), "tile_size": tile_size, "overlap": overlap,
+                           "step": [(tile_size - overlap) * pixel[0], (tile_size - overlap) * pixel[1]], "origin": [0, 0]},
+                "features": features}
+    with open(path, 'w') as f:
+        json.dump(manifest, f, indent = 1)
+    return path
+
+
+def metashape_executable():
+    '''
+    Returns the path of the Metashape executable used to launch export workers, or None if it cannot be found.
+    The REEFSHAPE_METASHAPE environment variable can be set to point at it explicitly.
+    '''
+    if os.environ.get("REEFSHAPE_METASHAPE"):
+        return os.environ["REEFSHAPE_METASHAPE"]
+    candidates = [sys.executable]
+    for folder in [os.path.dirname(sys.executable), os.path.dirname(os.path.dirname(sys.executable))]:
+        for name in ["metashape.exe", "metashape.sh", "metashape", "MetashapePro", os.path.join("MacOS", "MetashapePro")]:
+            candidates.append(os.path.join(folder, name))
+    for candidate in candidates:
+        if os.path.isfile(candidate) and os.path.basename(candidate).lower().startswith("metashape"):
+            return candidate
+    return None
+
+
+class ExportScheduler:
+    '''
+    Runs export jobs for one chunk of a saved project, up to max_concurrent at a time, each in its own headless
+    Metashape process, and records how long each takes. The project must be saved before start() is called,
+    since workers read it from disk.
+
+    start() returns straight away so the calling session can do other work (e.g. export the report) while
+    the workers run; wait() blocks until they are all done. Jobs whose worker fails are re-run in the
+    calling session by wait(). With max_concurrent of 1, or if the Metashape executable cannot be found,
+    start() simply runs the jobs one after another in the calling session.
+    '''
+    def __init__(self, chunk, project_path, max_concurrent = 2):
+        self.chunk = chunk
+        self.chunk_key = chunk.key
+        self.project_path = project_path
+        self.max_concurrent = max_concurrent
+        self.executable = metashape_executable() if max_concurrent > 1 else None
+        self.timings = []
+        self.completed = [] # (job, output records) of every job that finished
+        self.futures = []
+        self.pool = None
+        self.temp_dir = None
+
+    def start(self, jobs):
+        if not jobs:
+            return
+        if not self.executable:
+            for job in jobs:
+                self.runLocal(job)
+            return
+        self.temp_dir = tempfile.mkdtemp(prefix = "reefshape_exports_")
+        self.pool = ThreadPoolExecutor(max_workers = self.max_concurrent)
+        for index, job in enumerate(jobs):
+            self.futures.append((job, self.pool.submit(self.runWorker, job, index)))
+
+    def runLocal(self, job):
+        start = time.perf_counter()
+        self.completed.append((job, run_export_job(self.chunk, job)))
+        self.timings.append((job["name"], time.perf_counter() - start, "in session"))
+
+    def runWorker(self, job, index):
+        ''' runs one job in a separate Metashape process - called on a scheduler thread, so never touches the chunk '''
+        job_path = os.path.join(self.temp_dir, "job_" + str(index) + ".json")
+        log_path = os.path.join(self.temp_dir, "job_" + str(index) + ".log")
+        worker_job = dict(job, project_path = self.project_path, chunk_key = self.chunk_key)
+        with open(job_path, 'w') as f:
+            json.dump(worker_job, f)
+        worker_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "export_worker.py")
+        start = time.perf_counter()
+        with open(log_path, 'w') as log:
+            subprocess.run([self.executable, "-platform", "offscreen", "-r", worker_script, job_path],
+                                    stdout = log, stderr = subprocess.STDOUT)
+        # the worker writes a marker file with the records of the files it wrote once the export has finished without errors
+        records = None
+        if os.path.exists(job_path + ".done"):
+            with open(job_path + ".done") as f:
+                records = json.load(f)
+        return time.perf_counter() - start, records, log_path
+
+    def wait(self):
+        '''
+        Waits for all workers, re-runs any failed jobs in the calling session, prints a timing summary and
+        returns a list of (export name, seconds, where it ran)
+        '''
+        for job, future in self.futures:
+            elapsed, records, log_path = future.result()
+            if records is not None:
+                self.completed.append((job, records))
+                self.timings.append((job["name"], elapsed, "worker"))
+            else:
+                print("Export worker failed for " + job["name"] + " (see " + log_path + "), exporting in this session instead")
+                self.runLocal(job)
+        if self.pool:
+            self.pool.shutdown()
+        self.futures = []
+
+        for name, elapsed, where in self.timings:
+            print("Export {}: {:.1f} s ({})".format(name, elapsed, where))
+        return self.timings
@@ -0,0 +1,39 @@
+'''
+ReefShape Export Worker
+
+This script is launched by the full workflow script (see ExportScheduler in export_tools.py) in a separate,
+headless Metashape process to run a single export, so that several exports can run at the same time:
+
+    metashape -platform offscreen -r export_worker.py <job file>.json
+
+It opens the saved project read-only, runs the export described in the job file, and writes a marker file
+listing the files it wrote next to the job file when it has finished without errors. When Metashape loads
+it from the scripts folder at startup without a job file, it does nothing.
+'''
+
+import Metashape
+import os
+import sys
+import json
+
+sys.path.append(os.path.dirname(os.path.abspath(sys.argv[0] if sys.argv and sys.argv[0] else __file__)))
+from export_tools import run_export_job
+
+
+def run_worker(job_path):
+    with open(job_path) as f:
+        job = json.load(f)
+    doc = Metashape.Document()
+    doc.open(job["project_path"], read_only = True, ignore_lock = True)
+    chunk = next(chunk for chunk in doc.chunks if chunk.key == job["chunk_key"])
+    records = run_export_job(chunk, job)
+    with open(job_path + ".done", 'w') as f:
+        json.dump(records, f)
+
+
+if len(sys.argv) > 1 and sys.argv[1].endswith(".json") and os.path.basename(sys.argv[0]) == "export_worker.py":
+    try:
+        run_worker(sys.argv[1])
+    except Exception as e:
+        print("Export failed: " + str(e))
+    Metashape.app.quit()
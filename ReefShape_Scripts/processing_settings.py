@@ -0,0 +1,131 @@
+'''
+Processing Settings for the ReefShape Workflow
+
+This file contains the default task settings (neighbours, work item sizes, etc.) used by the full
+workflow script, and functions to load and save a per-machine tuned profile that overrides them.
+It also holds the export compression used for each product, which the Benchmark Export Compression
+tool (10_benchmark_compression.py) can replace with a recommended profile. It cannot function as a
+standalone script.
+
+The tuned profile is written by the Benchmark Processing Settings tool (09_benchmark_processing.py)
+to a JSON file in the user's home folder that is named after the computer, so a profile created
+on a 16-core laptop is never picked up by a 64-core server sharing the same scripts folder.
+'''
+
+import os
+import json
+import copy
+import socket
+from datetime import datetime
+
+# default settings - these match the values ReefShape has always used
+DEFAULT_SETTINGS = {
+    "match_photos": {"workitem_size_cameras": 20, "workitem_size_pairs": 80, "max_workgroup_size": 100},
+    "depth_maps": {"max_neighbors": 16, "workitem_size_cameras": 20, "max_workgroup_size": 100, "pm_enable": True},
+    "build_dem": {"workitem_size_tiles": 10, "max_workgroup_size": 100},
+    "build_orthomosaic": {"workitem_size_cameras": 20, "workitem_size_tiles": 10, "max_workgroup_size": 100}
+}
+
+# default export compression for each product - these match the codecs ReefShape has always used.
+# compression is a GDAL/TIFF codec name, quality applies to JPEG and predictor (2 or 3) to lossless codecs
+DEFAULT_COMPRESSION = {
+    "ortho": {"compression": "JPEG", "quality": 90, "predictor": None},
+    "dem": {"compression": "LZW", "quality": 90, "predictor": None},
+    "taglab_ortho": {"compression": "LZW", "quality": 90, "predictor": None},
+    "taglab_dem": {"compression": "LZW", "quality": 90, "predictor": None}
+}
+
+PROFILE_FOLDER = os.path.join(os.path.expanduser("~"), ".reefshape")
+COMPRESSION_PROFILE = os.path.join(PROFILE_FOLDER, "compression_profile.json")
+
+
+def machine_name():
+    ''' returns a file-name-safe name for this computer '''
+    name = socket.gethostname() or "unknown"
+    return "".join(c if c.isalnum() or c in "-_" else "_" for c in name)
+
+
+def profile_path():
+    ''' returns the path of the tuned profile for this computer '''
+    return os.path.join(PROFILE_FOLDER, "processing_profile_" + machine_name() + ".json")
+
+
+def load_processing_settings():
+    '''
+    Returns the task settings to use on this computer. Values from the tuned profile (if one exists)
+    override the defaults stage by stage, so a profile that only covers some stages or parameters
+    still works. A missing or unreadable profile falls back to the defaults.
+    '''
+    settings = copy.deepcopy(DEFAULT_SETTINGS)
+    path = profile_path()
+    if not os.path.exists(path):
+        return settings
+    try:
+        with open(path) as f:
+            profile = json.load(f)
+        for stage, values in profile.get("settings", {}).items():
+            if stage in settings:
+                settings[stage].update({key: value for key, value in values.items() if key in settings[stage]})
+        print("Loaded tuned processing settings from " + path)
+    except Exception as e:
+        print(f"Unable to read tuned processing settings, using defaults: {e}")
+    return settings
+
+
+def save_processing_settings(settings, results):
+    '''
+    Writes a tuned profile for this computer containing the chosen settings and the raw benchmark
+    results they were chosen from. Returns the path of the profile.
+    '''
+    if not os.path.exists(PROFILE_FOLDER):
+        os.makedirs(PROFILE_FOLDER)
+    profile = {
+        "machine": machine_name(),
+        "cpu_count": os.cpu_count(),
+        "created": datetime.now().isoformat(timespec = "seconds"),
+        "settings": settings,
+        "results": results
+    }
+    path = profile_path()
+    with open(path, 'w') as f:
+        json.dump(profile, f, indent = 2)
+    return path
+
+
+def load_compression_profile():
+    '''
+    Returns the export compression to use for each product: the recommended profile written by the
+    compression benchmark if there is one, otherwise the defaults. Products missing from the profile
+    keep their defaults.
+    '''
+    compression = copy.deepcopy(DEFAULT_COMPRESSION)
+    if not os.path.exists(COMPRESSION_PROFILE):
+        return compression
+    try:
+        with open(COMPRESSION_PROFILE) as f:
+            profile = json.load(f)
+        for product, codec in profile.get("compression", {}).items():
+            if product in compression:
+                compression[product].update(codec)
+        print("Loaded recommended export compression from " + COMPRESSION_PROFILE)
+    except Exception as e:
+        print(f"Unable to read export compression profile, using defaults: {e}")
+    return compression
+
+
+def save_compression_profile(compression, results):
+    '''
+    Writes the recommended export compression and the benchmark results it was chosen from.
+    Returns the path of the profile.
+    '''
+    if not os.path.exists(PROFILE_FOLDER):
+        os.makedirs(PROFILE_FOLDER)
+    profile = {
+        "machine": machine_name(),
+        "created": datetime.now().isoformat(timespec = "seconds"),
+        "compression": compression,
+        "results": results
+    }
+    with open(COMPRESSION_PROFILE, 'w') as f:
+        json.dump(profile, f, indent = 2)
+    return COMPRESSION_PROFILE
@@ -0,0 +1,790 @@
+'''
+Raster Tools for ReefShape Exports
+
+This file contains functions used by the ReefShape scripts to post-process exported orthomosaics and DEMs
+(GeoTIFFs) outside of Metashape. It cannot function as a standalone script.
+
+Most of these functions use GDAL, which is not bundled with Metashape. It can be installed into Metashape's
+Python with pip (see the Metashape manual on installing external Python modules), or any Python with GDAL
+can be used to run these functions outside of Metashape. Functions that need GDAL raise an exception with
+instructions if it is missing; the TIFF reading, layout validation and quick-look image functions work without it.
+'''
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import zlib
+import struct
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from coregistration import interior
+
+try:
+    from osgeo import gdal, osr
+    gdal.UseExceptions()
+except ImportError:
+    gdal = None
+    osr = None
+
+COG_BLOCK_SIZE = 512
+GDAL_CACHE_MB = 512 # upper bound on GDAL's block cache, so conversions stream with bounded memory
+DEM_NODATA = -32767 # nodata for exported float DEMs - far below any real depth or height
+QUANTIZED_NODATA = -32768 # nodata for compact (int16 and float16) DEMs
+COMPLEXITY_LAYERS = ["surface_area_ratio", "slope", "vrm", "height_range"] # layers of the gridded complexity rasters
+COMPLEXITY_BLOCK_PIXELS = 2048 * 2048 # DEM pixels read by each complexity block
+MIN_CELL_COVERAGE = 0.5 # fraction of a complexity cell the DEM must cover for the cell to get values
+CHANGE_BLOCK_PIXELS = 4096 * 4096 # DEM pixels differenced at a time
+
+
+def require_gdal():
+    ''' raises an exception explaining how to install GDAL if it is not available '''
+    if gdal is None:
+        raise Exception("This tool requires GDAL, which is not installed in Metashape's Python. Install it with "
+                        "'<Metashape folder>/python/python -m pip install gdal' (or run the tool from a Python environment "
+                        "that has GDAL, such as QGIS), then try again.")
+
+
+def require_metres(path):
+    '''
+    Raises an exception unless a raster is in a projected or local coordinate system in metres. Cell sizes, areas and
+    volumes are taken from the geotransform, which for a geographic coordinate system (such as the workflow's default
+    WGS84 + EGM96) is in degrees.
+    '''
+    projection = gdal.Open(path).GetProjection()
+    if not projection:
+        return
+    srs = osr.SpatialReference()
+    srs.ImportFromWkt(projection)
+    if srs.IsGeographic():
+        raise Exception(os.path.basename(path) + " is in a geographic coordinate system (degrees) - set a projected coordinate "
+                        "system in metres (e.g. UTM) for the chunk and export it again")
+    if abs(srs.GetLinearUnits() - 1.0) > 1e-9:
+        raise Exception(os.path.basename(path) + " is in " + srs.GetLinearUnitsName() + " - export it in a coordinate system in metres")
+
+
+def convert_to_cog(src_path, dst_path = None, compression = "JPEG", quality = 90, predictor = None, nodata = None,
+                   nbits = None, block_size = COG_BLOCK_SIZE, cache_mb = GDAL_CACHE_MB):
+    '''
+    Converts a GeoTIFF into a Cloud-Optimized GeoTIFF with internal tiling, overviews ordered smallest first,
+    and the given compression. GDAL reads and writes the raster block by block, so memory use is bounded by
+    cache_mb regardless of the size of the file.
+
+    predictor may be None (no predictor), 2 (horizontal differencing, for integer data) or 3 (floating
+    point predictor, for float DEMs) - it is ignored for JPEG. nbits of 16 keeps a float16 DEM (see
+    quantize_dem()) in half precision, which GDAL would otherwise write back as Float32. If dst_path is not
+    given, the file is converted in place: the COG is written next to it and then replaces it.
+
+    Returns the path of the COG.
+    '''
+    require_gdal()
+    in_place = dst_path is None
+    if in_place:
+        dst_path = os.path.splitext(src_path)[0] + "_cog.tmp.tif"
+
+    options = ["BLOCKSIZE=" + str(block_size), "COMPRESS=" + compression, "OVERVIEWS=IGNORE_EXISTING",
+               "BIGTIFF=IF_SAFER", "NUM_THREADS=ALL_CPUS"]
+    if compression == "JPEG":
+        options.append("QUALITY=" + str(quality))
+    elif predictor:
+        options.append("PREDICTOR=" + str(predictor))
+    if nbits:
+        options.append("NBITS=" + str(nbits))
+
+    path = translate(src_path, dst_path, "COG", options, nodata, cache_mb, in_place)
+    # older GDAL versions ignore NBITS for COGs
+    if nbits and gdal.Open(path).GetRasterBand(1).GetMetadataItem("NBITS", "IMAGE_STRUCTURE") != str(nbits):
+        print("GDAL " + gdal.__version__ + " wrote " + path + " without NBITS=" + str(nbits) + ", so it is no longer compact")
+    return path
+
+
+def recompress_tiff(path, compression = "DEFLATE", quality = 90, predictor = None, nodata = None,
+                    block_size = COG_BLOCK_SIZE, cache_mb = GDAL_CACHE_MB):
+    '''
+    Rewrites a GeoTIFF in place as a tiled GeoTIFF with the given compression and predictor, keeping its
+    overviews. This is used for codecs Metashape cannot write itself (e.g. ZSTD, or any codec with a
+    predictor). Like convert_to_cog(), memory use is bounded by cache_mb.
+    '''
+    require_gdal()
+    options = ["TILED=YES", "BLOCKXSIZE=" + str(block_size), "BLOCKYSIZE=" + str(block_size), "COMPRESS=" + compression,
+               "BIGTIFF=IF_SAFER", "NUM_THREADS=ALL_CPUS", "COPY_SRC_OVERVIEWS=YES"]
+    if compression == "JPEG":
+        options.append("JPEG_QUALITY=" + str(quality))
+    elif predictor:
+        options.append("PREDICTOR=" + str(predictor))
+    return translate(path, os.path.splitext(path)[0] + "_recompressed.tmp.tif", "GTiff", options, nodata, cache_mb, True)
+
+
+def quantize_dem(path, mode = "int16", step = 0.0001, compression = "DEFLATE", block_size = COG_BLOCK_SIZE, cache_mb = GDAL_CACHE_MB):
+    '''
+    Rewrites a float DEM in place in a compact 16-bit form, block by block so memory use stays bounded:
+        int16 - elevations are stored as whole multiples of step (m) from an offset at the middle of the
+        elevation range; the scale and offset are stored in the band metadata, so GIS software reads true
+        elevations. If the relief does not fit in 16 bits at that step, the step is increased to fit.
+        float16 - elevations minus the same offset are stored as half precision floats (with the offset in the
+        band metadata). Precision is finer than 1 mm within 2 m of the offset.
+    Cells with the DEM's nodata value are written as QUANTIZED_NODATA. The file is tiled, compressed with a
+    predictor (horizontal differencing for int16, floating point for float16) and given overviews.
+    Returns the step (int16) or offset used.
+    '''
+    require_gdal()
+    src = gdal.Open(path)
+    band = src.GetRasterBand(1)
+    nodata = band.GetNoDataValue()
+    low, high = band.ComputeRasterMinMax(False)
+    offset = round((low + high) / 2 / step) * step
+    if mode == "int16" and (high - low) / 2 > 32766 * step:
+        step = (high - low) / 2 / 32766
+        print("Elevation range does not fit in 16 bits at the requested step, using " + str(round(step * 1000, 4)) + " mm steps")
+
+    tmp_path = os.path.splitext(path)[0] + "_compact.tmp.tif"
+    options = ["TILED=YES", "BLOCKXSIZE=" + str(block_size), "BLOCKYSIZE=" + str(block_size), "COMPRESS=" + compression,
+               "BIGTIFF=IF_SAFER", "NUM_THREADS=ALL_CPUS", "PREDICTOR=" + ("2" if mode == "int16" else "3")]
+    if mode == "float16":
+        options.append("NBITS=16") # GDAL writes Float32 with NBITS=16 as half precision floats
+    data_type = gdal.GDT_Int16 if mode == "int16" else gdal.GDT_Float32
+    previous_cache = gdal.GetCacheMax()
+    gdal.SetCacheMax(cache_mb * 1024 * 1024)
+    try:
+        dst = gdal.GetDriverByName("GTiff").Create(tmp_path, src.RasterXSize, src.RasterYSize, 1, data_type, options)
+        dst.SetGeoTransform(src.GetGeoTransform())
+        dst.SetProjection(src.GetProjection())
+        out = dst.GetRasterBand(1)
+        out.SetNoDataValue(QUANTIZED_NODATA)
+        for row in range(0, src.RasterYSize, block_size):
+            rows = min(block_size, src.RasterYSize - row)
+            block = band.ReadAsArray(0, row, src.RasterXSize, rows).astype(np.float64)
+            missing = ~np.isfinite(block) if nodata is None else ~np.isfinite(block) | (block == nodata)
+            if mode == "int16":
+                values = np.clip(np.round((block - offset) / step), -32767, 32767).astype(np.int16)
+            else:
+                values = (block - offset).astype(np.float32)
+            values[missing] = QUANTIZED_NODATA
+            out.WriteArray(values, 0, row)
+        out.SetScale(step if mode == "int16" else 1.0)
+        out.SetOffset(offset)
+        dst.SetMetadataItem("REEFSHAPE_DEM_ENCODING", mode)
+        levels = []
+        while max(src.RasterXSize, src.RasterYSize) // (2 ** (len(levels) + 1)) >= block_size:
+            levels.append(2 ** (len(levels) + 1))
+        if levels:
+            dst.BuildOverviews("NEAREST", levels)
+        dst = None
+        src = None
+    finally:
+        gdal.SetCacheMax(previous_cache)
+
+    os.replace(tmp_path, path)
+    if os.path.exists(path + ".ovr"):
+        os.remove(path + ".ovr")
+    return step if mode == "int16" else offset
+
+
+def block_reduce(values, valid, factor, method):
+    '''
+    Reduces a (bands, rows, columns) block by an integer factor along both axes, using only the cells where
+    valid (rows, columns) is set: "mean" averages them (area averaging), "min" and "max" take the extremes.
+    rows and columns must be multiples of factor. Returns the reduced values (float) and validity.
+    '''
+    bands, rows, cols = values.shape
+    shape = (bands, rows // factor, factor, cols // factor, factor)
+    values = values.astype(np.float64).reshape(shape)
+    valid = valid.reshape(shape[1:])
+    count = valid.sum(axis = (1, 3))
+    if method == "mean":
+        reduced = np.where(valid, values, 0).sum(axis = (2, 4)) / np.maximum(count, 1)
+    elif method == "min":
+        reduced = np.where(valid, values, np.inf).min(axis = (2, 4))
+    elif method == "max":
+        reduced = np.where(valid, values, -np.inf).max(axis = (2, 4))
+    else:
+        raise Exception("Unknown resampling method: " + str(method))
+    return reduced, count > 0
+
+
+def ruggedness(gx, gy, cells):
+    '''
+    Vector ruggedness measure (VRM) of each DEM cell from the DEM slopes gx, gy: one minus the length of the mean unit
+    surface normal over its 3x3 window. NaN for cells whose window is not wholly in cells (a boolean mask).
+    '''
+    length = np.sqrt(1 + gx ** 2 + gy ** 2)
+    normals = [np.where(cells, component, 0) for component in [-gx / length, -gy / length, 1 / length]]
+    sums = [np.zeros(cells.shape) for _ in range(3)]
+    count = np.zeros(cells.shape)
+    padded = [np.pad(values, 1) for values in normals + [cells.astype(float)]]
+    rows, cols = cells.shape
+    for dy in range(3):
+        for dx in range(3):
+            for total, values in zip(sums + [count], padded):
+                total += values[dy:dy + rows, dx:dx + cols]
+    resultant = np.sqrt(sums[0] ** 2 + sums[1] ** 2 + sums[2] ** 2) / 9
+    return np.where(cells & (count == 9), np.clip(1 - resultant, 0, 1), np.nan)
+
+
+def downsample_raster(src_path, dst_path, factor, method = "mean", compression = "DEFLATE", block_size = COG_BLOCK_SIZE,
+                      max_block_pixels = 2048 * 2048, cache_mb = GDAL_CACHE_MB):
+    '''
+    Writes a copy of a GeoTIFF at 1/factor of its resolution (factor a whole number), reducing each factor x factor
+    group of pixels with block_reduce(). Pixels are valid unless they are nodata, or transparent in the alpha
+    band of an orthomosaic (the alpha band is 255 wherever any pixel in the group was valid). The raster is
+    processed one window at a time, each reading at most max_block_pixels, so any size of raster can be reduced
+    with little memory. The output keeps the data type of the source, is tiled and compressed with a predictor,
+    and gets overviews. Returns dst_path.
+    '''
+    require_gdal()
+    src = gdal.Open(src_path)
+    width, height, band_count = src.RasterXSize, src.RasterYSize, src.RasterCount
+    bands = [src.GetRasterBand(index + 1) for index in range(band_count)]
+    alpha = next((index for index, band in enumerate(bands) if band.GetColorInterpretation() == gdal.GCI_AlphaBand), None)
+    nodata = bands[0].GetNoDataValue()
+    data_type = bands[0].DataType
+    integer = gdal.GetDataTypeName(data_type) in ["Byte", "UInt16", "Int16", "UInt32", "Int32"]
+    out_width, out_height = -(-width // factor), -(-height // factor)
+
+    options = ["TILED=YES", "BLOCKXSIZE=" + str(block_size), "BLOCKYSIZE=" + str(block_size), "COMPRESS=" + compression,
+               "BIGTIFF=IF_SAFER", "NUM_THREADS=ALL_CPUS", "PREDICTOR=" + ("2" if integer else "3")]
+    if alpha is not None:
+        options.append("ALPHA=YES")
+    previous_cache = gdal.GetCacheMax()
+    gdal.SetCacheMax(cache_mb * 1024 * 1024)
+    try:
+        dst = gdal.GetDriverByName("GTiff").Create(dst_path, out_width, out_height, band_count, data_type, options)
+        x0, pixel_x, rot_x, y0, rot_y, pixel_y = src.GetGeoTransform()
+        dst.SetGeoTransform((x0, pixel_x * factor, rot_x, y0, rot_y, pixel_y * factor))
+        dst.SetProjection(src.GetProjection())
+        for index, band in enumerate(bands):
+            out = dst.GetRasterBand(index + 1)
+            out.SetColorInterpretation(band.GetColorInterpretation())
+            if nodata is not None:
+                out.SetNoDataValue(nodata)
+            if band.GetScale() not in [None, 1.0] or band.GetOffset() not in [None, 0.0]:
+                out.SetScale(band.GetScale())
+                out.SetOffset(band.GetOffset())
+
+        window = max(1, int(np.sqrt(max_block_pixels)) // factor) # output pixels per window side
+        for out_row in range(0, out_height, window):
+            for out_col in range(0, out_width, window):
+                rows, cols = min(window, out_height - out_row) * factor, min(window, out_width - out_col) * factor
+                row, col = out_row * factor, out_col * factor
+                read_rows, read_cols = min(rows, height - row), min(cols, width - col)
+                block = np.stack([band.ReadAsArray(col, row, read_cols, read_rows) for band in bands])
+                # pad partial windows at the right and bottom edges with invalid pixels
+                values = np.zeros((band_count, rows, cols), dtype = block.dtype)
+                values[:, :read_rows, :read_cols] = block
+                valid = np.zeros((rows, cols), dtype = bool)
+                valid[:read_rows, :read_cols] = True
+                if alpha is not None:
+                    valid &= values[alpha] > 0
+                if nodata is not None:
+                    valid &= values[0] != nodata
+                if not integer:
+                    valid &= np.isfinite(values[0])
+
+                reduced, reduced_valid = block_reduce(values, valid, factor, method)
+                if integer:
+                    reduced = np.round(reduced)
+                if alpha is not None:
+                    reduced[alpha] = np.where(reduced_valid, 255, 0)
+                if nodata is not None:
+                    reduced[:, ~reduced_valid] = nodata
+                for index in range(band_count):
+                    dst.GetRasterBand(index + 1).WriteArray(reduced[index].astype(block.dtype), out_col, out_row)
+
+        levels = []
+        while max(out_width, out_height) // (2 ** (len(levels) + 1)) >= block_size:
+            levels.append(2 ** (len(levels) + 1))
+        if levels:
+            dst.BuildOverviews("AVERAGE" if method == "mean" else "NEAREST", levels)
+        dst = None
+    finally:
+        gdal.SetCacheMax(previous_cache)
+    return dst_path
+
+
+def warp_raster(src_path, dst_path, resolution, method = "mean", compression = "DEFLATE", block_size = COG_BLOCK_SIZE, cache_mb = GDAL_CACHE_MB):
+    '''
+    Resamples a GeoTIFF to any resolution with gdal.Warp (area-weighted for "mean"), for resolutions that are not a
+    whole multiple of the source resolution. The output grid starts at the same corner as the source. Returns dst_path.
+    '''
+    require_gdal()
+    src = gdal.Open(src_path)
+    x0, pixel_x, rot_x, y0, rot_y, pixel_y = src.GetGeoTransform()
+    # exports are north up, so pixel_y is negative and y0 is the top edge
+    columns, rows = int(np.ceil(pixel_x * src.RasterXSize / resolution)), int(np.ceil(-pixel_y * src.RasterYSize / resolution))
+    options = ["TILED=YES", "BLOCKXSIZE=" + str(block_size), "BLOCKYSIZE=" + str(block_size), "COMPRESS=" + compression, "BIGTIFF=IF_SAFER"]
+    gdal.Warp(dst_path, src, format = "GTiff", outputBounds = [x0, y0 - rows * resolution, x0 + columns * resolution, y0],
+              width = columns, height = rows, resampleAlg = {"mean": "average", "min": "min", "max": "max"}[method],
+              creationOptions = options, warpMemoryLimit = cache_mb * 1024 * 1024, multithread = True)
+    return dst_path
+
+
+def complexity_block(dem_path, out_row, out_col, rows, cols, factor):
+    '''
+    Computes the complexity layers (see complexity_rasters()) for a block of rows x cols output cells starting at
+    (out_row, out_col), each factor x factor DEM pixels. Reads the block plus a two pixel margin, so slopes and VRM at
+    the edges of the block use the neighbouring pixels. Returns (out_row, out_col, {layer: float32 array}), NaN where
+    a cell has too little DEM. Opens the DEM itself, so it can run in a separate process.
+    '''
+    halo = 2
+    src = gdal.Open(dem_path)
+    band = src.GetRasterBand(1)
+    width, height = src.RasterXSize, src.RasterYSize
+    resolution = abs(src.GetGeoTransform()[1])
+    nodata, scale, offset = band.GetNoDataValue(), band.GetScale() or 1.0, band.GetOffset() or 0.0
+
+    # the block and its margin, padded with invalid pixels beyond the edges of the DEM
+    row, col = out_row * factor - halo, out_col * factor - halo
+    block_rows, block_cols = rows * factor + 2 * halo, cols * factor + 2 * halo
+    read_row, read_col = max(row, 0), max(col, 0)
+    read_rows, read_cols = min(row + block_rows, height) - read_row, min(col + block_cols, width) - read_col
+    raw = band.ReadAsArray(read_col, read_row, read_cols, read_rows)
+    dem = np.zeros((block_rows, block_cols))
+    valid = np.zeros((block_rows, block_cols), dtype = bool)
+    inner_rows, inner_cols = slice(read_row - row, read_row - row + read_rows), slice(read_col - col, read_col - col + read_cols)
+    dem[inner_rows, inner_cols] = raw * scale + offset # compact DEMs are stored with a scale and offset
+    valid[inner_rows, inner_cols] = np.isfinite(raw) if nodata is None else np.isfinite(raw) & (raw != nodata)
+
+    gy, gx = np.gradient(np.where(valid, dem, 0), resolution)
+    slopes = interior(valid) # central difference slopes only use valid pixels
+    vrm = ruggedness(np.where(slopes, gx, 0), np.where(slopes, gy, 0), slopes)
+    crop = (slice(halo, halo + rows * factor), slice(halo, halo + cols * factor))
+    dem, valid, slopes, gx, gy, vrm = [values[crop] for values in [dem, valid, slopes, gx, gy, vrm]]
+
+    layers = {}
+    def reduce(values, mask, method):
+        reduced, _ = block_reduce(values[None], mask, factor, method)
+        count, _ = block_reduce(mask[None].astype(float), np.ones(mask.shape, dtype = bool), factor, "mean")
+        return np.where(count[0] >= MIN_CELL_COVERAGE, reduced[0], np.nan)
+    layers["surface_area_ratio"] = reduce(np.sqrt(1 + gx ** 2 + gy ** 2), slopes, "mean")
+    layers["slope"] = reduce(np.degrees(np.arctan(np.hypot(gx, gy))), slopes, "mean")
+    layers["vrm"] = reduce(np.nan_to_num(vrm), np.isfinite(vrm), "mean")
+    highest, lowest = reduce(dem, valid, "max"), reduce(dem, valid, "min")
+    layers["height_range"] = highest - lowest
+    return out_row, out_col, {name: values.astype(np.float32) for name, values in layers.items()}
+
+
+def complexity_rasters(dem_path, cell_size, out_dir, processes = 1, compression = "DEFLATE", block_size = COG_BLOCK_SIZE,
+                       block_pixels = COMPLEXITY_BLOCK_PIXELS):
+    '''
+    Grids the structural complexity of an exported DEM into cells of cell_size (in metres, rounded to a whole number of
+    DEM pixels), writing one float32 GeoTIFF per layer to out_dir. The DEM must be in metres (see require_metres()):
+        surface_area_ratio - surface area of the DEM in the cell over its plan area
+        slope - mean slope in degrees
+        vrm - mean vector ruggedness measure (3x3 pixel windows)
+        height_range - highest minus lowest point
+    The DEM is read one block of cells at a time (each at most about block_pixels DEM pixels), and blocks are computed
+    by up to processes worker processes, so a DEM of any size can be gridded with little memory. Returns {layer: path}.
+    '''
+    require_gdal()
+    require_metres(dem_path) # the cell size and slopes are computed from the pixel size
+    src = gdal.Open(dem_path)
+    width, height = src.RasterXSize, src.RasterYSize
+    x0, pixel_x, rot_x, y0, rot_y, pixel_y = src.GetGeoTransform()
+    factor = max(1, int(round(cell_size / abs(pixel_x))))
+    out_width, out_height = -(-width // factor), -(-height // factor)
+    window = max(1, int(np.sqrt(block_pixels)) // factor) # output cells per block side
+
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    stem = os.path.splitext(os.path.basename(dem_path))[0] + "_" + ("%g" % (factor * abs(pixel_x) * 100)) + "cm_"
+    options = ["TILED=YES", "BLOCKXSIZE=" + str(block_size), "BLOCKYSIZE=" + str(block_size), "COMPRESS=" + compression,
+               "PREDICTOR=3", "BIGTIFF=IF_SAFER"]
+    paths, outputs = {}, {}
+    for name in COMPLEXITY_LAYERS:
+        paths[name] = os.path.join(out_dir, stem + name + ".tif")
+        outputs[name] = gdal.GetDriverByName("GTiff").Create(paths[name], out_width, out_height, 1, gdal.GDT_Float32, options)
+        outputs[name].SetGeoTransform((x0, pixel_x * factor, rot_x, y0, rot_y, pixel_y * factor))
+        outputs[name].SetProjection(src.GetProjection())
+        outputs[name].GetRasterBand(1).SetNoDataValue(DEM_NODATA)
+
+    blocks = [(dem_path, out_row, out_col, min(window, out_height - out_row), min(window, out_width - out_col), factor)
+              for out_row in range(0, out_height, window) for out_col in range(0, out_width, window)]
+    # inside Metashape, worker processes cannot be started from its embedded Python, so blocks run on threads instead
+    # (GDAL reads and most of the NumPy work release the GIL)
+    executor = ThreadPoolExecutor if "Metashape" in sys.modules else ProcessPoolExecutor
+    start = time.perf_counter()
+    with executor(max_workers = max(1, processes)) as pool:
+        # results are written on this thread as they arrive, since GDAL datasets cannot be shared
+        for out_row, out_col, layers in pool.map(complexity_block, *zip(*blocks)):
+            for name, values in layers.items():
+                outputs[name].GetRasterBand(1).WriteArray(np.where(np.isfinite(values), values, DEM_NODATA).astype(np.float32), out_col, out_row)
+    for name in COMPLEXITY_LAYERS:
+        outputs[name].FlushCache()
+    outputs = None
+    print(" --- Complexity rasters at {:g} m: {} blocks in {:.1f} s --- ".format(factor * abs(pixel_x), len(blocks), time.perf_counter() - start))
+    return paths
+
+
+def read_dem_block(src, col, row, cols, rows):
+    ''' reads a block of a DEM in height units (applying the scale and offset of compact DEMs) and its valid mask '''
+    band = src.GetRasterBand(1)
+    raw = band.ReadAsArray(col, row, cols, rows)
+    nodata = band.GetNoDataValue()
+    valid = np.isfinite(raw) if nodata is None else np.isfinite(raw) & (raw != nodata)
+    return raw * (band.GetScale() or 1.0) + (band.GetOffset() or 0.0), valid
+
+
+def grid_overlap(paths):
+    '''
+    Checks that rasters share a pixel grid - the same coordinate system, pixel size and pixel edges, as the exports of
+    aligned time points do (see window_extent() in export_tools.py) - and returns their overlap as
+    (geotransform, columns, rows, [(column offset, row offset) of the overlap in each raster]). Raises an exception if not.
+    '''
+    rasters = [gdal.Open(path) for path in paths]
+    transforms = [raster.GetGeoTransform() for raster in rasters]
+    first = rasters[0]
+    x_size, y_size = transforms[0][1], transforms[0][5]
+    for path, raster, transform in zip(paths[1:], rasters[1:], transforms[1:]):
+        if raster.GetProjection() != first.GetProjection():
+            raise Exception(os.path.basename(path) + " is not in the same coordinate system as " + os.path.basename(paths[0]))
+        if abs(transform[1] - x_size) > 1e-9 * abs(x_size) or abs(transform[5] - y_size) > 1e-9 * abs(y_size):
+            raise Exception(os.path.basename(path) + " does not have the same resolution as " + os.path.basename(paths[0]) +
+                            " - export the DEMs at the same resolution")
+        offsets = [(transform[0] - transforms[0][0]) / x_size, (transform[3] - transforms[0][3]) / y_size]
+        if any(abs(offset - round(offset)) > 1e-3 for offset in offsets):
+            raise Exception("The pixels of " + os.path.basename(path) + " do not line up with those of " + os.path.basename(paths[0]) +
+                            " - export the DEMs with a boundary window so they share a grid")
+    left = max(transform[0] for transform in transforms)
+    top = min(transform[3] for transform in transforms)
+    right = min(transform[0] + raster.RasterXSize * x_size for transform, raster in zip(transforms, rasters))
+    bottom = max(transform[3] + raster.RasterYSize * y_size for transform, raster in zip(transforms, rasters))
+    columns, rows = int(round((right - left) / x_size)), int(round((bottom - top) / y_size))
+    if columns <= 0 or rows <= 0:
+        raise Exception("The rasters do not overlap")
+    offsets = [(int(round((left - transform[0]) / x_size)), int(round((top - transform[3]) / y_size))) for transform in transforms]
+    return (left, x_size, 0, top, 0, y_size), columns, rows, offsets
+
+
+def rasterize_boundary(boundary_path, geotransform, columns, rows, projection, path):
+    ''' burns the polygons of a boundary shapefile into a tiled byte mask GeoTIFF on the given grid, and returns it opened '''
+    mask = gdal.GetDriverByName("GTiff").Create(path, columns, rows, 1, gdal.GDT_Byte, ["TILED=YES", "COMPRESS=DEFLATE", "BIGTIFF=IF_SAFER"])
+    mask.SetGeoTransform(geotransform)
+    mask.SetProjection(projection)
+    gdal.Rasterize(mask, boundary_path, burnValues = [1])
+    return mask
+
+
+def dem_change(before_path, after_path, dst_path, min_change = 0.0, boundary_path = None, compression = "DEFLATE",
+               block_size = COG_BLOCK_SIZE, block_pixels = CHANGE_BLOCK_PIXELS):
+    '''
+    Writes the difference between two DEMs of aligned time points (after minus before) over their overlap to dst_path as
+    a float32 GeoTIFF, one block at a time, and returns the change statistics inside the boundary (polygons of a
+    shapefile, or everywhere both DEMs have data without one). Changes within min_change of zero (the minimum
+    detectable change) count as no change. The DEMs must be in metres (see require_metres()), and volumes are in m3
+    and areas in m2:
+        area_compared - area where both DEMs have data
+        net_volume, mean_change - volume and mean height change over all compared cells
+        gain_volume, loss_volume, gain_area, loss_area - over the cells that changed by more than min_change
+        detectable_net_volume - gain_volume - loss_volume
+    '''
+    require_gdal()
+    require_metres(before_path) # volumes and areas are computed from the cell size - grid_overlap() checks the other DEM matches
+    geotransform, columns, rows, offsets = grid_overlap([before_path, after_path])
+    before, after = gdal.Open(before_path), gdal.Open(after_path)
+    cell_area = abs(geotransform[1] * geotransform[5])
+    options = ["TILED=YES", "BLOCKXSIZE=" + str(block_size), "BLOCKYSIZE=" + str(block_size), "COMPRESS=" + compression,
+               "PREDICTOR=3", "BIGTIFF=IF_SAFER"]
+    dst = gdal.GetDriverByName("GTiff").Create(dst_path, columns, rows, 1, gdal.GDT_Float32, options)
+    dst.SetGeoTransform(geotransform)
+    dst.SetProjection(after.GetProjection())
+    dst.GetRasterBand(1).SetNoDataValue(DEM_NODATA)
+
+    temp_dir = tempfile.mkdtemp(prefix = "reefshape_change_")
+    mask = None
+    totals = {"cells": 0, "sum": 0.0, "gain": 0.0, "loss": 0.0, "gain_cells": 0, "loss_cells": 0}
+    try:
+        if boundary_path:
+            mask = rasterize_boundary(boundary_path, geotransform, columns, rows, after.GetProjection(), os.path.join(temp_dir, "boundary.tif"))
+        window = max(block_size, int(np.sqrt(block_pixels)) // block_size * block_size) # whole output tiles per block
+        for row in range(0, rows, window):
+            for col in range(0, columns, window):
+                block_rows, block_cols = min(window, rows - row), min(window, columns - col)
+                old, old_valid = read_dem_block(before, offsets[0][0] + col, offsets[0][1] + row, block_cols, block_rows)
+                new, new_valid = read_dem_block(after, offsets[1][0] + col, offsets[1][1] + row, block_cols, block_rows)
+                valid = old_valid & new_valid
+                difference = np.where(valid, new - old, DEM_NODATA)
+                dst.GetRasterBand(1).WriteArray(difference.astype(np.float32), col, row)
+                if mask is not None:
+                    valid &= mask.GetRasterBand(1).ReadAsArray(col, row, block_cols, block_rows) > 0
+                change = difference[valid]
+                totals["cells"] += change.size
+                totals["sum"] += float(change.sum())
+                totals["gain"] += float(change[change > min_change].sum())
+                totals["loss"] -= float(change[change < -min_change].sum())
+                totals["gain_cells"] += int((change > min_change).sum())
+                totals["loss_cells"] += int((change < -min_change).sum())
+        dst.FlushCache()
+    finally:
+        dst = None
+        mask = None
+        shutil.rmtree(temp_dir, ignore_errors = True)
+    return {"area_compared": totals["cells"] * cell_area, "net_volume": totals["sum"] * cell_area,
+            "mean_change": totals["sum"] / totals["cells"] if totals["cells"] else float("nan"),
+            "gain_volume": totals["gain"] * cell_area, "loss_volume": totals["loss"] * cell_area,
+            "detectable_net_volume": (totals["gain"] - totals["loss"]) * cell_area,
+            "gain_area": totals["gain_cells"] * cell_area, "loss_area": totals["loss_cells"] * cell_area}
+
+
+def translate(src_path, dst_path, driver, options, nodata, cache_mb, in_place):
+    ''' runs gdal.Translate with a bounded block cache, replacing src_path with the result if in_place is set '''
+    previous_cache = gdal.GetCacheMax()
+    gdal.SetCacheMax(cache_mb * 1024 * 1024)
+    try:
+        gdal.Translate(dst_path, src_path, format = driver, creationOptions = options, noData = nodata)
+    finally:
+        gdal.SetCacheMax(previous_cache)
+
+    if in_place:
+        os.replace(dst_path, src_path)
+        # external overviews from the original export no longer match the file
+        if os.path.exists(src_path + ".ovr"):
+            os.remove(src_path + ".ovr")
+        return src_path
+    return dst_path
+
+
+def benchmark_codec(src_path, dst_path, compression, quality = 90, predictor = None, block_size = COG_BLOCK_SIZE):
+    '''
+    Writes src_path to dst_path as a tiled GeoTIFF with the given codec and measures it. Returns a dict with the
+    encode and decode (full read) times in seconds, the file size in MB, and for lossy results the peak
+    signal-to-noise ratio in dB against the source (None if the result is identical to the source).
+    '''
+    require_gdal()
+    options = ["TILED=YES", "BLOCKXSIZE=" + str(block_size), "BLOCKYSIZE=" + str(block_size), "COMPRESS=" + compression]
+    if compression == "JPEG":
+        options.append("JPEG_QUALITY=" + str(quality))
+    elif predictor:
+        options.append("PREDICTOR=" + str(predictor))
+
+    start = time.perf_counter()
+    gdal.Translate(dst_path, src_path, format = "GTiff", creationOptions = options)
+    encode = time.perf_counter() - start
+
+    previous_cache = gdal.GetCacheMax()
+    gdal.SetCacheMax(0) # make sure the decode is read from the file, not from the cache
+    try:
+        start = time.perf_counter()
+        decoded = gdal.Open(dst_path).ReadAsArray()
+        decode = time.perf_counter() - start
+    finally:
+        gdal.SetCacheMax(previous_cache)
+
+    original = gdal.Open(src_path).ReadAsArray()
+    psnr = None
+    if not np.array_equal(original, decoded):
+        valid = np.isfinite(original) & np.isfinite(decoded)
+        error = np.mean((original[valid].astype(float) - decoded[valid].astype(float)) ** 2)
+        peak = 255.0 if original.dtype == np.uint8 else float(np.ptp(original[valid])) or 1.0
+        psnr = round(float(10 * np.log10(peak ** 2 / error)), 2) if error > 0 else None
+    return {"encode_s": round(encode, 3), "decode_s": round(decode, 3), "size_mb": round(os.path.getsize(dst_path) / 1024 ** 2, 3), "psnr_db": psnr}
+
+
+# ---- TIFF layout validation (no GDAL needed) ----
+
+TIFF_TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2, 9: 4, 10: 8, 11: 4, 12: 8, 16: 8, 17: 8, 18: 8}
+TIFF_TYPE_FORMATS = {1: "B", 3: "H", 4: "I", 6: "b", 8: "h", 9: "i", 16: "Q", 17: "q", 18: "Q"}
+TAG_NEW_SUBFILE_TYPE = 254
+TAG_IMAGE_WIDTH = 256
+TAG_IMAGE_LENGTH = 257
+TAG_TILE_WIDTH = 322
+TAG_TILE_LENGTH = 323
+TAG_BITS_PER_SAMPLE = 258
+TAG_COMPRESSION = 259
+TAG_STRIP_OFFSETS = 273
+TAG_SAMPLES_PER_PIXEL = 277
+TAG_ROWS_PER_STRIP = 278
+TAG_STRIP_BYTE_COUNTS = 279
+TAG_PLANAR_CONFIG = 284
+TAG_TILE_OFFSETS = 324
+TAG_TILE_BYTE_COUNTS = 325
+TAG_SAMPLE_FORMAT = 339
+
+
+def read_tiff_ifds(path):
+    '''
+    Reads the directory structure of a TIFF or BigTIFF file. Returns a list of (ifd_offset, tags), where tags
+    maps each integer-valued tag to its list of values. Only the IFDs are read, never the image data.
+    '''
+    ifds = []
+    with open(path, 'rb') as f:
+        header = f.read(16)
+        if header[:2] == b"II":
+            endian = "<"
+        elif header[:2] == b"MM":
+            endian = ">"
+        else:
+            raise Exception("Not a TIFF file: " + path)
+        version = struct.unpack(endian + "H", header[2:4])[0]
+        if version == 42:
+            big, offset = False, struct.unpack(endian + "I", header[4:8])[0]
+        elif version == 43:
+            big, offset = True, struct.unpack(endian + "Q", header[8:16])[0]
+        else:
+            raise Exception("Not a TIFF file: " + path)
+
+        count_format, entry_size, next_format = ("Q", 20, "Q") if big else ("H", 12, "I")
+        inline_size = 8 if big else 4
+        visited = set()
+        while offset and offset not in visited:
+            visited.add(offset)
+            f.seek(offset)
+            count = struct.unpack(endian + count_format, f.read(struct.calcsize(count_format)))[0]
+            entries = f.read(count * entry_size)
+            next_offset = struct.unpack(endian + next_format, f.read(struct.calcsize(next_format)))[0]
+            tags = {}
+            for i in range(count):
+                entry = entries[i * entry_size:(i + 1) * entry_size]
+                tag, value_type = struct.unpack(endian + "HH", entry[:4])
+                value_count = struct.unpack(endian + ("Q" if big else "I"), entry[4:12 if big else 8])[0]
+                if value_type not in TIFF_TYPE_FORMATS:
+                    continue
+                size = TIFF_TYPE_SIZES[value_type] * value_count
+                raw = entry[12 if big else 8:]
+                if size > inline_size:
+                    data_offset = struct.unpack(endian + ("Q" if big else "I"), raw[:inline_size])[0]
+                    position = f.tell()
+                    f.seek(data_offset)
+                    raw = f.read(size)
+                    f.seek(position)
+                tags[tag] = list(struct.unpack(endian + TIFF_TYPE_FORMATS[value_type] * value_count, raw[:size]))
+            ifds.append((offset, tags))
+            offset = next_offset
+    return ifds
+
+
+def read_tiff_array(path):
+    '''
+    Reads the full resolution image of an uncompressed, pixel-interleaved TIFF (striped or tiled) into a NumPy
+    array of shape (rows, columns, samples). This is only meant for small rasters, such as quick-look exports
+    written without compression, and avoids needing GDAL for them.
+    '''
+    tags = read_tiff_ifds(path)[0][1]
+    if tags.get(TAG_COMPRESSION, [1])[0] != 1 or tags.get(TAG_PLANAR_CONFIG, [1])[0] != 1:
+        raise Exception("Only uncompressed, pixel-interleaved TIFFs can be read without GDAL: " + path)
+    with open(path, 'rb') as f:
+        endian = "<" if f.read(2) == b"II" else ">"
+    width, height = tags[TAG_IMAGE_WIDTH][0], tags[TAG_IMAGE_LENGTH][0]
+    samples = tags.get(TAG_SAMPLES_PER_PIXEL, [1])[0]
+    kind = {1: "u", 2: "i", 3: "f"}[tags.get(TAG_SAMPLE_FORMAT, [1])[0]]
+    dtype = np.dtype(endian + kind + str(tags[TAG_BITS_PER_SAMPLE][0] // 8))
+
+    image = np.zeros((height, width, samples), dtype = dtype)
+    with open(path, 'rb') as f:
+        if TAG_TILE_WIDTH in tags:
+            tile_width, tile_height = tags[TAG_TILE_WIDTH][0], tags[TAG_TILE_LENGTH][0]
+            tiles_across = -(-width // tile_width)
+            for index, offset in enumerate(tags[TAG_TILE_OFFSETS]):
+                f.seek(offset)
+                tile = np.frombuffer(f.read(tile_width * tile_height * samples * dtype.itemsize), dtype = dtype)
+                tile = tile.reshape(tile_height, tile_width, samples)
+                row, col = (index // tiles_across) * tile_height, (index % tiles_across) * tile_width
+                rows, cols = min(tile_height, height - row), min(tile_width, width - col)
+                image[row:row + rows, col:col + cols] = tile[:rows, :cols]
+        else:
+            rows_per_strip = tags.get(TAG_ROWS_PER_STRIP, [height])[0]
+            for index, offset in enumerate(tags[TAG_STRIP_OFFSETS]):
+                row = index * rows_per_strip
+                rows = min(rows_per_strip, height - row)
+                f.seek(offset)
+                strip = np.frombuffer(f.read(rows * width * samples * dtype.itemsize), dtype = dtype)
+                image[row:row + rows] = strip.reshape(rows, width, samples)
+    return image
+
+
+def validate_cog(path, block_size = COG_BLOCK_SIZE):
+    '''
+    Checks that a GeoTIFF has a Cloud-Optimized layout:
+        - the full resolution image comes first and is internally tiled with the expected tile size
+        - it has overviews (if it is larger than one tile)
+        - all IFDs come before the image data, so a reader gets the whole layout from the start of the file
+        - image data is ordered from the smallest overview to the full resolution image
+    Returns a list of problems found; an empty list means the file is a valid COG.
+    '''
+    problems = []
+    ifds = read_tiff_ifds(path)
+    # mask IFDs (subfile type bit 4) are interleaved with their images, so only images are checked for ordering
+    images = [(offset, tags) for offset, tags in ifds if not tags.get(TAG_NEW_SUBFILE_TYPE, [0])[0] & 4]
+    if not images:
+        return ["No images found"]
+
+    main = images[0][1]
+    if main.get(TAG_NEW_SUBFILE_TYPE, [0])[0] & 1:
+        problems.append("The first image is an overview, not the full resolution image")
+    for offset, tags in images:
+        if TAG_TILE_WIDTH not in tags:
+            problems.append("Image at IFD offset " + str(offset) + " is not tiled")
+    if main.get(TAG_TILE_WIDTH, [0])[0] != block_size or main.get(TAG_TILE_LENGTH, [0])[0] != block_size:
+        problems.append("Full resolution tile size is not " + str(block_size) + " px")
+    if max(main[TAG_IMAGE_WIDTH][0], main[TAG_IMAGE_LENGTH][0]) > block_size and len(images) < 2:
+        problems.append("No overviews")
+
+    data_offsets = [min([value for value in tags.get(TAG_TILE_OFFSETS, []) if value > 0] or [0]) for offset, tags in ifds]
+    first_data = min([value for value in data_offsets if value > 0] or [0])
+    if first_data and max(offset for offset, tags in ifds) > first_data:
+        problems.append("IFDs are not all before the image data")
+    image_offsets = [min([value for value in tags.get(TAG_TILE_OFFSETS, []) if value > 0] or [0]) for offset, tags in images]
+    for larger, smaller in zip(image_offsets, image_offsets[1:]):
+        if larger and smaller and larger < smaller:
+            problems.append("Image data is not ordered from the smallest overview to full resolution")
+            break
+    return problems
+
+
+# ---- quick-look images (no GDAL needed) ----
+
+def write_png(path, rgb):
+    ''' writes an (rows, columns, 3) uint8 array as a PNG, using zlib so no imaging library is needed '''
+    height, width = rgb.shape[:2]
+    raw = b"".join(b"\x00" + row.tobytes() for row in np.ascontiguousarray(rgb, dtype = np.uint8))
+    def png_chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff)
+    with open(path, 'wb') as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        f.write(png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)))
+        f.write(png_chunk(b"IDAT", zlib.compress(raw, 6)))
+        f.write(png_chunk(b"IEND", b""))
+
+
+def hillshade(dem, resolution, nodata = None, azimuth = 315, altitude = 45):
+    '''
+    Returns a colour hillshade of a DEM array as an (rows, columns, 3) uint8 array: the shading of a light from
+    the given azimuth and altitude (degrees) multiplied by a blue (low) to red (high) elevation ramp.
+    Nodata cells are white.
+    '''
+    dem = np.asarray(dem, dtype = float)
+    valid = np.isfinite(dem) if nodata is None else np.isfinite(dem) & (dem != nodata)
+    if not valid.any():
+        return np.full(dem.shape + (3,), 255, dtype = np.uint8)
+    filled = np.where(valid, dem, np.median(dem[valid]))
+    dz_dy, dz_dx = np.gradient(filled, resolution)
+    slope = np.arctan(np.hypot(dz_dx, dz_dy))
+    aspect = np.arctan2(-dz_dx, dz_dy) # rows run south, so dz_dy points the other way to north
+    zenith, azimuth = np.radians(90 - altitude), np.radians(azimuth)
+    shade = np.clip(np.cos(zenith) * np.cos(slope) + np.sin(zenith) * np.sin(slope) * np.cos(azimuth - aspect), 0, 1)
+
+    low, high = np.percentile(filled[valid], [2, 98])
+    level = np.clip((filled - low) / max(high - low, 1e-9), 0, 1)
+    ramp = np.stack([level, 1 - np.abs(2 * level - 1), 1 - level], axis = -1) * 0.7 + 0.3
+    rgb = (255 * ramp * (0.25 + 0.75 * shade)[..., None]).astype(np.uint8)
+    rgb[~valid] = 255
+    return rgb
+
+
+def mark_points(rgb, pixels, colour, radius = 2, cross = False):
+    '''
+    Draws a filled square (or a cross, if cross is set) of the given radius and colour at each (row, column)
+    pixel position on an RGB array, in place. Positions outside the image are ignored.
+    '''
+    height, width = rgb.shape[:2]
+    for row, col in pixels:
+        row, col = int(round(row)), int(round(col))
+        if not (0 <= row < height and 0 <= col < width):
+            continue
+        top, bottom, left, right = max(row - radius, 0), min(row + radius + 1, height), max(col - radius, 0), min(col + radius + 1, width)
+        if cross:
+            rgb[top:bottom, col] = colour
+            rgb[row, left:right] = colour
+        else:
+            rgb[top:bottom, left:right] = colour
+    return rgb
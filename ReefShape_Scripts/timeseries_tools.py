@@ -0,0 +1,565 @@
+'''
+Time Series Tools for ReefShape
+
+This file contains the functions used to align the chunks of later time points to a processed reference chunk,
+shared by the Align Timepoints dialog (02_align_chunks.py) and the batch alignment script (13_align_all_timepoints.py).
+It cannot function as a standalone script.
+
+Each alignment can be checked with record_alignment_qa(), which measures how well a chunk landed on its reference time
+point (marker residuals, and the scale, rotation and height differences left between the two) and stores the results in
+the chunk metadata and as a row of timeseries_alignment_qa.csv, so unattended batch alignments only need their outliers reviewed.
+
+A chunk is aligned by reading the estimated positions of the reference chunk's markers and setting them as the reference
+coordinates of the same markers in the new chunk (see 02_align_chunks.py). Markers are matched by label, or by target
+number, and the positions are copied at full precision without going through a reference file.
+
+The reference chunk can also be in another project, so each time point can be kept in a project of its own: the
+project is opened read-only, and the marker positions are cached in a reference marker file next to it
+(<project>_<chunk label>_reference_markers.json) which can also be used on its own.
+'''
+
+import Metashape
+import os
+import re
+import csv
+import json
+import shutil
+import tempfile
+from datetime import datetime
+import itertools
+import numpy as np
+from export_tools import window_extent, export_dem_grid, pixel_size
+from coregistration import estimate_offset, map_pixels, interior
+
+MARKER_ACCURACY = 0.0001 # m, reference accuracy of markers transferred from the reference chunk
+DAMAGED_MARKER_ACCURACY = 1 # m, damaged markers are kept but barely constrain the alignment
+MOVED_MARKER_THRESHOLD = 0.01 # m, markers further than this from the fitted similarity transform are flagged as moved or damaged
+MIN_MATCHED_MARKERS = 3 # time points with fewer markers matched to the reference are co-registered from their DEMs instead
+COREGISTRATION_SIZE = 1024 # px, longest side of the DEM grids compared when co-registering
+MIN_CORRELATION_PEAK = 0.1 # phase correlation peak below which the DEMs are considered not to match
+COREGISTRATION_MARKER = "coreg" # label prefix of the pseudo-markers created by co-registration
+COREGISTRATION_ACCURACY = 0.005 # m, reference accuracy of the pseudo-markers
+REFERENCE_CACHE_SUFFIX = "_reference_markers.json" # reference marker files are saved as <project>_<chunk label><suffix>
+QA_FILE = "timeseries_alignment_qa.csv" # one row is appended per alignment check, in the project folder
+QA_DEM_SIZE = 2048 # px, longest side of the DEM grids compared for the QA of an alignment
+QA_MAX_MARKER_RMS = 0.005 # m, alignments above these limits are marked for review
+QA_MAX_SCALE_PPM = 1000
+QA_MAX_ROTATION = 0.05 # deg
+QA_MAX_DEM_OFFSET = 0.01 # m, median height difference over stable areas
+QA_MIN_STABLE_FRACTION = 0.5 # of the overlapping DEM cells
+
+_reference_projects = {} # reference projects opened read-only, by path, kept open for the rest of the session
+TARGET_TYPES = [
+    ("Circular Target 12 Bit", Metashape.CircularTarget12bit),
+    ("Circular Target 14 Bit", Metashape.CircularTarget14bit),
+    ("Circular Target 16 Bit", Metashape.CircularTarget16bit),
+    ("Circular Target 20 Bit", Metashape.CircularTarget20bit),
+    ("Circular Target", Metashape.CircularTarget),
+    ("Cross Target", Metashape.CrossTarget)
+]
+
+
+def chunk_date(chunk):
+    ''' returns the YYYYMMDD date at the start of a chunk label (the naming convention ReefShape suggests), or None '''
+    match = re.match(r"\d{8}", chunk.label)
+    return match.group(0) if match else None
+
+
+def chronological(chunks):
+    ''' sorts chunks by the date in their label, keeping chunks without a date in project order after the dated ones '''
+    return sorted(chunks, key = lambda chunk: (chunk_date(chunk) is None, chunk_date(chunk) or ""))
+
+
+def is_processed(chunk):
+    return chunk.orthomosaic is not None or chunk.elevation is not None
+
+
+def has_reference_markers(chunk):
+    ''' True if the chunk has aligned markers that are enabled for georeferencing '''
+    return any(marker.position is not None and marker.reference.enabled for marker in chunk.markers)
+
+
+def find_reference_chunk(doc):
+    ''' returns the earliest processed chunk with referenced markers, to which the other time points are aligned, or None '''
+    candidates = [chunk for chunk in doc.chunks if is_processed(chunk) and has_reference_markers(chunk)]
+    return chronological(candidates)[0] if candidates else None
+
+
+def pending_chunks(doc, reference_chunk = None):
+    ''' returns the chunks with photos that have not been processed yet, in chronological order '''
+    return chronological([chunk for chunk in doc.chunks if (reference_chunk is None or chunk.key != reference_chunk.key)
+                          and len(chunk.cameras) > 0 and not is_processed(chunk)])
+
+
+def marker_target_id(label):
+    ''' returns the target number at the end of a marker label (e.g. 3 for "target 3"), or None '''
+    match = re.search(r"(\d+)\s*$", label)
+    return int(match.group(1)) if match else None
+
+
+def reference_marker_positions(reference_chunk):
+    '''
+    Returns {label: estimated position} of the reference chunk's markers that are enabled for georeferencing, in the
+    reference chunk's coordinate system at full precision
+    '''
+    positions = {}
+    for marker in reference_chunk.markers:
+        if marker.position is None or not marker.reference.enabled:
+            continue
+        point = reference_chunk.transform.matrix.mulp(marker.position)
+        positions[marker.label] = reference_chunk.crs.project(point) if reference_chunk.crs else point
+    return positions
+
+
+def match_markers(reference_positions, chunk):
+    '''
+    Pairs each marker of chunk with a reference position by label, or by target number when the labels differ
+    (e.g. "target 3" and "point 3"). Returns a list of (marker, reference label, position).
+    '''
+    by_target_id = {marker_target_id(label): label for label in reference_positions if marker_target_id(label) is not None}
+    matches = []
+    for marker in chunk.markers:
+        label = marker.label if marker.label in reference_positions else by_target_id.get(marker_target_id(marker.label))
+        if label is not None:
+            matches.append((marker, label, reference_positions[label]))
+    return matches
+
+
+def chunk_reference(reference_chunk, project_path = ""):
+    '''
+    Returns the reference that other time points are aligned to: the label, project (empty for the open project) and
+    coordinate system of reference_chunk, and the estimated positions of its markers
+    '''
+    positions = reference_marker_positions(reference_chunk)
+    if not positions:
+        raise Exception("Reference chunk " + reference_chunk.label + " has no aligned markers enabled for georeferencing")
+    return {"chunk": reference_chunk.label, "project": project_path, "crs": reference_chunk.crs, "markers": positions}
+
+
+def save_reference(reference, path):
+    ''' writes a reference (see chunk_reference()) to a reference marker file '''
+    with open(path, 'w') as f:
+        json.dump({"chunk": reference["chunk"], "project": reference["project"], "saved": datetime.now().isoformat(timespec = "seconds"),
+                   "crs_wkt": reference["crs"].wkt if reference["crs"] else None,
+                   "markers": {label: [point[0], point[1], point[2]] for label, point in reference["markers"].items()}}, f, indent = 1)
+
+
+def load_reference(path):
+    ''' reads a reference marker file written by save_reference() '''
+    with open(path) as f:
+        data = json.load(f)
+    return {"chunk": data["chunk"], "project": data["project"],
+            "crs": Metashape.CoordinateSystem(data["crs_wkt"]) if data["crs_wkt"] else None,
+            "markers": {label: Metashape.Vector(point) for label, point in data["markers"].items()}}
+
+
+def open_reference_project(project_path):
+    ''' opens another project read-only (once per session), so its chunks can be used as references without merging projects '''
+    if project_path not in _reference_projects:
+        print("Opening reference project " + project_path + " read-only...")
+        doc = Metashape.Document()
+        doc.open(project_path, read_only = True, ignore_lock = True)
+        _reference_projects[project_path] = doc
+    return _reference_projects[project_path]
+
+
+def external_reference(path, chunk_label = None):
+    '''
+    Returns the reference for a time point kept in another project: either a reference marker file, or a project (.psx)
+    and the label of the chunk in it (the earliest processed chunk with referenced markers if not given). Marker positions
+    read from a project are cached in a reference marker file next to it, which is used instead of opening the project
+    until the project is saved again.
+    '''
+    if path.lower().endswith(".json"):
+        return load_reference(path)
+    if chunk_label:
+        cache_path = os.path.splitext(path)[0] + "_" + chunk_label + REFERENCE_CACHE_SUFFIX
+        if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(path):
+            return load_reference(cache_path)
+    doc = open_reference_project(path)
+    if chunk_label:
+        reference_chunk = next((chunk for chunk in doc.chunks if chunk.label == chunk_label), None)
+    else:
+        reference_chunk = find_reference_chunk(doc)
+    if reference_chunk is None:
+        raise Exception("No reference chunk " + (chunk_label or "with referenced markers") + " found in " + path)
+    reference = chunk_reference(reference_chunk, path)
+    try:
+        save_reference(reference, os.path.splitext(path)[0] + "_" + reference_chunk.label + REFERENCE_CACHE_SUFFIX)
+    except OSError as e:
+        print("Unable to cache reference markers: " + str(e))
+    return reference
+
+
+def reference_chunk_of(doc, chunk):
+    ''' returns the chunk that chunk was aligned to, opening its project read-only if it is in another project, or None '''
+    label = chunk.meta['timeseries_reference']
+    project_path = chunk.meta['timeseries_reference_project']
+    if not label:
+        return None
+    if project_path and os.path.abspath(project_path) != os.path.abspath(doc.path):
+        if not os.path.exists(project_path):
+            return None
+        doc = open_reference_project(project_path)
+    return next((reference_chunk for reference_chunk in doc.chunks if reference_chunk.label == label), None)
+
+
+def transfer_reference(reference, chunk, target_type, damaged_markers = ()):
+    '''
+    Georeferences chunk with the estimated marker positions of a reference time point (see chunk_reference() and
+    external_reference()): detects the markers in chunk (unless it already has markers) and sets the reference location
+    and accuracy of each marker that matches a reference marker. Markers whose labels are in damaged_markers get a loose
+    accuracy, so moved or broken markers do not distort the alignment. Returns the list of matches (see match_markers()).
+    '''
+    reference_crs = reference["crs"]
+
+    # pseudo-markers from an earlier co-registration are replaced by the new reference
+    chunk.remove([marker for marker in chunk.markers if marker.label.startswith(COREGISTRATION_MARKER + " ")])
+
+    # only detect markers if there are currently no markers in the chunk
+    if(len(chunk.markers) == 0):
+        chunk.detectMarkers(target_type = target_type, tolerance=20, filter_mask=False, inverted=False, noparity=False, maximum_residual=5, minimum_size=0, minimum_dist=5)
+
+    # reference positions are in the reference chunk's coordinate system - use it for the new chunk too, or convert to the new chunk's
+    if not chunk.crs:
+        chunk.crs = reference_crs
+    convert = bool(reference_crs and chunk.crs) and chunk.crs.wkt != reference_crs.wkt
+
+    matches = match_markers(reference["markers"], chunk)
+    for marker, label, position in matches:
+        if convert:
+            position = Metashape.CoordinateSystem.transform(position, reference_crs, chunk.crs)
+        # accuracy is set in meters
+        accuracy = DAMAGED_MARKER_ACCURACY if marker.label in damaged_markers or label in damaged_markers else MARKER_ACCURACY
+        marker.reference.location = Metashape.Vector([position[0], position[1], position[2]])
+        marker.reference.accuracy = Metashape.Vector([accuracy, accuracy, accuracy])
+        marker.reference.enabled = True
+    print(" --- Reference transferred to {} of {} markers --- ".format(len(matches), len(chunk.markers)))
+    chunk.updateTransform()
+    chunk.meta['timeseries_reference'] = reference["chunk"]
+    chunk.meta['timeseries_reference_project'] = reference["project"]
+    chunk.meta['marker_check'] = "" # markers are checked again with the new reference
+    chunk.meta['moved_markers'] = ""
+    chunk.meta['qa_review'] = "" # and the alignment QA is recorded again
+    chunk.meta['qa_dem_offset_m'] = ""
+    chunk.meta['qa_dem_checked'] = ""
+    # with too few markers the chunk cannot be georeferenced from them - the workflow co-registers its DEM to the reference DEM instead
+    chunk.meta['coregistration'] = "pending" if len(matches) < MIN_MATCHED_MARKERS else ""
+    if len(matches) < MIN_MATCHED_MARKERS:
+        print(" --- Only {} markers matched: {} will be co-registered to {} from its DEM --- ".format(len(matches), chunk.label, reference["chunk"]))
+    return matches
+
+
+def similarity_transform(source, target):
+    '''
+    Least squares similarity transform (Umeyama) mapping source points (N, 3) onto target points.
+    Returns scale, rotation (3, 3) and translation, so that target ~ scale * rotation @ source + translation.
+    '''
+    source_mean, target_mean = source.mean(axis = 0), target.mean(axis = 0)
+    src, dst = source - source_mean, target - target_mean
+    u, d, vt = np.linalg.svd(dst.T @ src / len(source))
+    sign = np.eye(3)
+    if np.linalg.det(u) * np.linalg.det(vt) < 0: # avoid a reflection
+        sign[2, 2] = -1
+    rotation = u @ sign @ vt
+    variance = (src ** 2).sum() / len(source)
+    scale = np.trace(np.diag(d) @ sign) / variance if variance > 0 else 1.0
+    return scale, rotation, target_mean - scale * rotation @ source_mean
+
+
+def robust_similarity(source, target, threshold):
+    '''
+    Fits a similarity transform from source to target that ignores outliers: every 3-point sample is fitted and scored
+    by the number of points within threshold of it (ties go to the smaller truncated squared error), then the transform
+    is refitted to the best sample's inliers. With only a few markers, trying every sample is cheaper than random sampling
+    and always finds the best one. Returns the residual distance of each point and a mask of the outliers. None are
+    flagged for three points: a bad fit shows that something moved, but not which point, as that needs a fourth to compare against.
+    '''
+    def residuals(points):
+        scale, rotation, translation = similarity_transform(source[points], target[points])
+        return np.linalg.norm(target - (scale * source @ rotation.T + translation), axis = 1)
+
+    inliers = np.ones(len(source), dtype = bool)
+    if len(source) > 3: # the only sample of three points is all of them, so an outlier can't be singled out without a fourth
+        best = None
+        for sample in itertools.combinations(range(len(source)), 3):
+            distances = residuals(list(sample))
+            score = (int((distances <= threshold).sum()), -float(np.sum(np.minimum(distances, threshold) ** 2)))
+            if best is None or score > best[0]:
+                best = (score, distances <= threshold)
+        if best[0][0] >= 3:
+            inliers = best[1]
+    distances = residuals(np.flatnonzero(inliers))
+    return distances, (distances > threshold) & (len(source) > 3)
+
+
+def check_marker_residuals(chunk, output_dir, threshold = MOVED_MARKER_THRESHOLD):
+    '''
+    Finds markers that were moved or damaged since the reference time point by fitting a robust 7-parameter similarity
+    transform between the aligned marker positions and their reference locations (in geocentric coordinates, so geographic
+    coordinate systems work too). Markers further than threshold (m) from the fit get a loose accuracy, and a table of
+    residuals is written to <output_dir>/<chunk label>_marker_residuals.csv. Needs aligned cameras.
+    Returns the labels of the flagged markers.
+    '''
+    markers = [marker for marker in chunk.markers if marker.position is not None and marker.reference.location is not None
+               and marker.reference.enabled]
+    if len(markers) < 3:
+        print("Not enough referenced markers to check for moved markers in " + chunk.label)
+        return []
+    source = np.array([[marker.position[i] for i in range(3)] for marker in markers])
+    target = np.array([[point[i] for i in range(3)] for point in
+                       [chunk.crs.unproject(marker.reference.location) if chunk.crs else marker.reference.location for marker in markers]])
+    distances, flagged = robust_similarity(source, target, threshold)
+
+    path = os.path.join(output_dir, chunk.label + "_marker_residuals.csv")
+    with open(path, 'w', newline = '') as f:
+        writer = csv.writer(f)
+        writer.writerow(["marker", "residual_m", "flagged"])
+        for marker, distance, moved in zip(markers, distances, flagged):
+            writer.writerow([marker.label, "{:.5f}".format(distance), int(moved)])
+
+    moved_markers = [marker.label for marker, moved in zip(markers, flagged) if moved]
+    for marker, moved in zip(markers, flagged):
+        if moved:
+            marker.reference.accuracy = Metashape.Vector([DAMAGED_MARKER_ACCURACY] * 3)
+    if moved_markers:
+        chunk.updateTransform()
+        print(" --- Markers flagged as moved or damaged: " + ", ".join(moved_markers) + " --- ")
+    chunk.meta['moved_markers'] = ", ".join(moved_markers)
+    chunk.meta['marker_check'] = path
+    return moved_markers
+
+
+def has_aligned_markers(chunk):
+    return any(marker.position is not None for marker in chunk.markers)
+
+
+def dem_grids(reference_chunk, chunk, size):
+    '''
+    Exports the DEMs of both chunks on the same grid of square cells, covering the reference DEM with size pixels along
+    its longest side. Returns (reference DEM, valid mask, chunk DEM, valid mask, window, (x, y) pixel size in coordinate
+    system units, cell size in metres).
+    '''
+    reference_dem = reference_chunk.elevation
+    resolution = reference_dem.resolution * max(reference_dem.width, reference_dem.height) / size
+    pixel = pixel_size(reference_dem, resolution) # in degrees for a geographic coordinate system
+    window = window_extent([reference_dem.left, reference_dem.bottom, reference_dem.right, reference_dem.top], pixel)
+    temp_dir = tempfile.mkdtemp(prefix = "reefshape_dem_grids_")
+    try:
+        reference, reference_valid = export_dem_grid(reference_chunk, window, pixel, os.path.join(temp_dir, "reference.tif"))
+        target, target_valid = export_dem_grid(chunk, window, pixel, os.path.join(temp_dir, "target.tif"))
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors = True)
+    return reference, reference_valid, target, target_valid, window, pixel, resolution
+
+
+def coregister_chunk(reference_chunk, chunk):
+    '''
+    Co-registers a chunk that could not be georeferenced from the reference chunk's markers to the reference DEM (see
+    coregistration.py). The chunk must already be roughly georeferenced (e.g. from its own georeferencing file) and
+    have a DEM. Pseudo-markers are placed at four points spread over the chunk's DEM, with reference locations where
+    those points match the reference DEM, and the chunk transform is updated from them. The chunk's DEM and
+    orthomosaic are removed, since they no longer match its georeferencing, so they must be rebuilt.
+    Returns a description of the correction.
+    '''
+    reference_dem, dem = reference_chunk.elevation, chunk.elevation
+    if reference_dem is None or dem is None or chunk.transform.matrix is None:
+        raise Exception("Both time points need a DEM, and " + chunk.label + " must be roughly georeferenced, to co-register them")
+    if reference_dem.crs and dem.crs and reference_dem.crs.wkt != dem.crs.wkt:
+        raise Exception("The DEMs of both time points must be in the same coordinate system to co-register them")
+
+    reference, reference_valid, target, target_valid, window, pixel, resolution = dem_grids(reference_chunk, chunk, COREGISTRATION_SIZE)
+    if not target_valid.any():
+        raise Exception("The DEM of " + chunk.label + " does not overlap the DEM of " + reference_chunk.label)
+
+    result = estimate_offset(reference, target, reference_valid, target_valid)
+    if result["peak"] < MIN_CORRELATION_PEAK:
+        raise Exception("The DEMs of {} and {} do not match (correlation {:.2f}) - place the markers by hand".format(
+                        chunk.label, reference_chunk.label, result["peak"]))
+
+    # pseudo-markers at the valid cells nearest the quarter points of the chunk's DEM
+    rows, cols = np.nonzero(interior(target_valid))
+    cells = []
+    for row_fraction, col_fraction in [(0.25, 0.25), (0.25, 0.75), (0.75, 0.25), (0.75, 0.75)]:
+        row = rows.min() + row_fraction * (rows.max() - rows.min())
+        col = cols.min() + col_fraction * (cols.max() - cols.min())
+        nearest = np.argmin((rows - row) ** 2 + (cols - col) ** 2)
+        cells.append((rows[nearest], cols[nearest]))
+    matched = map_pixels(cells, result["angle"], result["shift"], target.shape)
+
+    def location(row, col, height):
+        point = Metashape.Vector([window[0] + (col + 0.5) * pixel[0], window[3] - (row + 0.5) * pixel[1], height])
+        if dem.crs and chunk.crs and dem.crs.wkt != chunk.crs.wkt:
+            point = Metashape.CoordinateSystem.transform(point, dem.crs, chunk.crs)
+        return point
+
+    chunk.remove([marker for marker in chunk.markers if marker.label.startswith(COREGISTRATION_MARKER + " ")])
+    to_internal = chunk.transform.matrix.inv()
+    for index, ((row, col), (matched_row, matched_col)) in enumerate(zip(cells, matched)):
+        height = target[row, col]
+        marker = chunk.addMarker(to_internal.mulp(chunk.crs.unproject(location(row, col, height))))
+        marker.label = COREGISTRATION_MARKER + " " + str(index + 1)
+        marker.reference.location = location(matched_row, matched_col, height + result["dz"])
+        marker.reference.accuracy = Metashape.Vector([COREGISTRATION_ACCURACY] * 3)
+        marker.reference.enabled = True
+    chunk.updateTransform()
+    chunk.remove([asset for asset in [chunk.orthomosaic, chunk.elevation] if asset is not None])
+
+    # the cells are square on the ground, so the shift in cells is converted to metres with the cell size
+    description = "rotated {:.3f} deg anticlockwise, moved {:.3f} m E, {:.3f} m N, {:.3f} m up (correlation {:.2f}, height RMS {:.3f})".format(
+        result["angle"], result["shift"][1] * resolution, -result["shift"][0] * resolution, result["dz"], result["peak"], result["rms"])
+    chunk.meta['coregistration'] = description
+    print(" --- " + chunk.label + " co-registered to " + reference_chunk.label + ": " + description + " --- ")
+    return description
+
+
+def marker_qa(chunk):
+    '''
+    Compares the estimated positions of the chunk's referenced markers with their reference locations (in geocentric
+    coordinates for geographic coordinate systems). Returns a dict with the residual of each marker, their RMS and
+    maximum, and the scale (ppm) and rotation (degrees) of the similarity transform still left between the estimated
+    and reference positions of the trusted markers (those not given a damaged marker accuracy), or None without three
+    aligned referenced markers.
+    '''
+    markers = [marker for marker in chunk.markers if marker.position is not None and marker.reference.location is not None
+               and marker.reference.enabled]
+    if len(markers) < 3 or chunk.transform.matrix is None:
+        return None
+    estimated = np.array([[point[i] for i in range(3)] for point in [chunk.transform.matrix.mulp(marker.position) for marker in markers]])
+    reference = np.array([[point[i] for i in range(3)] for point in
+                          [chunk.crs.unproject(marker.reference.location) if chunk.crs else marker.reference.location for marker in markers]])
+    residuals = np.linalg.norm(estimated - reference, axis = 1)
+    qa = {"markers": {marker.label: float(residual) for marker, residual in zip(markers, residuals)},
+          "marker_rms": float(np.sqrt(np.mean(residuals ** 2))), "max_residual": float(residuals.max()),
+          "worst_marker": markers[int(np.argmax(residuals))].label, "scale_ppm": None, "rotation_deg": None}
+    trusted = np.array([marker.reference.accuracy is None or marker.reference.accuracy[0] < DAMAGED_MARKER_ACCURACY for marker in markers])
+    if trusted.sum() >= 3:
+        scale, rotation, _ = similarity_transform(estimated[trusted], reference[trusted])
+        qa["scale_ppm"] = float((scale - 1) * 1e6)
+        qa["rotation_deg"] = float(np.degrees(np.arccos(np.clip((np.trace(rotation) - 1) / 2, -1, 1))))
+    return qa
+
+
+def dem_qa(reference_chunk, chunk, size = QA_DEM_SIZE):
+    '''
+    Samples the height differences between the chunk's DEM and the reference DEM over stable areas, i.e. the overlapping
+    cells whose difference is within three robust standard deviations (NMAD) of the median difference, so growth or
+    loss of the reef itself is left out. Returns a dict with the median offset (chunk minus reference), NMAD and RMS over
+    the stable cells and the fraction of the overlap that is stable, or None if either chunk has no DEM.
+    '''
+    if reference_chunk.elevation is None or chunk.elevation is None:
+        return None
+    reference, reference_valid, target, target_valid, _, _, _ = dem_grids(reference_chunk, chunk, size)
+    overlap = reference_valid & target_valid
+    if overlap.sum() < 100:
+        raise Exception("The DEM of " + chunk.label + " does not overlap the DEM of " + reference_chunk.label)
+    difference = (target - reference)[overlap]
+    median = np.median(difference)
+    nmad = 1.4826 * np.median(np.abs(difference - median))
+    stable = np.abs(difference - median) <= 3 * max(nmad, 1e-9)
+    offset = float(np.median(difference[stable]))
+    return {"dem_offset": offset, "dem_nmad": float(1.4826 * np.median(np.abs(difference[stable] - offset))),
+            "dem_rms": float(np.sqrt(np.mean(difference[stable] ** 2))), "stable_fraction": float(stable.mean())}
+
+
+def qa_review(qa):
+    ''' returns the reasons an alignment should be reviewed by hand, from the results of marker_qa() and dem_qa() '''
+    reasons = []
+    if qa.get("marker_rms") is not None and qa["marker_rms"] > QA_MAX_MARKER_RMS:
+        reasons.append("marker RMS {:.4f} m".format(qa["marker_rms"]))
+    if qa.get("scale_ppm") is not None and abs(qa["scale_ppm"]) > QA_MAX_SCALE_PPM:
+        reasons.append("scale {:.0f} ppm".format(qa["scale_ppm"]))
+    if qa.get("rotation_deg") is not None and qa["rotation_deg"] > QA_MAX_ROTATION:
+        reasons.append("rotation {:.3f} deg".format(qa["rotation_deg"]))
+    if qa.get("dem_offset") is not None and abs(qa["dem_offset"]) > QA_MAX_DEM_OFFSET:
+        reasons.append("DEM offset {:.4f} m".format(qa["dem_offset"]))
+    if qa.get("stable_fraction") is not None and qa["stable_fraction"] < QA_MIN_STABLE_FRACTION:
+        reasons.append("stable area {:.0%}".format(qa["stable_fraction"]))
+    return reasons
+
+
+QA_COLUMNS = ["time", "project", "chunk", "reference", "reference_project", "marker_count", "marker_rms_m", "max_residual_m",
+              "worst_marker", "scale_ppm", "rotation_deg", "dem_offset_m", "dem_nmad_m", "dem_rms_m", "stable_fraction",
+              "moved_markers", "coregistration", "review", "marker_residuals_m"]
+
+
+def record_alignment_qa(chunk, output_dir, reference_chunk = None):
+    '''
+    Measures how well chunk is aligned to its reference time point: marker residuals and the remaining scale and rotation
+    difference once its cameras are aligned (see marker_qa()), and height differences over stable areas when both chunks
+    have a DEM and reference_chunk is given (see dem_qa()). The results are stored in the chunk metadata (qa_* keys) and
+    appended as a row to <output_dir>/timeseries_alignment_qa.csv. Returns the results, with the reasons to review the
+    alignment under "review".
+    '''
+    qa = marker_qa(chunk) or {}
+    if reference_chunk is not None:
+        try:
+            qa.update(dem_qa(reference_chunk, chunk) or {})
+        except Exception as e:
+            print("Unable to compare the DEMs of " + chunk.label + " and " + reference_chunk.label + ": " + str(e))
+    qa["review"] = qa_review(qa)
+
+    def number(key, digits):
+        return "{:.{}f}".format(qa[key], digits) if qa.get(key) is not None else ""
+
+    row = {"time": datetime.now().isoformat(timespec = "seconds"), "project": Metashape.app.document.path, "chunk": chunk.label,
+           "reference": chunk.meta['timeseries_reference'] or "", "reference_project": chunk.meta['timeseries_reference_project'] or "",
+           "marker_count": len(qa.get("markers", {})), "marker_rms_m": number("marker_rms", 5), "max_residual_m": number("max_residual", 5),
+           "worst_marker": qa.get("worst_marker", ""), "scale_ppm": number("scale_ppm", 1), "rotation_deg": number("rotation_deg", 4),
+           "dem_offset_m": number("dem_offset", 5), "dem_nmad_m": number("dem_nmad", 5), "dem_rms_m": number("dem_rms", 5),
+           "stable_fraction": number("stable_fraction", 3), "moved_markers": chunk.meta['moved_markers'] or "",
+           "coregistration": chunk.meta['coregistration'] or "", "review": "; ".join(qa["review"]),
+           "marker_residuals_m": "; ".join("{}: {:.5f}".format(label, residual) for label, residual in qa.get("markers", {}).items())}
+    for key in ["marker_rms_m", "max_residual_m", "scale_ppm", "rotation_deg", "dem_offset_m", "dem_nmad_m", "stable_fraction", "review"]:
+        chunk.meta['qa_' + key] = str(row[key])
+    chunk.meta['qa_time'] = row["time"]
+
+    path = os.path.join(output_dir, QA_FILE)
+    new_file = not os.path.exists(path)
+    with open(path, 'a', newline = '') as f:
+        writer = csv.DictWriter(f, fieldnames = QA_COLUMNS)
+        if new_file:
+            writer.writeheader()
+        writer.writerow(row)
+    print(" --- Alignment QA of " + chunk.label + ": marker RMS " + (row["marker_rms_m"] or "n/a") + " m, DEM offset " + (row["dem_offset_m"] or "n/a")
+          + " m" + (" - review: " + row["review"] if row["review"] else "") + " --- ")
+    return qa
+
+
+def align_timepoints(doc, reference, chunks, target_type, damaged_markers = (), process = None):
+    '''
+    Aligns each chunk in turn to the reference time point (see chunk_reference() and external_reference()) and, if process is given, calls process(chunk) straight after to run the
+    processing workflow on it (process may return a description of how the chunk was processed, e.g. the processing mode, for the status). The project is saved after each step, and a chunk that fails is reported and skipped so the
+    rest of the queue still runs. The status of each chunk lists the reasons to review its alignment (see record_alignment_qa()). Returns a list of (chunk label, status).
+    '''
+    results = []
+    for index, chunk in enumerate(chunks):
+        print(" --- Time point {} of {}: {} --- ".format(index + 1, len(chunks), chunk.label))
+        try:
+            transfer_reference(reference, chunk, target_type, damaged_markers)
+            status = "aligned"
+            # markers can only be checked once the cameras are aligned - otherwise the workflow checks them after aligning
+            if has_aligned_markers(chunk):
+                check_marker_residuals(chunk, os.path.dirname(doc.path))
+                if process is None: # otherwise the workflow checks the alignment once the DEM is built
+                    record_alignment_qa(chunk, os.path.dirname(doc.path))
+            doc.save()
+            if process is not None:
+                doc.chunk = chunk
+                mode = process(chunk)
+                status = "processed" if is_processed(chunk) else "aligned, processing stopped early"
+                if mode:
+                    status += " (" + mode + ")"
+            if chunk.meta['qa_review']:
+                status += " (review: " + chunk.meta['qa_review'] + ")"
+            if chunk.meta['moved_markers']:
+                status += " (moved markers: " + chunk.meta['moved_markers'] + ")"
+            if chunk.meta['coregistration']:
+                status += " (co-registration: " + chunk.meta['coregistration'] + ")"
+        except Exception as e:
+            status = "failed: " + str(e)
+        chunk.meta['timeseries_status'] = status
+        print(" --- " + chunk.label + ": " + status + " --- ")
+        results.append((chunk.label, status))
+    doc.save()
+    return results